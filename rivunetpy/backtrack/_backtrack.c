@@ -0,0 +1,481 @@
+#include <stdlib.h>
+#include <math.h>
+#include "_backtrack.h"
+
+/* Native version of the inner loop of R2Tracer._iterative_backtrack. */
+/* Every function below follows its Python counterpart in */
+/* rivunetpy/trace.py step by step, so both engines produce the same */
+/* branches. All volumes are C-ordered. */
+
+#define BRANCH_EPS 1e-5
+#define MA_SHORT_WINDOW 4
+#define MA_LONG_WINDOW 10
+#define MAX_STEPS_AFTER_REACH 200
+#define GRID_CELL 8  /* Edge of the cells of R2NodeGrid in voxels */
+#ifndef min
+#define min(a,b)        ((a) < (b) ? (a): (b))
+#endif
+#ifndef max
+#define max(a,b)        ((a) > (b) ? (a): (b))
+#endif
+
+static npy_intp floor_index(npy_double p, int s) {
+  /* numpy indexing of math.floor(p): -1 wraps around to the last voxel */
+  npy_intp i = (npy_intp) floor(p);
+  if (i < 0) i += s;
+  if (i < 0) i = 0;
+  if (i >= s) i = s - 1;
+  return i;
+}
+
+static npy_intp voxel(const npy_double* p, int* dims) {
+  return (floor_index(p[0], dims[0]) * dims[1] + floor_index(p[1], dims[1])) * dims[2] +
+         floor_index(p[2], dims[2]);
+}
+
+/* A timemap value, from a float32 or a float64 timemap */
+static npy_double time_at(const void* t, bool single, npy_intp index) {
+  return single ? (npy_double) ((const npy_float*) t)[index] : ((const npy_double*) t)[index];
+}
+
+static bool inbound(const npy_double* p, int* dims) {
+  int d;
+  for (d = 0; d < 3; d++) {
+    if (!(0 <= p[d] && p[d] <= dims[d] - 1)) return false;
+  }
+  return true;
+}
+
+static npy_double norm3(const npy_double* v) {
+  return sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2]);
+}
+
+/* Trilinear lookup of the interleaved gradient field (GradientField._sample_one) */
+static void sample_grad(const npy_float* grad, int* dims, const npy_double* p, npy_double* out) {
+  npy_intp c[3], c1[3];
+  npy_double f[3], cx[2][2][3], cy[2][3];
+  int d, a, b, e;
+
+  for (d = 0; d < 3; d++) {
+    c[d] = (npy_intp) floor(p[d]);
+    if (c[d] > dims[d] - 2) c[d] = dims[d] - 2;
+    if (c[d] < 0) c[d] = 0;
+    c1[d] = dims[d] > 1 ? c[d] + 1 : c[d];
+    f[d] = p[d] - c[d];
+  }
+
+#define G(i, j, k, e) ((npy_double) grad[(((i) * dims[1] + (j)) * dims[2] + (k)) * 3 + (e)])
+  for (a = 0; a < 2; a++) {
+    for (b = 0; b < 2; b++) {
+      npy_intp j = a ? c1[1] : c[1];
+      npy_intp k = b ? c1[2] : c[2];
+      for (e = 0; e < 3; e++) {
+        cx[a][b][e] = G(c[0], j, k, e) * (1. - f[0]) + G(c1[0], j, k, e) * f[0];
+      }
+    }
+  }
+#undef G
+
+  for (b = 0; b < 2; b++) {
+    for (e = 0; e < 3; e++) {
+      cy[b][e] = cx[0][b][e] * (1. - f[1]) + cx[1][b][e] * f[1];
+    }
+  }
+  for (e = 0; e < 3; e++) {
+    out[e] = cy[0][e] * (1. - f[2]) + cy[1][e] * f[2];
+  }
+}
+
+static void rk4_k(const npy_float* grad, int* dims, const npy_double* p, npy_double stepsize,
+                  npy_double* k) {
+  npy_double n;
+  int d;
+  sample_grad(grad, dims, p, k);
+  n = norm3(k);
+  n = stepsize / (n > 1. ? n : 1.);
+  for (d = 0; d < 3; d++) k[d] *= n;
+}
+
+/* One RK4 step from srcpt, the result goes to out (rk4) */
+static void rk4(const npy_float* grad, int* dims, const npy_double* srcpt, npy_double stepsize,
+                npy_double* out) {
+  npy_double k1[3], k2[3], k3[3], k4[3], tp[3];
+  int d;
+
+  rk4_k(grad, dims, srcpt, stepsize, k1);
+  for (d = 0; d < 3; d++) tp[d] = srcpt[d] - 0.5 * k1[d];
+  if (!inbound(tp, dims)) goto stay;
+
+  rk4_k(grad, dims, tp, stepsize, k2);
+  for (d = 0; d < 3; d++) tp[d] = srcpt[d] - 0.5 * k2[d];
+  if (!inbound(tp, dims)) goto stay;
+
+  rk4_k(grad, dims, tp, stepsize, k3);
+  for (d = 0; d < 3; d++) tp[d] = srcpt[d] - k3[d];
+  if (!inbound(tp, dims)) goto stay;
+
+  rk4_k(grad, dims, tp, stepsize, k4);
+  for (d = 0; d < 3; d++) out[d] = srcpt[d] - (k1[d] + k2[d] * 2 + k3[d] * 2 + k4[d]) / 6.0;
+  return;
+
+stay:
+  for (d = 0; d < 3; d++) out[d] = srcpt[d];
+}
+
+/* Grow a cube until its foreground density drops below 0.6 (estimate_radius) */
+static npy_double estimate_radius(const npy_double* p, const npy_uint8* bimg, int* dims) {
+  npy_intp x = (npy_intp) floor(p[0]), y = (npy_intp) floor(p[1]), z = (npy_intp) floor(p[2]);
+  npy_intp r = 0, i, j, k, lo[3], hi[3];
+  npy_double total;
+
+  while (true) {
+    r++;
+    lo[0] = max(x - r, 0); hi[0] = min(x + r + 1, dims[0]);
+    lo[1] = max(y - r, 0); hi[1] = min(y + r + 1, dims[1]);
+    lo[2] = max(z - r, 0); hi[2] = min(z + r + 1, dims[2]);
+    total = 0;
+    for (i = lo[0]; i < hi[0]; i++) {
+      for (j = lo[1]; j < hi[1]; j++) {
+        const npy_uint8* row = bimg + (i * dims[1] + j) * dims[2];
+        for (k = lo[2]; k < hi[2]; k++) total += row[k] > 0;
+      }
+    }
+    if (total / (npy_double) ((2 * r + 1) * (2 * r + 1) * (2 * r + 1)) < .6) break;
+  }
+  return (npy_double) r;
+}
+
+static npy_double exponential_moving_average(npy_double p, npy_double ema, npy_double n) {
+  npy_double alpha = 2 / (1 + n);
+  return p * alpha + ema * (1 - alpha);
+}
+
+static int branch_add(R2Branch* branch, const npy_double* pt, npy_double conf, npy_double radius) {
+  if (branch->n == branch->capacity) {
+    npy_intp capacity = branch->capacity > 0 ? branch->capacity * 2 : 256;
+    npy_double* pts = realloc(branch->pts, capacity * 3 * sizeof(npy_double));
+    npy_double* c = realloc(branch->conf, capacity * sizeof(npy_double));
+    npy_double* r = realloc(branch->radius, capacity * sizeof(npy_double));
+    if (pts) branch->pts = pts;
+    if (c) branch->conf = c;
+    if (r) branch->radius = r;
+    if (!pts || !c || !r) return -1;
+    branch->capacity = capacity;
+  }
+  branch->pts[branch->n * 3] = pt[0];
+  branch->pts[branch->n * 3 + 1] = pt[1];
+  branch->pts[branch->n * 3 + 2] = pt[2];
+  branch->conf[branch->n] = conf;
+  branch->radius[branch->n] = radius;
+  branch->radius_sum += radius;
+  branch->n++;
+  return 0;
+}
+
+/* Keep only the first n points of the branch (R2Branch.slice(0, n)) */
+static void branch_truncate(R2Branch* branch, npy_intp n) {
+  npy_intp i;
+  branch->n = n;
+  branch->radius_sum = 0;
+  for (i = 0; i < n; i++) branch->radius_sum += branch->radius[i];
+}
+
+void branch_free(R2Branch* branch) {
+  free(branch->pts);
+  free(branch->conf);
+  free(branch->radius);
+  branch->pts = NULL;
+  branch->conf = NULL;
+  branch->radius = NULL;
+  branch->n = branch->capacity = 0;
+}
+
+static void branch_update_ma(R2Branch* branch, npy_double oc) {
+  npy_intp n = branch->n;
+  if (n > MA_LONG_WINDOW) {
+    if (branch->ma_short == -1) {
+      branch->ma_short = oc;
+    } else {
+      branch->ma_short = exponential_moving_average(
+          oc, branch->ma_short, n >= MA_SHORT_WINDOW ? MA_SHORT_WINDOW : n);
+    }
+    if (branch->ma_long == -1) {
+      branch->ma_long = oc;
+    } else {
+      branch->ma_long = exponential_moving_average(
+          oc, branch->ma_long, n >= MA_LONG_WINDOW ? MA_LONG_WINDOW : n);
+    }
+  }
+}
+
+/* R2Branch.update */
+static int branch_update(R2Branch* branch, const npy_double* pt, const npy_uint8* bimg,
+                         const npy_uint8* dilated, int* dims) {
+  const npy_double* head = branch->pts + (branch->n - 1) * 3;
+  npy_double velocity[3] = {pt[0] - head[0], pt[1] - head[1], pt[2] - head[2]};
+  npy_double b, oc;
+  npy_intp i, valleyidx;
+
+  branch->stepsz = norm3(velocity);
+  branch->branchlen += branch->stepsz;
+  b = dilated[voxel(pt, dims)] > 0;
+  if (b > 0) branch->gap += branch->stepsz;
+
+  branch->online_voxsum += b;
+  oc = branch->online_voxsum / (branch->n + 1);
+  branch_update_ma(branch, oc);
+
+  /* We are stepping in a valley */
+  if (branch->ma_short < branch->ma_long - BRANCH_EPS && oc < 0.5 && !branch->in_valley) {
+    branch->in_valley = true;
+  }
+
+  /* Cut at the valley */
+  if (branch->in_valley && branch->ma_short > branch->ma_long) {
+    valleyidx = 0;
+    for (i = 1; i < branch->n; i++) {
+      if (branch->conf[i] < branch->conf[valleyidx]) valleyidx = i;
+    }
+    /* Only cut if the valley confidence is below 0.5 */
+    if (branch->conf[valleyidx] < 0.5) {
+      branch_truncate(branch, valleyidx);
+      branch->low_conf = true;
+    }
+  }
+
+  if (oc <= 0.2) branch->low_conf = true;
+
+  if (branch->touched) branch->steps_after_reach++;
+
+  return branch_add(branch, pt, oc, estimate_radius(pt, bimg, dims));
+}
+
+static bool branch_is_stucked(R2Branch* branch) {
+  npy_double d[3];
+  const npy_double *a, *b;
+  if (branch->stepsz == 0) return true;
+  if (branch->n > 15) {
+    a = branch->pts + (branch->n - 1) * 3;
+    b = branch->pts + (branch->n - 15) * 3;
+    d[0] = a[0] - b[0];
+    d[1] = a[1] - b[1];
+    d[2] = a[2] - b[2];
+    return norm3(d) < 1;
+  }
+  return false;
+}
+
+static int grid_cell(npy_double p, int s) {
+  npy_intp c = (npy_intp) floor(p / GRID_CELL);
+  return (int) (c < 0 ? 0 : c >= s ? s - 1 : c);
+}
+
+void node_grid_free(R2NodeGrid* grid) {
+  free(grid->head);
+  free(grid->next);
+  grid->head = NULL;
+  grid->next = NULL;
+  grid->n = grid->capacity = 0;
+}
+
+/* Bin the nodes appended to swc since the last call. The grid starts over */
+/* when swc shrank or the volume changed */
+static int node_grid_sync(R2NodeGrid* grid, const npy_double* swc, npy_intp nswc, int dims[3]) {
+  npy_intp i, ncells;
+  int d, c[3];
+  if (grid->head && (nswc < grid->n || dims[0] != grid->vdims[0] || dims[1] != grid->vdims[1] ||
+                     dims[2] != grid->vdims[2])) {
+    node_grid_free(grid);
+  }
+  if (!grid->head) {
+    for (d = 0; d < 3; d++) {
+      grid->vdims[d] = dims[d];
+      grid->dims[d] = max((dims[d] + GRID_CELL - 1) / GRID_CELL, 1);
+    }
+    ncells = (npy_intp) grid->dims[0] * grid->dims[1] * grid->dims[2];
+    if (!(grid->head = malloc(ncells * sizeof(npy_intp)))) return -1;
+    for (i = 0; i < ncells; i++) grid->head[i] = -1;
+  }
+  if (nswc > grid->capacity) {
+    npy_intp capacity = max(nswc, grid->capacity * 2);
+    npy_intp* next = realloc(grid->next, capacity * sizeof(npy_intp));
+    if (!next) return -1;
+    grid->next = next;
+    grid->capacity = capacity;
+  }
+  for (i = grid->n; i < nswc; i++) {
+    npy_intp cell;
+    for (d = 0; d < 3; d++) {
+      c[d] = grid_cell(swc[i * 8 + 2 + d], grid->dims[d]);
+      if (i == 0 || c[d] < grid->lower[d]) grid->lower[d] = c[d];
+      if (i == 0 || c[d] > grid->upper[d]) grid->upper[d] = c[d];
+    }
+    cell = ((npy_intp) c[0] * grid->dims[1] + c[1]) * grid->dims[2] + c[2];
+    grid->next[i] = grid->head[cell];
+    grid->head[cell] = i;
+  }
+  grid->n = nswc;
+  return 0;
+}
+
+/* Closest swc node to pos, covered by either of the radii (SWC.match). */
+/* The cells are visited in rings of growing Chebyshev distance around the */
+/* cell of pos. Nodes beyond ring r are more than (r - 1) cells away, so */
+/* the search stops once the closest node found is nearer than that. Ties */
+/* go to the lowest index, as a full scan would */
+static bool swc_match(const R2NodeGrid* grid, const npy_double* swc, const npy_double* pos,
+                      npy_double radius, npy_intp* minidx) {
+  npy_intp i, j, k, idx;
+  npy_double d, mindist = INFINITY;
+  int e, r, rmax = 0, c[3];
+  *minidx = -2;
+  if (grid->n == 0) return false;
+  for (e = 0; e < 3; e++) {
+    c[e] = grid_cell(pos[e], grid->dims[e]);
+    rmax = max(rmax, max(c[e] - grid->lower[e], grid->upper[e] - c[e]));
+  }
+
+  for (r = 0; r <= rmax && !(mindist < (r - 1) * (npy_double) GRID_CELL); r++) {
+    for (i = max(c[0] - r, grid->lower[0]); i <= min(c[0] + r, grid->upper[0]); i++) {
+      for (j = max(c[1] - r, grid->lower[1]); j <= min(c[1] + r, grid->upper[1]); j++) {
+        /* Only the shell of the ring, the inside was visited before */
+        bool shell = i == c[0] - r || i == c[0] + r || j == c[1] - r || j == c[1] + r;
+        npy_intp kstep = shell || r == 0 ? 1 : 2 * r;
+        for (k = c[2] - r; k <= c[2] + r; k += kstep) {
+          if (k < grid->lower[2] || k > grid->upper[2]) continue;
+          for (idx = grid->head[(i * grid->dims[1] + j) * grid->dims[2] + k]; idx >= 0;
+               idx = grid->next[idx]) {
+            const npy_double* node = swc + idx * 8;
+            npy_double dx = pos[0] - node[2], dy = pos[1] - node[3], dz = pos[2] - node[4];
+            d = sqrt(dx * dx + dy * dy + dz * dz);
+            if (d < mindist || (d == mindist && idx < *minidx)) {
+              mindist = d;
+              *minidx = idx;
+            }
+          }
+        }
+      }
+    }
+  }
+  if (*minidx < 0) return false;
+  return radius > mindist || swc[*minidx * 8 + 5] > mindist;
+}
+
+int backtrack_branch(const npy_double* srcpt, const npy_float* grad, const npy_uint8* bimg,
+                     const npy_uint8* dilated, const void* tt, bool ttsingle, int dims[3],
+                     const npy_double* swc, npy_intp nswc, R2NodeGrid* grid,
+                     npy_double soma_radius, bool non_stop, R2Branch* branch, bool* keep) {
+  npy_double p[3], tt_head;
+  const npy_double* head;
+  npy_intp matched_idx;
+
+  *keep = true;
+  if (branch_add(branch, srcpt, 1., 1.)) return -1;
+
+  /* Loop for 1 back-tracking iteration */
+  while (true) {
+    rk4(grad, dims, branch->pts + (branch->n - 1) * 3, 1, p);
+    if (branch_update(branch, p, bimg, dilated, dims)) return -1;
+    head = branch->pts + (branch->n - 1) * 3;
+    tt_head = time_at(tt, ttsingle, voxel(head, dims));
+
+    /* 1. Check out of bound */
+    if (!inbound(head, dims)) {
+      branch_truncate(branch, branch->n - 1);
+      return STOP_OUT_OF_BOUND;
+    }
+
+    /* 2. Check for the large gap criterion */
+    if (branch->gap > branch->radius_sum / branch->n * 8 && !non_stop) {
+      return STOP_GAP;
+    } else {
+      branch->gap = 0;
+    }
+
+    /* 3. Check if Soma has been reached */
+    if (tt_head == -3) {
+      *keep = branch->branchlen > soma_radius * 3;
+      branch->reached_soma = true;
+      return STOP_SOMA;
+    }
+
+    /* 4. Check if not moved for 15 iterations */
+    if (branch_is_stucked(branch)) return STOP_STUCK;
+
+    /* 5. Check for low online confidence */
+    if (branch->low_conf && !non_stop) {
+      *keep = false;
+      return STOP_LOW_CONF;
+    }
+
+    /* 6. Check for branch merge */
+    if (tt_head == -1) {
+      branch->touched = true;
+      if (nswc == 1) return STOP_TOUCHED;
+
+      if (node_grid_sync(grid, swc, nswc, dims)) return -1;
+      if (swc_match(grid, swc, head, branch->radius[branch->n - 1], &matched_idx)) {
+        branch->touch_idx = matched_idx;
+        return STOP_MERGED;
+      }
+
+      if (branch->steps_after_reach > MAX_STEPS_AFTER_REACH) return STOP_TOUCHED;
+    }
+  }
+}
+
+/* Steepest descent direction of every voxel of the timemap t towards its */
+/* 26 neighbours (R2Tracer._dist_gradient). Of the neighbours lower than the */
+/* voxel, the lowest one wins, ties going to the first in the scan order */
+/* below. Voxels outside the image read as tpad. Voxels outside mask (if */
+/* given) and voxels without a lower neighbour get a zero vector. */
+/* t and mask are read through their strides (in elements), so Fortran */
+/* ordered timemaps need no copy. The result is written to the C-ordered, */
+/* interleaved X x Y x Z x 3 field out. */
+void descent_field(const void* t, bool tsingle, const npy_intp tstrides[3], const npy_uint8* mask,
+                   const npy_intp mstrides[3], int dims[3], npy_double tpad, npy_float* out) {
+  static const int ne[26][3] = {
+      {-1, -1, -1}, {-1, -1, 0}, {-1, -1, 1}, {-1, 0, -1}, {-1, 0, 0}, {-1, 0, 1}, {-1, 1, -1},
+      {-1, 1, 0},   {-1, 1, 1},  {0, -1, -1}, {0, -1, 0},  {0, -1, 1}, {0, 0, -1}, {0, 0, 1},
+      {0, 1, -1},   {0, 1, 0},   {0, 1, 1},   {1, -1, -1}, {1, -1, 0}, {1, -1, 1}, {1, 0, -1},
+      {1, 0, 0},    {1, 0, 1},   {1, 1, -1},  {1, 1, 0},   {1, 1, 1}};
+  npy_float dir[26][3];
+  npy_intp i, j, k, idx;
+  int n, e;
+
+  for (n = 0; n < 26; n++) {
+    npy_double len = sqrt((npy_double) (ne[n][0] * ne[n][0] + ne[n][1] * ne[n][1] +
+                                        ne[n][2] * ne[n][2]));
+    for (e = 0; e < 3; e++) dir[n][e] = (npy_float) (-ne[n][e] / len);
+  }
+
+  for (i = 0; i < dims[0]; i++) {
+    for (j = 0; j < dims[1]; j++) {
+      for (k = 0; k < dims[2]; k++) {
+        npy_double best, v;
+        int bn = -1;
+        idx = (i * dims[1] + j) * dims[2] + k;
+        if (mask && !mask[i * mstrides[0] + j * mstrides[1] + k * mstrides[2]]) {
+          out[idx * 3] = out[idx * 3 + 1] = out[idx * 3 + 2] = 0;
+          continue;
+        }
+
+        best = time_at(t, tsingle, i * tstrides[0] + j * tstrides[1] + k * tstrides[2]);
+        for (n = 0; n < 26; n++) {
+          npy_intp ni = i + ne[n][0], nj = j + ne[n][1], nk = k + ne[n][2];
+          if (ni < 0 || nj < 0 || nk < 0 || ni >= dims[0] || nj >= dims[1] || nk >= dims[2]) {
+            v = tpad;
+          } else {
+            v = time_at(t, tsingle, ni * tstrides[0] + nj * tstrides[1] + nk * tstrides[2]);
+          }
+          if (v < best) {
+            best = v;
+            bn = n;
+          }
+        }
+
+        for (e = 0; e < 3; e++) out[idx * 3 + e] = bn >= 0 ? dir[bn][e] : 0;
+      }
+    }
+  }
+}
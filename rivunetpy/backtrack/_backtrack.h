@@ -0,0 +1,84 @@
+#include "Python.h"
+#include "numpy/arrayobject.h"
+#include <stdbool.h>
+
+#ifndef _BACKTRACK
+#define _BACKTRACK
+
+/* Reasons for one back-tracking iteration to stop. */
+/* Keep in sync with the STOP_* constants in rivunetpy/trace.py */
+#define STOP_OUT_OF_BOUND 1
+#define STOP_GAP 2
+#define STOP_SOMA 3
+#define STOP_STUCK 4
+#define STOP_LOW_CONF 5
+#define STOP_MERGED 6
+#define STOP_TOUCHED 7
+
+/* The state of one branch while it is being back-tracked. */
+/* Mirrors R2Branch in rivunetpy/trace.py */
+typedef struct {
+  npy_double* pts;     /* n x 3 */
+  npy_double* conf;    /* n */
+  npy_double* radius;  /* n */
+  npy_intp n;
+  npy_intp capacity;
+  npy_double radius_sum;
+
+  int steps_after_reach;
+  bool low_conf;
+  npy_intp touch_idx;
+  bool reached_soma;
+  bool touched;
+  bool in_valley;
+  npy_double branchlen;
+  npy_double gap;
+  npy_double online_voxsum;
+  npy_double stepsz;
+  npy_double ma_short;
+  npy_double ma_long;
+} R2Branch;
+
+void branch_free(R2Branch* branch);
+
+/* Uniform grid over the positions of the swc nodes, for the closest node */
+/* queries of the branch merge check. It follows one swc that only grows: */
+/* the nodes appended since the last query are binned on the next one */
+typedef struct {
+  int vdims[3];       /* The size of the volume */
+  int dims[3];        /* The number of cells along each axis */
+  int lower[3];       /* The bounding box of the occupied cells */
+  int upper[3];
+  npy_intp* head;     /* The last node binned in each cell, -1 for none */
+  npy_intp* next;     /* The node binned before each node in its cell */
+  npy_intp n;         /* The number of nodes binned */
+  npy_intp capacity;
+} R2NodeGrid;
+
+void node_grid_free(R2NodeGrid* grid);
+
+int backtrack_branch(const npy_double* srcpt,   // The source point (3,)
+                     const npy_float* grad,     // Interleaved gradient field X x Y x Z x 3
+                     const npy_uint8* bimg,     // The binary image
+                     const npy_uint8* dilated,  // The dilated binary image
+                     const void* tt,            // The erased copy of the timemap
+                     bool ttsingle,             // Whether tt holds float32 values
+                     int dims[3],               // The size of the volumes
+                     const npy_double* swc,     // The swc traced so far N x 8
+                     npy_intp nswc,             // The number of swc nodes
+                     R2NodeGrid* grid,          // The grid over the swc nodes
+                     npy_double soma_radius,
+                     bool non_stop,
+                     R2Branch* branch,          // The output branch
+                     bool* keep);               // Whether the branch should be kept
+
+void descent_field(const void* t,            // The timemap
+                   bool tsingle,             // Whether t holds float32 values
+                   const npy_intp tstrides[3],  // Its strides in elements
+                   const npy_uint8* mask,    // Voxels to compute, NULL for all
+                   const npy_intp mstrides[3],  // Its strides in elements
+                   int dims[3],              // The size of the timemap
+                   npy_double tpad,          // The value read outside the image
+                   npy_float* out);          // The output field X x Y x Z x 3
+
+#endif
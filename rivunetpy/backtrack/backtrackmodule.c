@@ -0,0 +1,273 @@
+#include <Python.h>
+#include "_backtrack.h"
+#include "numpy/arrayobject.h"
+
+/* R2BACKTRACK.BRANCH back-tracks a single branch of Rivulet2 natively. */
+/* */
+/*pts, radius, conf, reason, keep, low_conf, reached_soma, touch_idx = */
+/*    branch(srcpt, grad, bimg, dilated_bimg, tt, swc, soma_radius, non_stop, grid=None) */
+/* */
+/*inputs, */
+/*   srcpt: The source point (3,) */
+/*   grad: The interleaved float32 gradient field X x Y x Z x 3 */
+/*          (GradientField.field) */
+/*   bimg, dilated_bimg: The binary image and its dilation, */
+/*          uint8 or bool X x Y x Z */
+/*   tt: The erased copy of the timemap, float32 or float64 X x Y x Z */
+/*   swc: The swc traced so far, N x 8 */
+/*   soma_radius: The radius of the soma */
+/*   non_stop: Boolean Set to true to ignore the gap and online */
+/*          confidence stopping criteria */
+/*   grid: The node_grid() of swc, kept across the branches of one swc so */
+/*          only the nodes appended since the last branch are binned. A */
+/*          grid of its own is built when None */
+/*outputs, */
+/*   pts, radius, conf: The traced branch, (M x 3), (M,), (M,) */
+/*   reason: One of the STOP_* codes in _backtrack.h */
+/*   keep, low_conf, reached_soma, touch_idx: The final state of the branch */
+/* */
+/* All arrays are expected to be C-contiguous with the exact dtypes above, */
+/* so nothing is copied per branch. */
+
+static PyArrayObject* as_c_array(PyObject* obj, int typenum, int ndim, const char* name) {
+  PyArrayObject* arr;
+  if (typenum >= 0) {
+    arr = (PyArrayObject*) PyArray_FROM_OTF(obj, typenum, NPY_ARRAY_IN_ARRAY);
+  } else {  // Any one-byte mask
+    arr = (PyArrayObject*) PyArray_FROM_OF(obj, NPY_ARRAY_IN_ARRAY);
+    if (arr && PyArray_ITEMSIZE(arr) != 1) {
+      PyErr_Format(PyExc_TypeError, "%s should be a uint8 or bool array", name);
+      Py_DECREF(arr);
+      return NULL;
+    }
+  }
+  if (arr && PyArray_NDIM(arr) != ndim) {
+    PyErr_Format(PyExc_ValueError, "%s should have %d dimensions", name, ndim);
+    Py_DECREF(arr);
+    return NULL;
+  }
+  return arr;
+}
+
+/* float32 and float64 timemaps are used as they are, anything else is */
+/* converted to float64 */
+static PyArrayObject* as_timemap(PyObject* obj, int requirements) {
+  PyArrayObject* arr = (PyArrayObject*) PyArray_FROM_OF(obj, requirements);
+  if (arr && PyArray_TYPE(arr) != NPY_FLOAT && PyArray_TYPE(arr) != NPY_DOUBLE) {
+    Py_SETREF(arr, (PyArrayObject*) PyArray_FROM_OTF((PyObject*) arr, NPY_DOUBLE, requirements));
+  }
+  return arr;
+}
+
+static PyObject* to_numpy(npy_double* data, npy_intp n, npy_intp width) {
+  npy_intp dims[2] = {n, width};
+  PyObject* arr = PyArray_SimpleNew(width > 1 ? 2 : 1, dims, NPY_DOUBLE);
+  if (arr && n > 0) memcpy(PyArray_DATA((PyArrayObject*) arr), data, n * width * sizeof(npy_double));
+  return arr;
+}
+
+#define NODE_GRID_NAME "r2backtrack.node_grid"
+
+static void node_grid_destroy(PyObject* capsule) {
+  R2NodeGrid* grid = PyCapsule_GetPointer(capsule, NODE_GRID_NAME);
+  node_grid_free(grid);
+  free(grid);
+}
+
+/* R2BACKTRACK.NODE_GRID makes an empty grid over the nodes of a swc for */
+/* branch to keep up to date. */
+/* */
+/*grid = node_grid() */
+
+static PyObject* r2backtrack_node_grid(PyObject* self, PyObject* args) {
+  PyObject* capsule;
+  R2NodeGrid* grid = calloc(1, sizeof(R2NodeGrid));
+  if (!grid) return PyErr_NoMemory();
+  if (!(capsule = PyCapsule_New(grid, NODE_GRID_NAME, node_grid_destroy))) free(grid);
+  return capsule;
+}
+
+static PyObject* r2backtrack_branch(PyObject* self, PyObject* args) {
+  PyObject *srcobj, *gradobj, *bobj, *dobj, *ttobj, *swcobj, *gridobj = Py_None;
+  PyArrayObject *srcarr = NULL, *gradarr = NULL, *barr = NULL, *darr = NULL, *ttarr = NULL,
+                *swcarr = NULL;
+  PyObject *pts = NULL, *radius = NULL, *conf = NULL, *result = NULL;
+  double soma_radius;
+  int non_stop, reason, d;
+  bool keep;
+  npy_intp* gdims;
+  int dims[3];
+  R2Branch branch = {0};
+  R2NodeGrid own_grid = {0}, *grid = &own_grid;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOdp|O", &srcobj, &gradobj, &bobj, &dobj, &ttobj, &swcobj,
+                        &soma_radius, &non_stop, &gridobj))
+    return NULL;
+  if (gridobj != Py_None && !(grid = PyCapsule_GetPointer(gridobj, NODE_GRID_NAME))) return NULL;
+
+  if (!(srcarr = as_c_array(srcobj, NPY_DOUBLE, 1, "srcpt"))) goto fail;
+  if (!(gradarr = as_c_array(gradobj, NPY_FLOAT, 4, "grad"))) goto fail;
+  if (!(barr = as_c_array(bobj, -1, 3, "bimg"))) goto fail;
+  if (!(darr = as_c_array(dobj, -1, 3, "dilated_bimg"))) goto fail;
+  if (!(ttarr = as_timemap(ttobj, NPY_ARRAY_IN_ARRAY))) goto fail;
+  if (!(swcarr = as_c_array(swcobj, NPY_DOUBLE, 2, "swc"))) goto fail;
+
+  gdims = PyArray_DIMS(gradarr);
+  if (PyArray_NDIM(ttarr) != 3) {
+    PyErr_SetString(PyExc_ValueError, "tt should have 3 dimensions");
+    goto fail;
+  }
+  for (d = 0; d < 3; d++) {
+    dims[d] = (int) gdims[d];
+    if (PyArray_DIMS(barr)[d] != gdims[d] || PyArray_DIMS(darr)[d] != gdims[d] ||
+        PyArray_DIMS(ttarr)[d] != gdims[d]) {
+      PyErr_SetString(PyExc_ValueError, "grad, bimg, dilated_bimg and tt should share the same shape");
+      goto fail;
+    }
+  }
+  if (gdims[3] != 3 || PyArray_SIZE(srcarr) != 3 || PyArray_DIMS(swcarr)[1] != 8) {
+    PyErr_SetString(PyExc_ValueError, "Expected srcpt (3,), grad X x Y x Z x 3 and swc N x 8");
+    goto fail;
+  }
+
+  branch.touch_idx = -2;
+  branch.ma_short = -1;
+  branch.ma_long = -1;
+
+  reason = backtrack_branch((npy_double*) PyArray_DATA(srcarr), (npy_float*) PyArray_DATA(gradarr),
+                            (npy_uint8*) PyArray_DATA(barr), (npy_uint8*) PyArray_DATA(darr),
+                            PyArray_DATA(ttarr), PyArray_TYPE(ttarr) == NPY_FLOAT, dims,
+                            (npy_double*) PyArray_DATA(swcarr), PyArray_DIMS(swcarr)[0], grid,
+                            soma_radius, non_stop, &branch, &keep);
+  if (reason < 0) {
+    PyErr_NoMemory();
+    goto fail;
+  }
+
+  pts = to_numpy(branch.pts, branch.n, 3);
+  radius = to_numpy(branch.radius, branch.n, 1);
+  conf = to_numpy(branch.conf, branch.n, 1);
+  if (pts && radius && conf) {
+    result = Py_BuildValue("NNNiNNNn", pts, radius, conf, reason, PyBool_FromLong(keep),
+                           PyBool_FromLong(branch.low_conf), PyBool_FromLong(branch.reached_soma),
+                           branch.touch_idx);
+    pts = radius = conf = NULL;  // References were stolen
+  }
+
+fail:
+  Py_XDECREF(pts);
+  Py_XDECREF(radius);
+  Py_XDECREF(conf);
+  Py_XDECREF(srcarr);
+  Py_XDECREF(gradarr);
+  Py_XDECREF(barr);
+  Py_XDECREF(darr);
+  Py_XDECREF(ttarr);
+  Py_XDECREF(swcarr);
+  branch_free(&branch);
+  node_grid_free(&own_grid);
+  return result;
+}
+
+/* R2BACKTRACK.DESCENT computes the steepest descent direction of each */
+/* voxel of a timemap towards its 26 neighbours. */
+/* */
+/*field = descent(t, mask, tpad, out=None) */
+/* */
+/*inputs, */
+/*   t: The float32 or float64 timemap X x Y x Z, in any memory order */
+/*   mask: uint8 or bool X x Y x Z, voxels to compute, or None for all */
+/*   tpad: The time read outside the image */
+/*   out: A C-contiguous float32 X x Y x Z x 3 array to write the field */
+/*          into, e.g. a memory-mapped one. A new array when None */
+/*outputs, */
+/*   field: float32 X x Y x Z x 3, the unit vector towards the lowest */
+/*          lower neighbour, zero where there is none */
+
+static PyObject* r2backtrack_descent(PyObject* self, PyObject* args) {
+  PyObject *tobj, *mobj, *outobj = Py_None;
+  PyArrayObject *tarr = NULL, *marr = NULL;
+  PyObject* field = NULL;
+  double tpad;
+  npy_intp fdims[4], tstrides[3], mstrides[3] = {0, 0, 0};
+  int dims[3], d;
+
+  if (!PyArg_ParseTuple(args, "OOd|O", &tobj, &mobj, &tpad, &outobj)) return NULL;
+
+  if (!(tarr = as_timemap(tobj, NPY_ARRAY_ALIGNED))) goto fail;
+  if (PyArray_NDIM(tarr) != 3) {
+    PyErr_SetString(PyExc_ValueError, "t should have 3 dimensions");
+    goto fail;
+  }
+  for (d = 0; d < 3; d++) {
+    fdims[d] = PyArray_DIMS(tarr)[d];
+    dims[d] = (int) fdims[d];
+    tstrides[d] = PyArray_STRIDES(tarr)[d] / PyArray_ITEMSIZE(tarr);
+  }
+  fdims[3] = 3;
+
+  if (mobj != Py_None) {
+    marr = (PyArrayObject*) PyArray_FROM_OF(mobj, NPY_ARRAY_ALIGNED);
+    if (!marr) goto fail;
+    if (PyArray_ITEMSIZE(marr) != 1 || PyArray_NDIM(marr) != 3) {
+      PyErr_SetString(PyExc_TypeError, "mask should be a 3D uint8 or bool array");
+      goto fail;
+    }
+    for (d = 0; d < 3; d++) {
+      if (PyArray_DIMS(marr)[d] != fdims[d]) {
+        PyErr_SetString(PyExc_ValueError, "mask and t should share the same shape");
+        goto fail;
+      }
+      mstrides[d] = PyArray_STRIDES(marr)[d];
+    }
+  }
+
+  if (outobj != Py_None) {
+    if (!PyArray_Check(outobj) || PyArray_TYPE((PyArrayObject*) outobj) != NPY_FLOAT ||
+        !PyArray_IS_C_CONTIGUOUS((PyArrayObject*) outobj) ||
+        !PyArray_ISWRITEABLE((PyArrayObject*) outobj) || PyArray_NDIM((PyArrayObject*) outobj) != 4 ||
+        !PyArray_CompareLists(PyArray_DIMS((PyArrayObject*) outobj), fdims, 4)) {
+      PyErr_SetString(PyExc_ValueError, "out should be a writeable C-contiguous float32 X x Y x Z x 3 array");
+      goto fail;
+    }
+    Py_INCREF(outobj);
+    field = outobj;
+  } else if (!(field = PyArray_SimpleNew(4, fdims, NPY_FLOAT))) {
+    goto fail;
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  descent_field(PyArray_DATA(tarr), PyArray_TYPE(tarr) == NPY_FLOAT, tstrides,
+                marr ? (npy_uint8*) PyArray_DATA(marr) : NULL, mstrides, dims, tpad,
+                (npy_float*) PyArray_DATA((PyArrayObject*) field));
+  Py_END_ALLOW_THREADS
+
+fail:
+  Py_XDECREF(tarr);
+  Py_XDECREF(marr);
+  return field;
+}
+
+static PyMethodDef r2backtrack_methods[] = {
+    {"branch", (PyCFunction)r2backtrack_branch, METH_VARARGS,
+     "Back-track one Rivulet2 branch from a source point."},
+    {"node_grid", (PyCFunction)r2backtrack_node_grid, METH_NOARGS,
+     "An empty grid over the nodes of a swc for branch to keep up to date."},
+    {"descent", (PyCFunction)r2backtrack_descent, METH_VARARGS,
+     "Steepest descent directions of a timemap towards its 26 neighbours."},
+    {NULL, NULL, 0, NULL}};
+
+// Module definition
+static struct PyModuleDef r2backtrack_definition = {
+    PyModuleDef_HEAD_INIT, "r2backtrack",
+    "A python module that runs the Rivulet2 back-tracking natively", -1, r2backtrack_methods};
+
+// Module initialization
+PyMODINIT_FUNC PyInit_r2backtrack(void) {
+  PyObject* m;
+  m = PyModule_Create(&r2backtrack_definition);
+  if (m == NULL) return NULL;
+
+  import_array();
+  return m;
+}
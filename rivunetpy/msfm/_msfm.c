@@ -2,6 +2,7 @@
 #include <math.h>
 #include "_msfm.h"
 #include "common.c"
+#include "heap.c"
 
 
 npy_double second_derivative(npy_double Txm1, npy_double Txm2, npy_double Txp1, npy_double Txp2) {
@@ -20,7 +21,7 @@ npy_double second_derivative(npy_double Txm1, npy_double Txm2, npy_double Txp1,
   return Tm;
 }
 
-npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, int j, int k,
+npy_double CalculateDistance(npy_double* T, npy_double Fijk, npy_intp* dims, int i, int j, int k,
                          int usesecond, int usecross, bool* Frozen) {
   /* Loop variables */
   int q, t;
@@ -94,7 +95,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
   jn = j + 0;
   kn = k + 0;
   if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-    Txm1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+    Txm1 = T[vindex3(in, jn, kn, dims)];
   } else {
     Txm1 = INF;
   }
@@ -102,7 +103,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
   jn = j + 0;
   kn = k + 0;
   if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-    Txp1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+    Txp1 = T[vindex3(in, jn, kn, dims)];
   } else {
     Txp1 = INF;
   }
@@ -110,7 +111,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
   jn = j - 1;
   kn = k + 0;
   if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-    Tym1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+    Tym1 = T[vindex3(in, jn, kn, dims)];
   } else {
     Tym1 = INF;
   }
@@ -118,7 +119,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
   jn = j + 1;
   kn = k + 0;
   if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-    Typ1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+    Typ1 = T[vindex3(in, jn, kn, dims)];
   } else {
     Typ1 = INF;
   }
@@ -126,7 +127,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
   jn = j + 0;
   kn = k - 1;
   if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-    Tzm1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+    Tzm1 = T[vindex3(in, jn, kn, dims)];
   } else {
     Tzm1 = INF;
   }
@@ -134,7 +135,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
   jn = j + 0;
   kn = k + 1;
   if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-    Tzp1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+    Tzp1 = T[vindex3(in, jn, kn, dims)];
   } else {
     Tzp1 = INF;
   }
@@ -146,7 +147,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j - 1;
     kn = k - 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr2t2m1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr2t2m1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr2t2m1 = INF;
     }
@@ -154,7 +155,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 1;
     kn = k + 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr2t2p1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr2t2p1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr2t2p1 = INF;
     }
@@ -162,7 +163,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j - 1;
     kn = k + 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr2t3m1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr2t3m1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr2t3m1 = INF;
     }
@@ -171,7 +172,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     kn = k - 1;
 
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr2t3p1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr2t3p1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr2t3p1 = INF;
     }
@@ -181,7 +182,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 0;
     kn = k + 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr3t2m1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr3t2m1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr3t2m1 = INF;
     }
@@ -190,7 +191,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     kn = k - 1;
 
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr3t2p1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr3t2p1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr3t2p1 = INF;
     }
@@ -200,7 +201,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     kn = k - 1;
 
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr3t3m1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr3t3m1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr3t3m1 = INF;
     }
@@ -210,7 +211,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     kn = k + 1;
 
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr3t3p1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr3t3p1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr3t3p1 = INF;
     }
@@ -221,7 +222,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j - 1;
     kn = k - 0;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr4t2m1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr4t2m1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr4t2m1 = INF;
     }
@@ -229,7 +230,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 1;
     kn = k + 0;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr4t2p1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr4t2p1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr4t2p1 = INF;
     }
@@ -237,7 +238,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 1;
     kn = k - 0;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr4t3m1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr4t3m1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr4t3m1 = INF;
     }
@@ -245,7 +246,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j - 1;
     kn = k + 0;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr4t3p1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr4t3p1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr4t3p1 = INF;
     }
@@ -255,7 +256,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j - 1;
     kn = k + 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr5t2m1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr5t2m1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr5t2m1 = INF;
     }
@@ -263,7 +264,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 1;
     kn = k - 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr5t2p1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr5t2p1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr5t2p1 = INF;
     }
@@ -271,7 +272,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 1;
     kn = k + 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr5t3m1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr5t3m1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr5t3m1 = INF;
     }
@@ -279,7 +280,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j - 1;
     kn = k - 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr5t3p1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr5t3p1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr5t3p1 = INF;
     }
@@ -289,7 +290,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j - 1;
     kn = k - 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr6t2m1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr6t2m1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr6t2m1 = INF;
     }
@@ -297,7 +298,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 1;
     kn = k + 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr6t2p1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr6t2p1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr6t2p1 = INF;
     }
@@ -305,7 +306,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 1;
     kn = k - 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr6t3m1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr6t3m1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr6t3m1 = INF;
     }
@@ -313,7 +314,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j - 1;
     kn = k + 1;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tr6t3p1 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tr6t3p1 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tr6t3p1 = INF;
     }
@@ -429,7 +430,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 0;
     kn = k + 0;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Txm2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Txm2 = T[vindex3(in, jn, kn, dims)];
     } else {
       Txm2 = INF;
     }
@@ -437,7 +438,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 0;
     kn = k + 0;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Txp2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Txp2 = T[vindex3(in, jn, kn, dims)];
     } else {
       Txp2 = INF;
     }
@@ -445,7 +446,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j - 2;
     kn = k + 0;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tym2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tym2 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tym2 = INF;
     }
@@ -453,7 +454,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 2;
     kn = k + 0;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Typ2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Typ2 = T[vindex3(in, jn, kn, dims)];
     } else {
       Typ2 = INF;
     }
@@ -461,7 +462,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 0;
     kn = k - 2;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tzm2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tzm2 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tzm2 = INF;
     }
@@ -469,7 +470,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
     jn = j + 0;
     kn = k + 2;
     if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-      Tzp2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+      Tzp2 = T[vindex3(in, jn, kn, dims)];
     } else {
       Tzp2 = INF;
     }
@@ -481,7 +482,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j - 2;
       kn = k - 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr2t2m2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr2t2m2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr2t2m2 = INF;
       }
@@ -489,7 +490,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j + 2;
       kn = k + 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr2t2p2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr2t2p2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr2t2p2 = INF;
       }
@@ -497,7 +498,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j - 2;
       kn = k + 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr2t3m2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr2t3m2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr2t3m2 = INF;
       }
@@ -505,7 +506,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j + 2;
       kn = k - 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr2t3p2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr2t3p2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr2t3p2 = INF;
       }
@@ -515,7 +516,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j + 0;
       kn = k + 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr3t2m2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr3t2m2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr3t2m2 = INF;
       }
@@ -523,7 +524,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j + 0;
       kn = k - 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr3t2p2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr3t2p2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr3t2p2 = INF;
       }
@@ -531,7 +532,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j - 0;
       kn = k - 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr3t3m2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr3t3m2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr3t3m2 = INF;
       }
@@ -539,7 +540,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j + 0;
       kn = k + 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr3t3p2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr3t3p2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr3t3p2 = INF;
       }
@@ -549,7 +550,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j - 2;
       kn = k - 0;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr4t2m2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr4t2m2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr4t2m2 = INF;
       }
@@ -557,7 +558,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j + 2;
       kn = k + 0;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr4t2p2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr4t2p2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr4t2p2 = INF;
       }
@@ -565,7 +566,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j + 2;
       kn = k - 0;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr4t3m2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr4t3m2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr4t3m2 = INF;
       }
@@ -573,7 +574,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j - 2;
       kn = k + 0;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr4t3p2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr4t3p2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr4t3p2 = INF;
       }
@@ -583,7 +584,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j - 2;
       kn = k + 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr5t2m2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr5t2m2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr5t2m2 = INF;
       }
@@ -591,7 +592,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j + 2;
       kn = k - 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr5t2p2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr5t2p2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr5t2p2 = INF;
       }
@@ -599,7 +600,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j + 2;
       kn = k + 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr5t3m2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr5t3m2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr5t3m2 = INF;
       }
@@ -607,7 +608,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j - 2;
       kn = k - 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr5t3p2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr5t3p2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr5t3p2 = INF;
       }
@@ -617,7 +618,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j - 2;
       kn = k - 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr6t2m2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr6t2m2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr6t2m2 = INF;
       }
@@ -625,7 +626,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j + 2;
       kn = k + 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr6t2p2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr6t2p2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr6t2p2 = INF;
       }
@@ -633,7 +634,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j + 2;
       kn = k - 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr6t3m2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr6t3m2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr6t3m2 = INF;
       }
@@ -641,7 +642,7 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
       jn = j - 2;
       kn = k + 2;
       if (isfrozen3d(in, jn, kn, dims, Frozen)) {
-        Tr6t3p2 = T[mindex3(in, jn, kn, dims[0], dims[1])];
+        Tr6t3p2 = T[vindex3(in, jn, kn, dims)];
       } else {
         Tr6t3p2 = INF;
       }
@@ -824,15 +825,27 @@ npy_double CalculateDistance(npy_double* T, npy_double Fijk, int* dims, int i, i
 }
 
 
-void msfm3d(npy_double *F,             // The input speed image
-            npy_int64 *B, // The segmentation
-            int dims[3],           // The size of the input speed image and the binary image
+/* Reads a float32 or float64 speed image */
+static __inline npy_double speed_at(const void *F, bool single, npy_intp index) {
+  return single ? (npy_double)((const npy_float *)F)[index] : ((const npy_double *)F)[index];
+}
+
+int msfm3d(const void *F,             // The input speed image
+            bool Fsingle,          // Whether F holds float32 instead of float64 values
+            const npy_uint8 *B, // The segmentation
+            const npy_uint8 *region, // Voxels the front may expand into, NULL for all
+            int size[3],           // The size of the input speed image and the binary image
+            npy_intp strides[3],   // The strides of F, B and T in elements
             npy_int64 *SourcePoints,  // The source points
             int dims_sp[2],        // The size of the source point array
             bool usesecond, 
             bool usecross,
+            bool useheap,   // Keep the narrow band in a binary heap instead of the min-tree list
+            msfm_progress progress,  // Called every progress_every frozen foreground voxels, or NULL
+            void *progress_data,     // Passed on to progress
+            npy_intp progress_every,
             npy_double *T,  // The output time crosing map
-            npy_double *Y)  // The output euclidean image
+            npy_double *Y)  // The output euclidean image (not filled by the heap)
 {
   /* Current distance values */
   npy_double Tt, Ty;
@@ -843,43 +856,55 @@ void msfm3d(npy_double *F,             // The input speed image
   /* Augmented Fast Marching (For skeletonize) */
   bool Ed = false;  // Skip the Y output for now
 
+  /* Sizes followed by strides, as expected by vindex3 */
+  npy_intp dims[6] = {size[0], size[1], size[2], strides[0], strides[1], strides[2]};
+
   /* Number of pixels in image */
-  long npixels = dims[0] * dims[1] * dims[2];
+  npy_intp npixels = (npy_intp)size[0] * size[1] * size[2];
 
   /* Neighbour list */
-  long neg_free;
-  long neg_pos;
+  npy_intp neg_free;
+  npy_intp neg_pos;
   npy_double* neg_listv;
   npy_double* neg_listx;
   npy_double* neg_listy;
   npy_double* neg_listz;
   npy_double* neg_listo;
 
-  int* listprop;
-  npy_double** listval;
+  int* listprop = NULL;
+  npy_double** listval = NULL;
+
+  /* Binary heap narrow band */
+  NarrowHeap heap = {0};
+  int xyz[3];
+  int status = 0;
 
   /* Neighbours 6x3 */
   int ne[18] = {-1, 0, 0, 1, 0, 0, 0, -1, 0, 0, 1, 0, 0, 0, -1, 0, 0, 1};
 
   /* Loop variables */
-  long s, w, itt, q;
+  npy_intp s, w, itt, q;
 
   /* Current location */
   int x, y, z, i, j, k;
 
   /* Index */
-  long IJK_index, XYZ_index, index;
+  npy_intp IJK_index, XYZ_index, index;
 
   /* Count how many voxels in foreground is foreground */
-  long nforeground = 0;
+  npy_intp nforeground = 0;
   for (q = 0; q < npixels; q++){
     if (B[q] > 0){
       nforeground ++;
     }
   }
+  npy_intp ntotal = nforeground;
 
   /* Pixels which are processed and have a final distance are frozen */
-  Frozen = (bool*)malloc(npixels * sizeof(int));
+  Frozen = (bool*)malloc(npixels * sizeof(bool));
+  if (!Frozen) {
+    return -1;
+  }
   for (q = 0; q < npixels; q++) {
     Frozen[q] = 0;
     T[q] = -1;
@@ -913,6 +938,11 @@ void msfm3d(npy_double *F,             // The input speed image
   initialize_list(listval, listprop);
   neg_listv = listval[listprop[1] - 1];
 
+  if (useheap && heap_init(&heap) < 0) {
+    status = -1;
+    goto cleanup;
+  }
+
   /*(There are 3 pixel classes: */
   /*  - frozen (processed) */
   /*  - narrow band (boundary) (in list to check for the next pixel with
@@ -926,7 +956,7 @@ void msfm3d(npy_double *F,             // The input speed image
     x = (int)SourcePoints[0 + s * 3] - 1;
     y = (int)SourcePoints[1 + s * 3] - 1;
     z = (int)SourcePoints[2 + s * 3] - 1;
-    XYZ_index = mindex3(x, y, z, dims[0], dims[1]);
+    XYZ_index = vindex3(x, y, z, dims);
 
     Frozen[XYZ_index] = 1;
     T[XYZ_index] = 0;
@@ -941,20 +971,31 @@ void msfm3d(npy_double *F,             // The input speed image
     y = (int)SourcePoints[1 + s * 3] - 1;
     z = (int)SourcePoints[2 + s * 3] - 1;
 
-    XYZ_index = mindex3(x, y, z, dims[0], dims[1]);
+    XYZ_index = vindex3(x, y, z, dims);
     for (w = 0; w < 6; w++) {
       /*Location of neighbour */
       i = x + ne[w];
       j = y + ne[w + 6];
       k = z + ne[w + 12];
 
-      IJK_index = mindex3(i, j, k, dims[0], dims[1]);
+      IJK_index = vindex3(i, j, k, dims);
 
       /*Check if current neighbour is not yet frozen and inside the */
 
       /*picture */
-      if (isntfrozen3d(i, j, k, dims, Frozen)) {
-        Tt = (1 / (max(F[IJK_index], eps)));
+      if (isntfrozen3d(i, j, k, dims, Frozen) && (!region || region[IJK_index])) {
+        Tt = (1 / (max(speed_at(F, Fsingle, IJK_index), eps)));
+        if (useheap) {
+          if (T[IJK_index] > -1) {
+            if (heap.key[(npy_intp)T[IJK_index]] > Tt) {
+              heap_decrease(&heap, (npy_intp)T[IJK_index], Tt, T, dims);
+            }
+          } else if (heap_push(&heap, Tt, i, j, k, T, dims) < 0) {
+            status = -1;
+            goto cleanup;
+          }
+          continue;
+        }
         /*Update distance in neigbour list or add to neigbour list */
         if (T[IJK_index] > 0) {
           if (neg_listv[(int)T[IJK_index]] > Tt) {
@@ -988,48 +1029,73 @@ void msfm3d(npy_double *F,             // The input speed image
   for (itt = 0; itt < (npixels); itt++) /* */ {
     /*Get the pixel from narrow list (boundary list) with smallest */
     /*distance value and set it to current pixel location */
-    index = list_minimum(listval, listprop);
-    neg_listv = listval[listprop[1] - 1];
-    /* Stop if pixel distance is infinite (all pixels are processed) */
-    if (IsInf(neg_listv[index])) {
-      break;
-    }
+    if (useheap) {
+      if (heap.n == 0 || IsInf(heap.key[0])) {
+        break;
+      }
+      heap_pop(&heap, &Tt, xyz, T, dims);
+      x = xyz[0];
+      y = xyz[1];
+      z = xyz[2];
+    } else {
+      index = list_minimum(listval, listprop);
+      neg_listv = listval[listprop[1] - 1];
+      /* Stop if pixel distance is infinite (all pixels are processed) */
+      if (IsInf(neg_listv[index])) {
+        break;
+      }
 
-    /*index=minarray(neg_listv, neg_pos); */
-    x = (int)neg_listx[index];
-    y = (int)neg_listy[index];
-    z = (int)neg_listz[index];
-    XYZ_index = mindex3(x, y, z, dims[0], dims[1]);
+      /*index=minarray(neg_listv, neg_pos); */
+      x = (int)neg_listx[index];
+      y = (int)neg_listy[index];
+      z = (int)neg_listz[index];
+      Tt = neg_listv[index];
+    }
+    XYZ_index = vindex3(x, y, z, dims);
 
     /* Decrease the foreground count if x y z is a foreground voxel */
-    if ( B[XYZ_index] > 0 ){
-      B[XYZ_index] = 0; // Erase it from the binary map
+    /* frozen for the first time, leaving the binary image untouched */
+    if ( B[XYZ_index] > 0 && !Frozen[XYZ_index] ){
       nforeground--;
-      if(nforeground <= 1){ // All the foreground pixels have been covered
+      if (region && nforeground == 0) { // Freeze the last foreground voxel as well
+        Frozen[XYZ_index] = 1;
+        T[XYZ_index] = Tt;
+        break;
+      }
+      if(!region && nforeground <= 1){ // All the foreground pixels have been covered
         break;
       }
+      /* Report the progress and stop early when asked to */
+      if (progress && (ntotal - nforeground) % progress_every == 0 &&
+          progress(ntotal - nforeground, ntotal, progress_data)) {
+        status = -2;
+        goto cleanup;
+      }
     }
 
     Frozen[XYZ_index] = 1;
-    T[XYZ_index] = neg_listv[index];
-    if (Ed) {
-      Y[XYZ_index] = neg_listo[index];
-    }
+    T[XYZ_index] = Tt;
 
-    /*Remove min value by replacing it with the last value in the array */
-    list_remove_replace(listval, listprop, index);
-    neg_listv = listval[listprop[1] - 1];
-    if (index < (neg_pos - 1)) {
-      neg_listx[index] = neg_listx[neg_pos - 1];
-      neg_listy[index] = neg_listy[neg_pos - 1];
-      neg_listz[index] = neg_listz[neg_pos - 1];
+    if (!useheap) {
       if (Ed) {
-        neg_listo[index] = neg_listo[neg_pos - 1];
+        Y[XYZ_index] = neg_listo[index];
       }
-      T[(int)mindex3((int)neg_listx[index], (int)neg_listy[index],
-                     (int)neg_listz[index], dims[0], dims[1])] = index;
+
+      /*Remove min value by replacing it with the last value in the array */
+      list_remove_replace(listval, listprop, index);
+      neg_listv = listval[listprop[1] - 1];
+      if (index < (neg_pos - 1)) {
+        neg_listx[index] = neg_listx[neg_pos - 1];
+        neg_listy[index] = neg_listy[neg_pos - 1];
+        neg_listz[index] = neg_listz[neg_pos - 1];
+        if (Ed) {
+          neg_listo[index] = neg_listo[neg_pos - 1];
+        }
+        T[vindex3((int)neg_listx[index], (int)neg_listy[index],
+                       (int)neg_listz[index], dims)] = index;
+      }
+      neg_pos = neg_pos - 1;
     }
-    neg_pos = neg_pos - 1;
 
     /*Loop through all 6 neighbours of current pixel */
     for (w = 0; w < 6; w++) {
@@ -1037,12 +1103,12 @@ void msfm3d(npy_double *F,             // The input speed image
       i = x + ne[w];
       j = y + ne[w + 6];
       k = z + ne[w + 12];
-      IJK_index = mindex3(i, j, k, dims[0], dims[1]);
+      IJK_index = vindex3(i, j, k, dims);
 
       /*Check if current neighbour is not yet frozen and inside the */
       /*picture */
-      if (isntfrozen3d(i, j, k, dims, Frozen)) {
-        Tt = CalculateDistance(T, F[IJK_index], dims, i, j, k, usesecond,
+      if (isntfrozen3d(i, j, k, dims, Frozen) && (!region || region[IJK_index])) {
+        Tt = CalculateDistance(T, speed_at(F, Fsingle, IJK_index), dims, i, j, k, usesecond,
                                usecross, Frozen);
         if (Ed) {
           Ty = CalculateDistance(Y, 1, dims, i, j, k, usesecond, usecross,
@@ -1050,7 +1116,18 @@ void msfm3d(npy_double *F,             // The input speed image
         }
 
         /*Update distance in neigbour list or add to neigbour list */
-        IJK_index = mindex3(i, j, k, dims[0], dims[1]);
+        IJK_index = vindex3(i, j, k, dims);
+        if (useheap) {
+          if (T[IJK_index] > -1) {
+            if (heap.key[(npy_intp)T[IJK_index]] > Tt) {
+              heap_decrease(&heap, (npy_intp)T[IJK_index], Tt, T, dims);
+            }
+          } else if (heap_push(&heap, Tt, i, j, k, T, dims) < 0) {
+            status = -1;
+            goto cleanup;
+          }
+          continue;
+        }
         if ((T[IJK_index] > -1) && T[IJK_index] <= listprop[0]) {
           if (neg_listv[(int)T[IJK_index]] > Tt) {
             listupdate(listval, listprop, (int)T[IJK_index], Tt);
@@ -1082,11 +1159,28 @@ void msfm3d(npy_double *F,             // The input speed image
       }
     }
   }
+  /* Voxels left out of a region, or not reached before all the foreground */
+  /* was frozen, take the latest arrival time instead of their band position */
+  if (region) {
+    Tt = 0;
+    for (q = 0; q < npixels; q++) {
+      if (Frozen[q] && T[q] > Tt) Tt = T[q];
+    }
+    for (q = 0; q < npixels; q++) {
+      if (!Frozen[q]) T[q] = Tt;
+    }
+  }
+
   /* Free memory */
+cleanup:
   /* Destroy parameter list */
-  destroy_list(listval, listprop);
+  if (listprop) {
+    destroy_list(listval, listprop);
+  }
   free(neg_listx);
   free(neg_listy);
   free(neg_listz);
   free(Frozen);
+  heap_free(&heap);
+  return status;
 }
\ No newline at end of file
@@ -6,11 +6,24 @@
 #define _MSFM
 #endif
 
-void msfm3d(npy_double* F,             // The input speed image
-	        npy_int64* bimg,
-            int dims[3],           // The size of the input speed image
+/* Progress callback of msfm3d, given the number of frozen foreground */
+/* voxels and the size of the foreground. Returning non-zero cancels */
+/* the fast marching. It is called without the GIL held. */
+typedef int (*msfm_progress)(npy_intp frozen, npy_intp total, void* data);
+
+/* Returns 0 when done, -1 when out of memory and -2 when cancelled */
+int msfm3d(const void* F,             // The input speed image, float32 or float64
+            bool Fsingle,          // Whether F holds float32 values
+            const npy_uint8* bimg, // The binary image, left untouched
+            const npy_uint8* region, // Voxels the front may expand into, NULL for all
+            int size[3],           // The size of the input speed image
+            npy_intp strides[3],   // The strides of F, bimg and T in elements
             npy_int64* SourcePoints,  // The source points
-            int dims_sp[3],        // The size of the source point array
+            int dims_sp[2],        // The size of the source point array
             bool usesecond, bool usecross,
+            bool useheap,   // Binary heap narrow band instead of the min-tree list
+            msfm_progress progress,  // Progress callback, or NULL
+            void* progress_data,     // Passed on to progress
+            npy_intp progress_every, // Frozen foreground voxels between two calls
             npy_double* T,  // The output time crosing map
             npy_double* Y); // The output euclidean image
@@ -72,6 +72,12 @@ int maxarray(double *A, int l) {
 
 __inline int mindex3(int x, int y, int z, int sizx, int sizy) { return x+y*sizx+z*sizx*sizy; }
 
+/* Index of a voxel in a volume of any memory order, with dims holding the */
+/* size of the three axes followed by their strides in elements */
+__inline npy_intp vindex3(int x, int y, int z, npy_intp *dims) {
+    return x*dims[3] + y*dims[4] + z*dims[5];
+}
+
 
 __inline bool IsFinite(double x) { return (x <= doublemax  && x >= -doublemax ); }
 __inline bool IsInf(double x)    { return (x >= doublemax ); }
@@ -79,13 +85,13 @@ __inline bool IsInf(double x)    { return (x >= doublemax ); }
 __inline bool IsListInf(double x){ return (x == listINF ); }
 
 
-__inline bool isntfrozen3d(int i, int j, int k, int *dims, bool *Frozen) {
+__inline bool isntfrozen3d(int i, int j, int k, npy_intp *dims, bool *Frozen) {
 
-    return (i>=0)&&(j>=0)&&(k>=0)&&(i<dims[0])&&(j<dims[1])&&(k<dims[2])&&(Frozen[mindex3(i, j, k, dims[0], dims[1])]==0);
+    return (i>=0)&&(j>=0)&&(k>=0)&&(i<dims[0])&&(j<dims[1])&&(k<dims[2])&&(Frozen[vindex3(i, j, k, dims)]==0);
 }
-__inline bool isfrozen3d(int i, int j, int k, int *dims, bool *Frozen) {
+__inline bool isfrozen3d(int i, int j, int k, npy_intp *dims, bool *Frozen) {
 
-    return (i>=0)&&(j>=0)&&(k>=0)&&(i<dims[0])&&(j<dims[1])&&(k<dims[2])&&(Frozen[mindex3(i, j, k, dims[0], dims[1])]==1);
+    return (i>=0)&&(j>=0)&&(k>=0)&&(i<dims[0])&&(j<dims[1])&&(k<dims[2])&&(Frozen[vindex3(i, j, k, dims)]==1);
 }
 
 int p2x(int x) /* 2^x */
@@ -300,11 +306,11 @@ void listupdate(double **listval, int *listprop, int index, double val) {
 
 __inline int mindex2(int x, int y, int sizx) { return x+y*sizx; }    
 
-__inline bool isntfrozen2d(int i, int j, int *dims, bool *Frozen)
+__inline bool isntfrozen2d(int i, int j, npy_intp *dims, bool *Frozen)
 {
     return (i>=0)&&(j>=0)&&(i<dims[0])&&(j<dims[1])&&(Frozen[i+j*dims[0]]==0);
 }
-__inline bool isfrozen2d(int i, int j, int *dims, bool *Frozen)
+__inline bool isfrozen2d(int i, int j, npy_intp *dims, bool *Frozen)
 {
     return (i>=0)&&(j>=0)&&(i<dims[0])&&(j<dims[1])&&(Frozen[i+j*dims[0]]==1);
 }
@@ -0,0 +1,112 @@
+#include <stdlib.h>
+#include <string.h>
+
+/* Indexed binary min-heap holding the narrow band of the fast marching. */
+/* Each entry is a travel time with the int32 coordinates of its voxel. */
+/* As with the min-tree list in common.c, the position of a voxel in the */
+/* band is kept in the time map T itself while the voxel is not frozen, so */
+/* an update can find its entry without a separate index. */
+/* The arrays grow geometrically instead of in fixed steps. */
+
+#define HEAP_INITIAL_CAPACITY 4096
+
+typedef struct {
+    npy_double* key;  /* n */
+    npy_int32* xyz;   /* n x 3 */
+    npy_intp n;
+    npy_intp capacity;
+} NarrowHeap;
+
+int heap_init(NarrowHeap* h) {
+    h->n = 0;
+    h->capacity = HEAP_INITIAL_CAPACITY;
+    h->key = (npy_double*)malloc(h->capacity * sizeof(npy_double));
+    h->xyz = (npy_int32*)malloc(h->capacity * 3 * sizeof(npy_int32));
+    return (h->key && h->xyz) ? 0 : -1;
+}
+
+void heap_free(NarrowHeap* h) {
+    free(h->key);
+    free(h->xyz);
+    h->key = NULL;
+    h->xyz = NULL;
+    h->n = h->capacity = 0;
+}
+
+static int heap_grow(NarrowHeap* h) {
+    npy_intp capacity = h->capacity * 2;
+    npy_double* key = (npy_double*)realloc(h->key, capacity * sizeof(npy_double));
+    npy_int32* xyz;
+    if (!key) return -1;
+    h->key = key;
+    xyz = (npy_int32*)realloc(h->xyz, capacity * 3 * sizeof(npy_int32));
+    if (!xyz) return -1;
+    h->xyz = xyz;
+    h->capacity = capacity;
+    return 0;
+}
+
+/* Write an entry at pos and record pos in the time map */
+static __inline void heap_place(NarrowHeap* h, npy_intp pos, npy_double key, const npy_int32* xyz,
+                                npy_double* T, npy_intp* dims) {
+    h->key[pos] = key;
+    memcpy(h->xyz + 3 * pos, xyz, 3 * sizeof(npy_int32));
+    T[vindex3(xyz[0], xyz[1], xyz[2], dims)] = pos;
+}
+
+static void heap_sift_up(NarrowHeap* h, npy_intp pos, npy_double* T, npy_intp* dims) {
+    npy_double key = h->key[pos];
+    npy_int32 xyz[3];
+    npy_intp parent;
+    memcpy(xyz, h->xyz + 3 * pos, 3 * sizeof(npy_int32));
+    while (pos > 0) {
+        parent = (pos - 1) / 2;
+        if (h->key[parent] <= key) break;
+        heap_place(h, pos, h->key[parent], h->xyz + 3 * parent, T, dims);
+        pos = parent;
+    }
+    heap_place(h, pos, key, xyz, T, dims);
+}
+
+static void heap_sift_down(NarrowHeap* h, npy_intp pos, npy_double* T, npy_intp* dims) {
+    npy_double key = h->key[pos];
+    npy_int32 xyz[3];
+    npy_intp child;
+    memcpy(xyz, h->xyz + 3 * pos, 3 * sizeof(npy_int32));
+    while ((child = 2 * pos + 1) < h->n) {
+        if (child + 1 < h->n && h->key[child + 1] < h->key[child]) child++;
+        if (key <= h->key[child]) break;
+        heap_place(h, pos, h->key[child], h->xyz + 3 * child, T, dims);
+        pos = child;
+    }
+    heap_place(h, pos, key, xyz, T, dims);
+}
+
+/* Add voxel (x, y, z) to the band. Returns -1 when out of memory */
+int heap_push(NarrowHeap* h, npy_double key, int x, int y, int z, npy_double* T, npy_intp* dims) {
+    npy_int32 xyz[3] = {x, y, z};
+    if (h->n == h->capacity && heap_grow(h) < 0) return -1;
+    heap_place(h, h->n, key, xyz, T, dims);
+    h->n++;
+    heap_sift_up(h, h->n - 1, T, dims);
+    return 0;
+}
+
+/* Lower the travel time of the entry at pos */
+void heap_decrease(NarrowHeap* h, npy_intp pos, npy_double key, npy_double* T, npy_intp* dims) {
+    h->key[pos] = key;
+    heap_sift_up(h, pos, T, dims);
+}
+
+/* Remove the entry with the smallest travel time, returning it in key and xyz */
+void heap_pop(NarrowHeap* h, npy_double* key, int* xyz, npy_double* T, npy_intp* dims) {
+    *key = h->key[0];
+    xyz[0] = h->xyz[0];
+    xyz[1] = h->xyz[1];
+    xyz[2] = h->xyz[2];
+    h->n--;
+    if (h->n > 0) {
+        heap_place(h, 0, h->key[h->n], h->xyz + 3 * h->n, T, dims);
+        heap_sift_down(h, 0, T, dims);
+    }
+}
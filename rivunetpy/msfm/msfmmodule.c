@@ -7,7 +7,8 @@
 /*Multistencil Fast Marching Method (MSFM). This method gives more accurate */
 /*distances by using second order derivatives and cross neighbours. */
 /* */
-/*T=msfm3d(F, SourcePoints, UseSecond, UseCross) */
+/*T=run(F, B, SourcePoints, UseSecond, UseCross, heap=False, */
+/*      progress=None, cancel=None, every=100000, out=None, region=None) */
 /* */
 /*inputs, */
 /*   F: The 3D speed image. The speed function must always be larger */
@@ -15,98 +16,225 @@
  */
 /*          never be reached because the time will go to infinity.
  */
+/*          C- or Fortran-contiguous float32/float64 images are not copied */
+/*   B: The binary image, only its foreground is marched through. */
+/*          uint8/bool masks in the memory order of F are not copied */
 /*  SourcePoints : A list of starting points [3 x N] (distance zero) */
 /*  UseSecond : Boolean Set to true if not only first but also second */
 /*               order derivatives are used (default) */
 /*  UseCross: Boolean Set to true if also cross neighbours */
 /*               are used (default) */
+/*  heap: Boolean Set to true to keep the narrow band in an indexed */
+/*               binary heap instead of the min-tree list of common.c */
+/*  progress: Called as progress(frozen, total) every `every` frozen */
+/*               foreground voxels, total being the size of the foreground */
+/*  cancel: An object with an is_set() method such as threading.Event, */
+/*               checked every `every` frozen foreground voxels. msfm.Cancelled */
+/*               is raised once it is set */
+/*  out: A float64 array in the shape and memory order of F to write T into */
+/*  region: A mask the front is not allowed to leave, usually a dilation */
+/*               of B. The march then stops once all of B is frozen and */
+/*               every voxel left unreached takes the latest arrival time */
 /*outputs, */
-/*  T : Image with distance from SourcePoints to all pixels */
+/*  T : Image with distance from SourcePoints to all pixels, in the memory */
+/*               order of F (out when given) */
 
+/* */
+/* The GIL is released while marching, so several volumes can be */
+/* processed at once from a thread pool. */
 /* */
 /* Function is written by D.Kroon University of Twente (June 2009) */
 /* Wrapped into python by Siqi Liu of Uni.Sydney (2016) */
 
-static PyObject* msfm_run(PyObject* self, PyObject* args) {
-  PyArrayObject *Fobj, *Farr, *Bobj, *Barr, *spobj, *sparr = NULL; 
-  PyObject *secondobj, *crossobj = NULL;
-  npy_double *F = NULL; 
-  npy_double *B = NULL; 
-  npy_int64 *sp = NULL;  // Pointers hold the data of numpy array
-  npy_double *T, *Y = NULL;   // The pointers to the return matrices
-  npy_intp *Fdims, *spdims = NULL;
-
-  // Parse the input args
-  // Expecting args: F(3D numpy array), sourcepoints (2D numpy array), second(int), cross(int)
-  if (!PyArg_ParseTuple(args, "OOObb", &Fobj, &Bobj, &spobj, &secondobj, &crossobj))
-    return NULL;  // TODO: raise error here
+static PyObject* CancelledError = NULL;
 
-  // 1. Parse F speed image
-  if (!(Farr = PyArray_FROM_OTF(Fobj, NPY_DOUBLE, NPY_F_CONTIGUOUS | NPY_ARRAY_ALIGNED))) return NULL;
+typedef struct {
+  PyObject* callback;
+  PyObject* cancel;
+} ProgressData;
 
-  F = (npy_double *) PyArray_DATA(Farr);
-  Fdims = PyArray_DIMS(Farr);
-  int nvox = Fdims[0] * Fdims[1] * Fdims[2];
+/* Takes the GIL back to call the python progress callback and cancel flag */
+static int report_progress(npy_intp frozen, npy_intp total, void* data) {
+  ProgressData* p = (ProgressData*) data;
+  PyObject* r;
+  int stop = 0;
+  PyGILState_STATE gil = PyGILState_Ensure();
 
-  // 2. Parse binary image
-  if (!(Barr = PyArray_FROM_OTF(Bobj, NPY_DOUBLE, NPY_F_CONTIGUOUS | NPY_ARRAY_ALIGNED))) return NULL;
-
-  B = (npy_int64 *) PyArray_DATA(Barr); // B and F should share the same dimensionality
+  if (p->callback) {
+    if ((r = PyObject_CallFunction(p->callback, "nn", (Py_ssize_t) frozen, (Py_ssize_t) total))) {
+      Py_DECREF(r);
+    } else {
+      stop = 1;  // Let the exception of the callback propagate
+    }
+  }
+  if (!stop && p->cancel) {
+    if ((r = PyObject_CallMethod(p->cancel, "is_set", NULL))) {
+      stop = PyObject_IsTrue(r) != 0;
+      Py_DECREF(r);
+    } else {
+      stop = 1;
+    }
+  }
 
-  // 3. Parse source points
-  if(!(sparr = PyArray_FROM_OTF(spobj, NPY_INT64, NPY_IN_ARRAY))) return NULL;
+  PyGILState_Release(gil);
+  return stop;
+}
 
-  sp = (npy_int64*) PyArray_DATA(sparr);
-  spdims = PyArray_DIMS(sparr);
+/* Whether arr can be used in place: C- or Fortran-contiguous as asked */
+static int has_order(PyArrayObject* arr, int fortran) {
+  return fortran ? PyArray_IS_F_CONTIGUOUS(arr) : PyArray_IS_C_CONTIGUOUS(arr);
+}
 
-  // Allocate memory for outputs
-  T = malloc(nvox * sizeof(npy_double));
-  Y = malloc(nvox * sizeof(npy_double));
+/* One-byte masks in the memory order of F are used in place, anything */
+/* else is converted to a bool copy */
+static PyArrayObject* as_mask(PyObject* obj, int fortran, npy_intp* dims, const char* name) {
+  PyArrayObject* arr;
+  if (!(arr = (PyArrayObject*) PyArray_FROM_OF(obj, NPY_ARRAY_ALIGNED))) return NULL;
+  if (!((PyArray_ITEMSIZE(arr) == 1 && PyArray_ISINTEGER(arr)) || PyArray_ISBOOL(arr)) ||
+      !has_order(arr, fortran)) {
+    Py_SETREF(arr, (PyArrayObject*) PyArray_FromArray(
+                       arr, PyArray_DescrFromType(NPY_BOOL),
+                       (fortran ? NPY_ARRAY_F_CONTIGUOUS : NPY_ARRAY_C_CONTIGUOUS) |
+                           NPY_ARRAY_ALIGNED | NPY_ARRAY_FORCECAST));
+    if (!arr) return NULL;
+  }
+  if (PyArray_NDIM(arr) != 3 || !PyArray_CompareLists(PyArray_DIMS(arr), dims, 3)) {
+    PyErr_Format(PyExc_ValueError, "%s and F should share the same shape", name);
+    Py_DECREF(arr);
+    return NULL;
+  }
+  return arr;
+}
 
-  // Convert the dims to plain int
-  int Fdims_int [3] = {(int) Fdims[0], (int) Fdims[1], (int) Fdims[2]};
-  int spdims_int[2];
+static PyObject* msfm_run(PyObject* self, PyObject* args, PyObject* kwargs) {
+  static char* kwlist[] = {"F", "B", "source", "second", "cross", "heap",
+                           "progress", "cancel", "every", "out", "region", NULL};
+  PyObject *Fobj, *Bobj, *spobj, *outobj = NULL, *regionobj = NULL;
+  PyArrayObject *Farr = NULL, *Barr = NULL, *Rarr = NULL, *sparr = NULL, *Tarr = NULL;
+  char secondobj = 1, crossobj = 1, heapobj = 0;
+  int status, d, fortran, single;
+  ProgressData progress = {NULL, NULL};
+  npy_intp every = 100000;
+  npy_intp *Fdims, *spdims;
+  npy_intp strides[3];
+  int Fdims_int[3], spdims_int[2];
 
-  if (PyArray_NDIM(sparr) == 1 && spdims[0] == 3) 
-  {
+  // Parse the input args
+  // Expecting args: F(3D numpy array), B(3D numpy array), sourcepoints (2D numpy array),
+  // second(int), cross(int)
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OOObb|bOOnOO", kwlist, &Fobj, &Bobj, &spobj,
+                                   &secondobj, &crossobj, &heapobj, &progress.callback,
+                                   &progress.cancel, &every, &outobj, &regionobj))
+    return NULL;
+  if (progress.callback == Py_None) progress.callback = NULL;
+  if (progress.cancel == Py_None) progress.cancel = NULL;
+  if (outobj == Py_None) outobj = NULL;
+  if (regionobj == Py_None) regionobj = NULL;
+  if (every < 1) {
+    PyErr_SetString(PyExc_ValueError, "every should be a positive number of voxels");
+    return NULL;
+  }
 
-	spdims_int[0] = (int) spdims[0];
-	spdims_int[1] = 1;
+  // 1. Parse F speed image. Contiguous float32 and float64 images are used
+  // in place, anything else is converted to a Fortran ordered float64 copy
+  if (!(Farr = (PyArrayObject*) PyArray_FROM_OF(Fobj, NPY_ARRAY_ALIGNED))) return NULL;
+  if (!((PyArray_TYPE(Farr) == NPY_FLOAT || PyArray_TYPE(Farr) == NPY_DOUBLE) &&
+        (PyArray_IS_F_CONTIGUOUS(Farr) || PyArray_IS_C_CONTIGUOUS(Farr)))) {
+    Py_SETREF(Farr, (PyArrayObject*) PyArray_FROM_OTF((PyObject*) Farr, NPY_DOUBLE,
+                                                      NPY_ARRAY_F_CONTIGUOUS | NPY_ARRAY_ALIGNED));
+    if (!Farr) return NULL;
   }
-  else if (PyArray_NDIM(sparr) == 2 && spdims[0] == 3)
-  {
-	spdims_int[0] = (int) spdims[0];
-	spdims_int[1] = (int) spdims[1];
+  if (PyArray_NDIM(Farr) != 3) {
+    PyErr_SetString(PyExc_ValueError, "F should be a 3D speed image");
+    goto fail;
   }
-  else
-  {
-  	PyErr_NewException("DimensionError: The dimensions of the source points matrix can only be 3X1 or 3XN", NULL, NULL);
+  single = PyArray_TYPE(Farr) == NPY_FLOAT;
+  fortran = PyArray_IS_F_CONTIGUOUS(Farr);
+  Fdims = PyArray_DIMS(Farr);
+  for (d = 0; d < 3; d++) Fdims_int[d] = (int) Fdims[d];
+  if (fortran) {
+    strides[0] = 1;
+    strides[1] = Fdims[0];
+    strides[2] = Fdims[0] * Fdims[1];
+  } else {
+    strides[0] = Fdims[1] * Fdims[2];
+    strides[1] = Fdims[2];
+    strides[2] = 1;
   }
 
+  // 2. Parse binary image and the region to march through
+  if (!(Barr = as_mask(Bobj, fortran, Fdims, "B"))) goto fail;
+  if (regionobj && !(Rarr = as_mask(regionobj, fortran, Fdims, "region"))) goto fail;
 
-  // Run the Meaty part MSFM
-  msfm3d(F, B, Fdims_int, sp, spdims_int, secondobj, crossobj, T, Y);
-  PyObject* npT = PyArray_New(&PyArray_Type, 3, Fdims, NPY_DOUBLE, 0, 0, sizeof(npy_double), NPY_F_CONTIGUOUS, 0);
-  memcpy(PyArray_DATA(npT), T, nvox * sizeof(double));
+  // 3. Parse source points
+  if (!(sparr = (PyArrayObject*) PyArray_FROM_OTF(spobj, NPY_INT64, NPY_ARRAY_IN_ARRAY))) goto fail;
+  spdims = PyArray_DIMS(sparr);
+  if (PyArray_NDIM(sparr) == 1 && spdims[0] == 3) {
+    spdims_int[0] = 3;
+    spdims_int[1] = 1;
+  } else if (PyArray_NDIM(sparr) == 2 && spdims[0] == 3) {
+    spdims_int[0] = 3;
+    spdims_int[1] = (int) spdims[1];
+  } else {
+    PyErr_SetString(PyExc_ValueError,
+                    "The dimensions of the source points matrix can only be 3X1 or 3XN");
+    goto fail;
+  }
 
-  // Skip the Y output for now
-  // PyObject* npY =
-  //     PyArray_NewFromDescr(&PyArray_Type, PyArray_DescrFromType(NPY_DOUBLE),
-  //     3, Fdims, NULL,
-                           // Y, NPY_FORTRAN|NPY_WRITEABLE, NULL);
-  // Py_INCREF(npY);
+  // 4. The time map is written straight into out, or into a new array
+  // in the memory order of F
+  if (outobj) {
+    if (!PyArray_Check(outobj) || PyArray_TYPE((PyArrayObject*) outobj) != NPY_DOUBLE ||
+        !PyArray_ISWRITEABLE((PyArrayObject*) outobj) || !has_order((PyArrayObject*) outobj, fortran)) {
+      PyErr_Format(PyExc_TypeError, "out should be a writeable float64 %s-contiguous array",
+                   fortran ? "Fortran" : "C");
+      goto fail;
+    }
+    if (PyArray_NDIM((PyArrayObject*) outobj) != 3 ||
+        !PyArray_CompareLists(PyArray_DIMS((PyArrayObject*) outobj), Fdims, 3)) {
+      PyErr_SetString(PyExc_ValueError, "out and F should share the same shape");
+      goto fail;
+    }
+    Py_INCREF(outobj);
+    Tarr = (PyArrayObject*) outobj;
+  } else if (!(Tarr = (PyArrayObject*) PyArray_New(&PyArray_Type, 3, Fdims, NPY_DOUBLE, NULL, NULL, 0,
+                                                    fortran ? NPY_ARRAY_F_CONTIGUOUS : 0, NULL))) {
+    goto fail;
+  }
+
+  // Run the Meaty part MSFM
+  Py_BEGIN_ALLOW_THREADS
+  status = msfm3d(PyArray_DATA(Farr), single, (npy_uint8*) PyArray_DATA(Barr),
+                  Rarr ? (npy_uint8*) PyArray_DATA(Rarr) : NULL, Fdims_int, strides,
+                  (npy_int64*) PyArray_DATA(sparr), spdims_int, secondobj, crossobj, heapobj,
+                  (progress.callback || progress.cancel) ? report_progress : NULL,
+                  &progress, every, (npy_double*) PyArray_DATA(Tarr), NULL);
+  Py_END_ALLOW_THREADS
+  if (status == -1) {
+    PyErr_NoMemory();
+    goto fail;
+  } else if (status < 0) {
+    if (!PyErr_Occurred()) PyErr_SetString(CancelledError, "The fast marching was cancelled");
+    goto fail;
+  }
 
   Py_DECREF(Farr);
+  Py_DECREF(Barr);
+  Py_XDECREF(Rarr);
   Py_DECREF(sparr);
-  Py_INCREF(npT);
-  free(T);
-  free(Y); // Y is not used for now
+  return (PyObject*) Tarr;
 
-  return npT;
+fail:
+  Py_XDECREF(Farr);
+  Py_XDECREF(Barr);
+  Py_XDECREF(Rarr);
+  Py_XDECREF(sparr);
+  Py_XDECREF(Tarr);
+  return NULL;
 }
 
 static PyMethodDef msfm_methods[] = {
-    {"run", (PyCFunction)msfm_run, METH_VARARGS,
+    {"run", (PyCFunction)msfm_run, METH_VARARGS | METH_KEYWORDS,
      "Run multistencils fastmarching."},
     {NULL, NULL, 0, NULL}};
 
@@ -123,5 +251,14 @@ PyMODINIT_FUNC PyInit_msfm(void) {
 
   Py_Initialize();
   import_array();
+
+  CancelledError = PyErr_NewException("msfm.Cancelled", PyExc_RuntimeError, NULL);
+  Py_XINCREF(CancelledError);
+  if (PyModule_AddObject(m, "Cancelled", CancelledError) < 0) {
+    Py_XDECREF(CancelledError);
+    Py_CLEAR(CancelledError);
+    Py_DECREF(m);
+    return NULL;
+  }
   return m;
 }
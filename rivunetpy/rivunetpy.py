@@ -1,6 +1,7 @@
 import os
 import sys
-from multiprocessing import Pool
+import queue
+from multiprocessing import Pool, shared_memory
 import warnings
 import time
 
@@ -13,14 +14,15 @@ from SimpleITK.SimpleITK import Image
 from rivunetpy.trace import R2Tracer
 from rivunetpy.swc import SWC
 from rivunetpy.utils.plottools import flatten, plot_swcs, plot_segmentation
-from rivunetpy.utils.io import loadswc, loadimg, crop
+from rivunetpy.utils.io import loadswc, loadswcnpz, saveswcnpz, loadimg, crop
 from rivunetpy.utils.filtering import apply_threshold
-from rivunetpy.trace import estimate_radius
+from rivunetpy.trace import RadiusEstimator
 from rivunetpy.utils.segmentation import NeuronSegmentor
 from rivunetpy.utils.cells import Neuron
-from rivunetpy.utils.extensions import RIVULET_2_TREE_SWC_EXT, RIVULET_2_TREE_IMG_EXT
+from rivunetpy.utils.extensions import (RIVULET_2_TREE_SWC_EXT, RIVULET_2_TREE_IMG_EXT, RIVULET_2_TREE_NPZ_EXT,
+                                        RIVULET_2_TREE_OFFSET_EXT)
 
-from contextlib import redirect_stdout
+from contextlib import redirect_stdout, nullcontext
 
 
 def check_long_ext(file_to_check, ext):
@@ -154,6 +156,10 @@ def sitk_read_metadata(img_or_file, key=None):
 class HyperStack(Image):
     """Image class for easy operations on 4D HyperStacks exported by ImageJ.
 
+    A HyperStack loaded lazily keeps no image data of its own. Its pages stay
+    memory-mapped in the file and are only read when a frame or z-slice is
+    accessed through ``frame``, ``z_slice`` or ``as_array``.
+
     Attributes:
         frames (int): Number of timepoints in HyperStack.
         z_size (int): Z-depth of confocal stack.
@@ -173,9 +179,123 @@ class HyperStack(Image):
         self.voxel_unit_str = None
         self.period = None
         self.period_unit_str = None
+        self._pages = None  # Memory-mapped pages as T x Z x Y x X when lazy
+        self._shm = None  # Shared memory holding the pages when shared
+        self._shm_owner = False
 
         super().__init__(*args, **kwargs)
 
+    def GetSize(self):
+        """Size of the image in X, Y, Z, and T, also when loaded lazily.
+        """
+        if self._pages is not None:
+            frames, z_size, y_size, x_size = self._pages.shape
+            return x_size, y_size, z_size, frames
+        return super().GetSize()
+
+    def as_array(self) -> np.ndarray:
+        """Image data as a T x Z x Y x X array without copying it.
+
+        Returns:
+            np.ndarray: A memory map of the file when loaded lazily, otherwise
+              a read-only view of the image.
+        """
+        if self._pages is not None:
+            return self._pages
+        return sitk.GetArrayViewFromImage(self)
+
+    def frame(self, t: int) -> np.ndarray:
+        """Z x Y x X view of a single frame.
+        """
+        return self.as_array()[t]
+
+    def z_slice(self, z: int, t: int = None) -> np.ndarray:
+        """Y x X view of a z-slice of one frame, or T x Y x X for all frames.
+        """
+        if t is None:
+            return self.as_array()[:, z]
+        return self.as_array()[t, z]
+
+    def _file_backed(self) -> bool:
+        """Whether the pages are memory-mapped from a file that can be reopened.
+        """
+        return (isinstance(self._pages, np.memmap) and self._pages.filename is not None
+                and os.path.exists(self._pages.filename))
+
+    def share(self):
+        """Makes the image data attachable by name from other processes.
+
+        A HyperStack memory-mapped from its file is returned as is. Any other
+        HyperStack is copied once into shared memory. Either way, pickling the
+        result only sends the name of the file or shared memory block and the
+        metadata, so that worker processes read the recording in place.
+        Share before starting the worker processes, so that they clean up
+        through the same resource tracker, and release the shared memory with
+        ``close`` when done.
+
+        Returns:
+            HyperStack: HyperStack that is cheap to pass to worker processes.
+        """
+        if self._shm is not None or self._file_backed():
+            return self
+
+        pages = self.as_array()
+        shm = shared_memory.SharedMemory(create=True, size=max(pages.nbytes, 1))
+        shared = HyperStack._attach(('shm', shm.name, pages.shape, pages.dtype.str), self._metadata(), shm)
+        shared._pages[...] = pages
+        shared._pages.flags.writeable = False
+        shared._shm_owner = True
+        return shared
+
+    def close(self):
+        """Releases the shared memory, if any, created by ``share``.
+        """
+        if self._shm is not None:
+            self._pages = None
+            self._shm.close()
+            if self._shm_owner:
+                self._shm.unlink()
+            self._shm = None
+
+    _METADATA = ('frames', 'z_size', 'voxel_size', 'voxel_unit_str', 'period', 'period_unit_str',
+                 'x_size', 'y_size')
+
+    def _metadata(self) -> dict:
+        """Metadata attributes to carry over to a pickled copy.
+        """
+        return {key: getattr(self, key) for key in self._METADATA if hasattr(self, key)}
+
+    def __reduce_ex__(self, protocol):
+        if self._shm is not None:
+            source = ('shm', self._shm.name, self._pages.shape, self._pages.dtype.str)
+        elif self._file_backed():
+            source = ('memmap', self._pages.filename, self._pages.offset, self._pages.shape, self._pages.dtype.str)
+        else:  # No name to attach to, the data goes along
+            source = ('array', np.array(self.as_array()))
+        return HyperStack._attach, (source, self._metadata())
+
+    @staticmethod
+    def _attach(source, metadata, shm=None):
+        """Rebuilds a pickled HyperStack around the image data it refers to.
+        """
+        hyperstack = HyperStack()
+        kind = source[0]
+        if kind == 'shm':
+            _, name, shape, dtype = source
+            attached = shm is None
+            if attached:
+                shm = shared_memory.SharedMemory(name=name)
+            hyperstack._shm = shm
+            hyperstack._pages = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            hyperstack._pages.flags.writeable = not attached
+        elif kind == 'memmap':
+            _, filename, offset, shape, dtype = source
+            hyperstack._pages = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            hyperstack._pages = source[1]
+        hyperstack.__dict__.update(metadata)
+        return hyperstack
+
     def _add_metadata(self, metadata_dict):
         """Processes metatdata stored in a dictionary.
 
@@ -275,7 +395,7 @@ class HyperStack(Image):
               f'\tWith {self.frames} frames.')
 
     @classmethod
-    def from_file(cls, fname, metadata_only=False):
+    def from_file(cls, fname, metadata_only=False, lazy=False):
         """Automatically loads a HyperStack from file.
 
         Loads an image from file and tries to automatically reslice the image
@@ -286,12 +406,15 @@ class HyperStack(Image):
             metadata_only (bool): Whether to read only the metadata and skip
               reading the image data from file (fast) or also read the image
               data.
+            lazy (bool): Whether to memory-map the image data instead of
+              reading it, so that recordings larger than the memory can be
+              opened. Compressed files are decoded to a temporary file.
 
         Returns:
             HyperStack: Python interface for ImageJ HyperStack exports.
         """
         # Hacky bootstrapping to read the file
-        if not metadata_only:
+        if not metadata_only and not lazy:
             # sitk.ProcessObject_SetGlobalWarningDisplay(False)
             img = sitk.ReadImage(fname)
             # img = sitk.Cast(img, sitk.sitkUInt16)
@@ -321,6 +444,20 @@ class HyperStack(Image):
                                                            'hyperstack. Try editing it in ImageJ.')
         if metadata_only:
             hyperstack = cls()
+        elif lazy:
+            try:
+                pages = tifffile.memmap(fname, mode='r')
+            except ValueError:  # Not stored contiguously, decode to a file instead
+                pages = tifffile.imread(fname, out='memmap')
+
+            stacks = int(np.prod(pages.shape[:-2]))
+            assert stacks == (frames * z_depth), \
+                (f'Image dimensions do not match metadata. Number of stacks: {stacks} should equal \n'
+                 'the number of Z-stacks * number of frames: \n'
+                 f'({frames} * {z_depth} = {frames * z_depth} != {stacks}')
+
+            hyperstack = cls()
+            hyperstack._pages = pages.reshape((frames, z_depth) + pages.shape[-2:])
         else:
             X_size, Y_size, stacks = img.GetSize()
 
@@ -362,11 +499,19 @@ class HyperStack(Image):
             raise ValueError(f'Unknown projection mode: {mode}. Please use either MAX or AVG for maximum intensity \n'
                              'and average intensity projection resp.')
 
-        X_size, Y_size, _, _ = self.GetSize()
-
-        # Project to 3D image to get geometry
-        T_project = sitk.GetArrayFromImage(self)
-        T_project = function(T_project, axis=0, keepdims=False)
+        if self._pages is not None:  # Read one frame at a time
+            T_project = np.array(self.frame(0), dtype=None if mode == 'MAX' else 'float64')
+            for ii in range(1, self.GetSize()[3]):
+                if mode == 'MAX':
+                    np.maximum(T_project, self.frame(ii), out=T_project)
+                else:
+                    T_project += self.frame(ii)
+            if mode == 'AVG':
+                T_project /= self.GetSize()[3]
+        else:
+            # Project to 3D image to get geometry
+            T_project = sitk.GetArrayFromImage(self)
+            T_project = function(T_project, axis=0, keepdims=False)
 
         return sitk.GetImageFromArray(T_project, isVector=False)
 
@@ -387,6 +532,9 @@ class Tracer():
         quality (bool): Quality setting for Rivuletpy tracer.
         asynchronous (bool): Setting for asynchronous segmentation and tracing.
           Set to True for normal use and to False for debugging.
+        plot_segmentation (bool): Whether to show the seeds and labeled neurons
+          once segmented. Off by default, as showing them extracts every
+          neuron before the first one is traced.
         neurons (list): List containing Neuron objects which store
           segementation and trace results.
         use_hyperstack (bool): Strictly check for HyperStack input. Set to True.
@@ -406,6 +554,7 @@ class Tracer():
         self.overwrite_cache = False
         self.quality = False
         self.asynchronous = True
+        self.plot_segmentation = False
         self.neurons = None
         self._speed = False
         self.use_hyperstack = True
@@ -525,6 +674,26 @@ class Tracer():
         self.asynchronous = asynchronous
         return self
 
+    def plot_segmentation_on(self):
+        """Shows the seeds and labeled neurons once segmented.
+
+        All neurons are then extracted before tracing starts.
+        """
+        self.plot_segmentation = True
+        return self
+
+    def plot_segmentation_off(self):
+        """Turns off the segmentation plot.
+        """
+        self.plot_segmentation = False
+        return self
+
+    def set_plot_segmentation(self, plot_segmentation: bool):
+        """Sets whether to show the seeds and labeled neurons once segmented.
+        """
+        self.plot_segmentation = plot_segmentation
+        return self
+
     def hyperstack_on(self):
         """Strictly allows only input HyperStacks saved by ImageJ.
         """
@@ -646,45 +815,48 @@ class Tracer():
             if check_long_ext(fname, RIVULET_2_TREE_IMG_EXT):
                 loc = os.path.join(self.out, fname)
                 image = loadimg(loc, 1)
-                self.neurons.append(Neuron(image, img_fname=loc, num=len(self.neurons)))
+                offset_fname = '{}{}'.format(loc.split(RIVULET_2_TREE_IMG_EXT)[0], RIVULET_2_TREE_OFFSET_EXT)
+                offset = tuple(np.loadtxt(offset_fname, dtype=int)) if os.path.exists(offset_fname) else (0, 0, 0)
+                self.neurons.append(Neuron(image, img_fname=loc, num=len(self.neurons), offset=offset))
         print(f'Loaded {len(self.neurons)} neuron images from file.')
 
         self.hyperstack = HyperStack().from_file(self.filename, metadata_only=True)
 
     def _segment(self):
         """Loads an image from disk and segments it.
+
+        Returns:
+            generator: Yields the neurons one at a time, largest first, each
+              cropped from the image as it is requested.
         """
         ################ LOAD IMAGE AND METADATA #################
-        self.hyperstack = HyperStack().from_file(self.filename)
+        self.hyperstack = HyperStack().from_file(self.filename, lazy=True)
 
         ######## CREATE PROJECTIONS FOR TRACING AND VOLTAGE IMAGE DATA ANALYSIS ##########
         spatial_data = self.hyperstack.t_project(mode='MAX')
 
-        # Reload without image
-        self.hyperstack = None
-        self.hyperstack = HyperStack().from_file(self.filename, metadata_only=True)
-
         # Create a new directory next to the input file for the SWC outputs
         if not os.path.exists(self.out):
             os.mkdir(self.out)
 
-        neuronsegmentor = NeuronSegmentor(spatial_data, threshold=self.threshold, tolerance=self.tolerance, blur=self.blur)
-        self.neurons = neuronsegmentor.neurons
+        neuronsegmentor = NeuronSegmentor(spatial_data, threshold=self.threshold, tolerance=self.tolerance, blur=self.blur,
+                                          plot=self.plot_segmentation)
 
         # DEBUG PLOTS
         # neuronsegmentor.plot()
         # neuronsegmentor.plot_full_segmentation()
 
-    def _write_segmentation_to_file(self):
-        """Stores the results of the segmentation to disk.
+        return neuronsegmentor.iter_neurons(largest_first=True)
+
+    def _write_neuron_to_file(self, neuron: Neuron):
+        """Stores the image of a single segmented neuron and its offset to disk.
         """
-        for ii, neuron in enumerate(self.neurons):
-            # Store images
-            img_fname = 'neuron_{:04d}{}'.format(ii, RIVULET_2_TREE_IMG_EXT)
-            loc = os.path.join(self.out, img_fname)
-            neuron.img_fname = loc
-            sitk.WriteImage(neuron.img, neuron.img_fname)
-        print(f'Segmented image into {len(self.neurons)} neurons.')
+        img_fname = 'neuron_{:04d}{}'.format(neuron.num, RIVULET_2_TREE_IMG_EXT)
+        loc = os.path.join(self.out, img_fname)
+        neuron.img_fname = loc
+        sitk.WriteImage(neuron.img, neuron.img_fname)
+        np.savetxt('{}{}'.format(loc.split(RIVULET_2_TREE_IMG_EXT)[0], RIVULET_2_TREE_OFFSET_EXT),
+                   np.atleast_2d(neuron.offset), fmt='%d')
 
     @staticmethod
     def _trace_single(neuron, threshold, speed, quality, force_retrace, voxel_size):
@@ -708,9 +880,14 @@ class Tracer():
         starttime = time.time()
         img = neuron.img
         neuron.swc_fname = '{}{}'.format(neuron.img_fname.split(RIVULET_2_TREE_IMG_EXT)[0], RIVULET_2_TREE_SWC_EXT)
+        npz_fname = '{}{}'.format(neuron.img_fname.split(RIVULET_2_TREE_IMG_EXT)[0], RIVULET_2_TREE_NPZ_EXT)
 
-        if os.path.exists(neuron.swc_fname) and not force_retrace:
-            swc_mat = loadswc(neuron.swc_fname)
+        # The binary copy is only used when the SWC was not changed after it
+        use_npz = os.path.exists(npz_fname) and (not os.path.exists(neuron.swc_fname) or
+                                                 os.path.getmtime(npz_fname) >= os.path.getmtime(neuron.swc_fname))
+
+        if (use_npz or os.path.exists(neuron.swc_fname)) and not force_retrace:
+            swc_mat = loadswcnpz(npz_fname) if use_npz else loadswc(neuron.swc_fname)
             swc = SWC()
             swc._data = swc_mat
             neuron.add_SWC(swc)
@@ -723,12 +900,13 @@ class Tracer():
             else:
                 _, reg_thresh = apply_threshold(img, mthd='Max Entropy')
 
-            img: np.ndarray = sitk.GetArrayFromImage(img)
+            img: np.ndarray = sitk.GetArrayViewFromImage(img)
             img = np.moveaxis(img, 0, -1)
             img = np.swapaxes(img, 0, 1)
 
             try:
                 img, crop_region = crop(img, reg_thresh)  # Crop by default
+                img = np.ascontiguousarray(img)  # The distance transforms misread strided volumes
                 print(f'Neuron ({neuron.num})\t --Tracing neuron of shape {img.shape} '
                       f'with a threshold of {reg_thresh}')
             except ValueError:
@@ -751,8 +929,7 @@ class Tracer():
             if skeletonize:
                 print('Re-estimating radius...')
                 swc_arr = swc.get_array()
-                for i in range(swc_arr.shape[0]):
-                    swc_arr[i, 5] = estimate_radius(swc_arr[i, 2:5], img > reg_thresh)
+                swc_arr[:, 5] = RadiusEstimator(img > reg_thresh).estimate(swc_arr[:, 2:5])
                 swc._data = swc_arr
 
             if np.ndim(swc._data) == 1:
@@ -764,130 +941,220 @@ class Tracer():
 
             swc.apply_soma_TypeID(soma)
 
-            swc.reset(crop_region, 1)
+            swc.reset(crop_region + np.asarray(neuron.offset)[:, None], 1)  # Back to the original image
 
             swc.apply_scale(voxel_size)
 
             swc.save(neuron.swc_fname)
+            saveswcnpz(npz_fname, swc._data)
             neuron.add_SWC(swc)
 
         return neuron
 
-    def _trace_all(self):
-        """Reconstructs a batch of images each containing a single neuron.
-        """
-        if self.asynchronous:
-            with Pool(processes=os.cpu_count() - 1) as pool:
-                result_buffers = []
-                for neuron in self.neurons:
-                    result = pool.apply_async(self._trace_single,
-                                              (neuron,
-                                               self.threshold,
-                                               self._speed,
-                                               self.quality,
-                                               self.overwrite_cache,
-                                               self.hyperstack.voxel_size))
-                    result_buffers.append(result)
-
-                self.neurons = [result.get() for result in result_buffers]
-        else:
-            result_buffers = []
-            for neuron in self.neurons:
-                result_buffers.append(self._trace_single(neuron,
-                                                         self.threshold,
-                                                         self._speed,
-                                                         self.quality,
-                                                         self.overwrite_cache,
-                                                         self.hyperstack.voxel_size))
-
-            self.neurons = result_buffers
-
     @staticmethod
-    def _get_voltage_single(neuron: Neuron, hyperstack: HyperStack, force_redo: bool, window_scale: float = 5):
-        """Gets the voltage trace of a single neuron at the soma.
-
-        Retrieves the change in intensity over each frame around the soma of
-        a neuron. For each frame, retrieves the average intensity from a
-        spherical region with a radius close to that of the soma.
+    def _soma_roi(neuron: Neuron, hyperstack: HyperStack, window_scale: float = 5):
+        """Gets the spherical region of interest around the soma of a neuron.
 
         Args:
             neuron (Neuron): Neuron dataclass containing the reconstruction of
               the neuron to be analyzed.
             hyperstack (HyperStack): The original image.
-            force_redo (bool): Whether to discard results stored to disk from
-              previous runs and redo the voltage recovery.
             window_scale (float): Scale factor for increasing or descreasing
               the radius of the spherical area of interest.
 
         Returns:
-            Neuron: Neuron dataclass containing the recovered trace.
+            tuple: Tuple containing (1) the slices of the bounding box of the
+              region in a Z x Y x X frame and (2) a boolean mask of the region
+              within that bounding box.
         """
-        neuron.i_fname = '{}{}'.format(neuron.img_fname.split(RIVULET_2_TREE_IMG_EXT)[0], '.npy')
+        soma_centroid = np.divide(neuron.swc._data[0, 2:5], hyperstack.voxel_size)  # XYZ of soma in cleaned SWC
+
+        # TODO: Nice implementation for scaling section radii based on voxel size
+        # This would likely involve figuring out where the line spanning from childID to parentID is pointing to
+        # correctly scale the radius with an appropriate weight for each direction
+        radius = neuron.swc._data[0, 5] / np.min(hyperstack.voxel_size) * window_scale
+        print(f'Neuron ({neuron.num})\t --Getting intensity trace from a radius {radius:.0f} px from the soma.')
+
+        # Dilate a single voxel with the ball kernel to get the shape of the region
+        r = int(radius)
+        ball = sitk.Image((2 * r + 1,) * 3, sitk.sitkUInt8)
+        ball[r, r, r] = 1
+        bin_dil_filt = sitk.BinaryDilateImageFilter()
+        bin_dil_filt.SetKernelRadius(r)
+        bin_dil_filt.SetKernelType(sitk.sitkBall)
+        ball = sitk.GetArrayFromImage(bin_dil_filt.Execute(ball)) > 0
+
+        # Place it on the voxel of the soma, cropped to the frame
+        x_size, y_size, z_size, _ = hyperstack.GetSize()
+        center = np.floor(soma_centroid[::-1] + 0.5).astype(int)  # ZYX
+        lower, upper = center - r, center + r + 1
+        clip_lower = np.maximum(lower, 0)
+        clip_upper = np.minimum(upper, (z_size, y_size, x_size))
+        bbox = tuple(slice(lo, hi) for lo, hi in zip(clip_lower, clip_upper))
+        mask = ball[tuple(slice(lo, hi) for lo, hi in zip(clip_lower - lower, clip_upper - lower))]
+        return bbox, mask
 
-        if os.path.exists(neuron.i_fname) and not force_redo:
-            neuron.intensities = np.load(neuron.i_fname)
-            print(f'Neuron ({neuron.num})\t --Loaded trace from disk')
+    @staticmethod
+    def _get_intensities(hyperstack: HyperStack, rois: list, frames: range = None):
+        """Gets the mean intensity of regions of interest over the frames.
 
-        else:
-            soma_centroid = np.divide(neuron.swc._data[0, 2:5], hyperstack.voxel_size)  # XYZ of soma in cleaned SWC
+        Reads each frame once and only the bounding boxes of the regions in
+        it.
 
-            # TODO: Nice implementation for scaling section radii based on voxel size
-            # This would likely involve figuring out where the line spanning from childID to parentID is pointing to
-            # correctly scale the radius with an appropriate weight for each direction
-            radius = neuron.swc._data[0, 5] / np.min(hyperstack.voxel_size) * window_scale
-            print(f'Neuron ({neuron.num})\t --Getting intensity trace from a radius {radius:.0f} px from the soma.')
+        Args:
+            hyperstack (HyperStack): The original image.
+            rois (list): Regions of interest as returned by ``_soma_roi``.
+            frames (range): The frames to read. All frames when unspecified.
 
-            x_size, y_size, z_size, frames = hyperstack.GetSize()
+        Returns:
+            np.ndarray: Array of regions by frames with the mean intensity
+              of each region in each frame.
+        """
+        if frames is None:
+            frames = range(hyperstack.GetSize()[3])
+        intensities = np.zeros((len(rois), len(frames)))
+        for jj, ii in enumerate(frames):
+            volume = hyperstack.frame(ii)
+            for kk, (bbox, mask) in enumerate(rois):
+                intensities[kk, jj] = volume[bbox][mask].mean(dtype='float64')
+        return intensities
 
-            mask = sitk.Image((x_size, y_size, z_size), hyperstack.GetPixelID())
+    @staticmethod
+    def _set_intensities(neuron: Neuron, hyperstack: HyperStack, intensities: np.ndarray):
+        """Stores the intensity trace of a neuron with its timestamps.
+        """
+        frames = intensities.size
+        times = np.linspace(0, frames * hyperstack.period, num=frames)
 
-            idx = mask.TransformPhysicalPointToIndex(soma_centroid)
-            mask[idx] = 1
+        neuron.intensities = np.array([intensities, times])
+        np.save(neuron.i_fname, neuron.intensities)
 
-            bin_dil_filt = sitk.BinaryDilateImageFilter()
-            bin_dil_filt.SetKernelRadius(int(radius))
-            bin_dil_filt.SetKernelType(sitk.sitkBall)
-            mask = bin_dil_filt.Execute(mask)
+    def _get_voltage_all(self, hyperstack=None, pool=None, window_scale: float = 5):
+        """Gets the votlage trace from all cells.
 
-            intensities = np.zeros(frames)
+        Retrieves the change in intensity over each frame around the soma of
+        each neuron, as the average intensity from a spherical region with a
+        radius close to that of the soma. Traces that are not on disk yet are
+        retrieved in a single pass over the frames of the recording. When
+        asynchronous, the frames are split over worker processes that read
+        the recording in place, so only its name and the regions of interest
+        are sent to each worker.
 
-            for ii in range(frames):
-                volume = hyperstack[:, :, :, ii]
-                volume = volume * mask
-                intensities[ii] = np.mean(sitk.GetArrayFromImage(volume))
+        Args:
+            hyperstack (HyperStack): The original image, shared with
+              ``HyperStack.share`` before ``pool`` was started. Opened from
+              file when unspecified.
+            pool (Pool): Running pool of worker processes to reuse. A new
+              pool is started when unspecified.
+            window_scale (float): Scale factor for increasing or descreasing
+              the radius of the spherical area of interest.
+        """
+        if hyperstack is None:
+            hyperstack = HyperStack().from_file(self.filename, lazy=True)
 
-            times = np.linspace(0, frames * hyperstack.period, num=frames)
+        to_trace = []
+        for neuron in self.neurons:
+            neuron.i_fname = '{}{}'.format(neuron.img_fname.split(RIVULET_2_TREE_IMG_EXT)[0], '.npy')
+            if os.path.exists(neuron.i_fname) and not self.overwrite_cache:
+                neuron.intensities = np.load(neuron.i_fname)
+                print(f'Neuron ({neuron.num})\t --Loaded trace from disk')
+            else:
+                to_trace.append(neuron)
+
+        if to_trace:
+            rois = [self._soma_roi(neuron, hyperstack, window_scale) for neuron in to_trace]
+            frames = hyperstack.GetSize()[3]
+            if self.asynchronous and frames > 1:
+                # Workers attach to the recording by name and each reads a chunk of the frames
+                processes = max(min(os.cpu_count() - 1, frames), 1)
+                shared = hyperstack.share()
+                try:
+                    with (Pool(processes=processes) if pool is None else nullcontext(pool)) as workers:
+                        result_buffers = []
+                        for chunk in np.array_split(np.arange(frames), processes):
+                            result = workers.apply_async(self._get_intensities,
+                                                         (shared, rois, range(chunk[0], chunk[-1] + 1)))
+                            result_buffers.append(result)
+
+                        intensities = np.hstack([result.get() for result in result_buffers])
+                finally:
+                    if shared is not hyperstack:
+                        shared.close()
+            else:
+                intensities = self._get_intensities(hyperstack, rois)
+            for neuron, trace in zip(to_trace, intensities):
+                self._set_intensities(neuron, hyperstack, trace)
 
-            neuron.intensities = np.array([intensities, times])
-            np.save(neuron.i_fname, neuron.intensities)
+    def _run_pipeline(self, neurons):
+        """Reconstructs each neuron in turn and gets all voltage traces.
 
-        return neuron
+        Each neuron moves from its segmented image to reconstruction and
+        saving the SWC as soon as a worker is free, without waiting for the
+        other neurons to be segmented. When asynchronous, a new neuron is only
+        taken from ``neurons`` when a worker is free, so giving the largest
+        neurons first keeps the slowest ones from finishing last. The voltage
+        traces of all neurons are then retrieved in one pass over the frames
+        of the recording, split over the same pool of worker processes.
 
-    def _get_voltage_all(self):
-        """Gets the votlage trace from all cells.
+        Args:
+            neurons: Iterable of Neuron dataclasses, largest first. Neurons
+              without an image on disk yet are stored first.
         """
-        hyperstack = HyperStack().from_file(self.filename)
+        # Shared before the pool starts, see HyperStack.share
+        hyperstack = HyperStack().from_file(self.filename, lazy=True).share()
+        trace_args = (self.threshold, self._speed, self.quality, self.overwrite_cache, self.hyperstack.voxel_size)
+
+        done = {}
+        try:
+            if self.asynchronous:
+                processes = max(os.cpu_count() - 1, 1)
+                finished = queue.Queue()
+                with Pool(processes=processes) as pool:
+                    neurons = iter(neurons)
+                    running = 0
+                    while True:
+                        while running < processes:  # Keep the workers busy with new neurons
+                            neuron = next(neurons, None)
+                            if neuron is None:
+                                break
+                            if neuron.img_fname is None:
+                                self._write_neuron_to_file(neuron)
+                            pool.apply_async(self._trace_single, (neuron, *trace_args),
+                                             callback=finished.put,
+                                             error_callback=finished.put)
+                            running += 1
+
+                        if running == 0:
+                            break
+
+                        result = finished.get()
+                        running -= 1
+                        if isinstance(result, BaseException):
+                            raise result
+                        done[result.num] = result
+
+                    self.neurons = [done[num] for num in sorted(done)]
+                    self._get_voltage_all(hyperstack, pool)
+            else:
+                for neuron in neurons:
+                    if neuron.img_fname is None:
+                        self._write_neuron_to_file(neuron)
+                    neuron = self._trace_single(neuron, *trace_args)
+                    done[neuron.num] = neuron
 
-        if self.asynchronous:
-            with Pool(processes=os.cpu_count() - 1) as pool:
-                result_buffers = []
-                for neuron in self.neurons:
-                    result = pool.apply_async(self._get_voltage_single,
-                                              (neuron, hyperstack, self.overwrite_cache))
-                    result_buffers.append(result)
+                self.neurons = [done[num] for num in sorted(done)]
+                self._get_voltage_all(hyperstack)
+        finally:
+            hyperstack.close()
 
-                results = [result.get() for result in result_buffers]
-        else:
-            results = []
-            for neuron in self.neurons:
-                results.append(self._get_voltage_single(neuron, hyperstack, self.overwrite_cache))
-
-        self.neurons = results
+        print(f'Processed {len(self.neurons)} neurons.')
 
     def execute(self):
         """Start the tracer.
 
-        Initiates segmetnation, reconstruction, and voltage retrieval.
+        Initiates segmetnation, reconstruction, and voltage retrieval. Each
+        neuron goes through these as soon as its inputs are ready, see
+        ``_run_pipeline``.
         """
 
         if self.threshold is not None and not isinstance(self.threshold, (int, float, str)):
@@ -900,15 +1167,12 @@ class Tracer():
         if self._must_read_segmentation_file():
             self._read_segmentation_from_file()
             # self._read_neurons_from_file()
+            neurons = sorted(self.neurons, key=lambda neuron: neuron.img.GetNumberOfPixels(), reverse=True)
         else:
-            self._segment()
-            self._write_segmentation_to_file()
+            neurons = self._segment()
             # self._write_neurons_to_file()
 
-        self._trace_all()
-        # self.get_voltage(file, results, asynchronous=False)
-
-        self._get_voltage_all()
+        self._run_pipeline(neurons)
 
         self._plot()
 
@@ -2,12 +2,14 @@ import copy
 import math
 import numpy as np
 import time
-from collections import Counter
 from random import gauss
 from random import random, randrange
 from itertools import cycle
 
 import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
 import matplotlib.pyplot as plt
 
@@ -47,10 +49,25 @@ LABELS = {-1 : 'Root',
 
 COLORS = list(plt.rcParams['axes.prop_cycle'].by_key()['color'])
 
+# A swc assigned with at least this many nodes gets a KD-tree over them on its
+# first match, the nodes appended later go to hash grids
+INDEX_BULK = 4096
+# Nearest nodes asked from the KD-tree, to find the first one on ties
+INDEX_K = 4
+# Edges of the cells of the hash grids over the node positions, finest first
+GRID_CELLS = (8., 64., 512.)
+# Cells are hashed to (i << 42) + (j << 21) + k, so the keys of the 3 x 3 x 3
+# block of cells around a cell are its own key plus these. Cells further out
+# than GRID_LIMIT are clamped, which keeps neighbouring cells neighbours
+GRID_LIMIT = 1 << 20
+GRID_BLOCK = [(i << 42) + (j << 21) + k for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]
+
 
 class SWC(object):
 
     def __init__(self, soma=None):
+        # The nodes are the first _n rows of _buffer, which doubles in
+        # capacity when full. Read and assign them through _data
         self._data = np.zeros((1, 8))
 
         ########## PLOTTING PARAMETERS ##########
@@ -62,8 +79,41 @@ class SWC(object):
             self._data[0, :] = np.asarray([0, 1, soma.centroid[0], soma.centroid[
                 1], soma.centroid[2], soma.radius, -1, 1])
 
+    @property
+    def _data(self):
+        return self._buffer[:self._n]
+
+    @_data.setter
+    def _data(self, data):
+        self._buffer = data
+        self._n = len(data)
+        self._next_id = None  # The largest id + 1, found when first needed
+        self._reset_index()
+
+    def _reset_index(self):
+        # KD-tree over the first _nbase nodes, None until the first match.
+        # Hash grids over the positions of the nodes after them up to
+        # _nindexed, the nodes appended since are added on the next match
+        self._base = None
+        self._nbase = None
+        self._index = NodeGrid()
+        self._nindexed = 0
+
     def add(self, swc_nodes):
-        np.vstack((self._data, swc_nodes))
+        '''
+        Append N x 8 swc nodes, in amortised constant time per node
+        '''
+        swc_nodes = np.atleast_2d(swc_nodes)
+        n = self._n + swc_nodes.shape[0]
+        if n > self._buffer.shape[0]:
+            buffer = np.empty((max(n, 2 * self._buffer.shape[0]), self._buffer.shape[1]))
+            buffer[:self._n] = self._buffer[:self._n]
+            self._buffer = buffer
+        if self._next_id is None:
+            self._next_id = self._data[:, 0].max() + 1 if self._n > 0 else 0
+        self._buffer[self._n:n] = swc_nodes
+        self._n = n
+        self._next_id = max(self._next_id, swc_nodes[:, 0].max() + 1)
 
     def add_branch(self, branch, pidx=None, random_color=False, label=False):
         '''
@@ -74,8 +124,9 @@ class SWC(object):
             rand_node_type = randrange(256)
 
         new_branch = np.zeros((len(branch.pts), 8))
-        id_start = 1 if self._data.shape[
-                            0] == 1 else self._data[:, 0].max() + 1
+        if self._next_id is None:
+            self._next_id = self._data[:, 0].max() + 1
+        id_start = 1 if self._n == 1 else self._next_id
 
         for i in range(len(branch.pts)):
             p, r, c = branch.pts[i], branch.radius[i], branch.conf[i]
@@ -105,95 +156,65 @@ class SWC(object):
         if matched and self._data[minidx, 6] == -2:
             self._data[minidx, 6] = tail[0]
 
-        self._data = np.vstack((self._data, new_branch))
+        self.add(new_branch)
+
+    def _update_index(self):
+        '''
+        Build the KD-tree over a large assigned swc on its first match and
+        add the nodes appended since the last match to the hash grids
+        '''
+        if self._nbase is None:
+            self._nbase = self._nindexed = self._n if self._n >= INDEX_BULK else 0
+            if self._nbase:
+                self._base = cKDTree(self._data[:, 2:5])
+        if self._nindexed < self._n:
+            self._index.add(self._data[self._nindexed:, 2:5], self._nindexed)
+            self._nindexed = self._n
 
     def clean(self):
         """Cleans the SWC file to allow for import into NetPyNE.
 
         Reassings TypeIDs and rearranges tree structure to have SampleIDs
         increase with distance from the soma (rather than decrease, as in
-        unmodified Rivuletpy output).
+        unmodified Rivuletpy output). SampleIDs are assigned in depth-first
+        order from the root, visiting children in the order of their rows.
+        Attractors (nodes that are their own parent) other than the root and
+        nodes that cannot be reached from the root are dropped.
         """
 
         sec_list = [1, 2, 3, 4] # Valid TypeIDs for NetPYne
-        nanint = np.zeros(1)
-        nanint[0] = np.nan
-        nanint = nanint.astype(int)[0]
 
         SampleIDs = self._data[:, 0].astype(int)  # SampleID
-
-        swc_dict, swc_children, swc_ends, swc_indices = self.swc_to_dicts()
-
-        # Map from old SampleIDs to NewSampleIDs. Index is old SampleID
-        mapper = np.full(np.amax(SampleIDs)+1, np.NaN, dtype=int)
-
-        if -1 in swc_children.keys():
-            ROOT_ID = swc_children[-1][0] # ParentID of root is -1
-        elif any([key in value for key, value in swc_children.items()]): # Search for attractors
-            ii = np.argmax([key in value for key, value in swc_children.items()])
-            ROOT_ID = int(list(swc_children.keys())[ii])
+        ParentIDs = self._data[:, 6].astype(int)  # ParentID
+        nnode = SampleIDs.size
+        parent_index = self._parent_index()
+        attractor = SampleIDs == ParentIDs
+
+        if (ParentIDs == -1).any():
+            root_index = np.argmax(ParentIDs == -1)  # ParentID of root is -1
+        elif attractor.any():  # The attractor that first appears as a parent
+            _, first_child = np.unique(ParentIDs, return_index=True)
+            first_child = first_child[np.searchsorted(np.unique(ParentIDs), SampleIDs[attractor])]
+            root_index = np.flatnonzero(attractor)[np.argmin(first_child)]
         else:
-            ROOT_ID = 0
-
-        ID = 0 # Start ID
-
-        # Delete non-root attractors
-        root_index = np.argmax(SampleIDs == ROOT_ID)
-        attractor_ii = []
-        for ii, (SampleID, ParentID) in enumerate(self._data[:, [0, 6]]):
-            if SampleID == ParentID:
-                attractor_ii.append(ii)
-        attractor_ii = np.array(attractor_ii)
-        attractor_ii = attractor_ii[attractor_ii != root_index]
-        for ii in attractor_ii:
-            self._data = np.delete(self._data, ii, axis=0)
-
-        def assign_ID(current_node):
-            nonlocal ID
-            nonlocal mapper
-            nonlocal swc_ends
-
-            ID += 1
-            new_ID = ID
-
-            mapper[current_node] = new_ID
-
-
-            if current_node in swc_ends:
-                pass
-            else:
-                for child_node in swc_children[current_node]:
-                    if child_node == current_node:
-                        continue  # Avoid attractors, e.g. the root
-                    else:
-                        assign_ID(child_node)
-
-        assign_ID(ROOT_ID)
-
-        assert (np.unique(mapper[mapper != nanint])
-                == np.sort(mapper[mapper != nanint])).all(), 'Incorrect mapper, doubly mapped indecies.'
-
-        # index_mapper = np.full_like(mapper, np.NaN)
-        # for index, SampleID in enumerate(SampleIDs):
-        #     index_mapper[SampleID] = index
-
-        new_data = np.zeros((np.amax(mapper), self._data.shape[1]))
-        for data_line, old_SampleID in zip(self._data, SampleIDs):
-
-            new_SampleID = mapper[old_SampleID]
-            new_ParentID = mapper[int(data_line[6])]
-
-            if new_SampleID == 473.0:
-                pass
-
-            new_data[new_SampleID - 1, :] = data_line
-            new_data[new_SampleID - 1, 0] = new_SampleID
-            new_data[new_SampleID - 1, 6] = new_ParentID
-
+            root_index = np.argmax(SampleIDs == 0)
+
+        # Edges from the row of each parent to the rows of its children
+        child = np.flatnonzero((parent_index >= 0) & ~attractor)
+        tree = csr_matrix((np.ones(child.size), (parent_index[child], child)),
+                          shape=(nnode, nnode))
+        order = csgraph.depth_first_order(tree, root_index, directed=True,
+                                          return_predecessors=False)
+
+        # Map from rows to NewSampleIDs, 0 for the rows left out
+        mapper = np.zeros(nnode + 1, dtype=int)
+        mapper[order] = np.arange(1, order.size + 1)
+
+        new_data = self._data[order].copy()
+        new_data[:, 0] = np.arange(1, order.size + 1)
+        new_data[:, 6] = mapper[parent_index[order]]
         new_data[np.logical_not(np.isin(new_data[:, 1], sec_list)), 1] = 3 # All non-valid TypeIDs are converted to 3 (dendrite)
 
-
-
         self._data = new_data
 
         # Set ParentID of point 0 to -1 (Root).
@@ -234,79 +255,65 @@ class SWC(object):
         # This would likely involve figuring out where the line spanning from childID to parentID is pointing to
         # correctly scale the radius with an appropriate weight for each direction
         self._data[:, 5] = self._data[:, 5] * np.mean(factors)
+        self._reset_index()  # Positions were changed in place
 
 
+    def _parent_index(self):
+        '''
+        The row of the parent of each node, -1 where it is not in the swc
+        '''
+        ids = self._data[:, 0].astype(int)
+        pids = self._data[:, 6].astype(int)
+        index = np.full(max(ids.max(), pids.max()) + 2, -1)  # Row of every id
+        index[ids] = np.arange(ids.size)
+        return np.where(pids >= 0, index[pids], -1)
+
     def _prune_leaves(self):
-        # Find all the leaves
-        childctr = Counter(self._data[:, 6])
-        leafidlist = [id for id in self._data[:, 0]
-                      if id not in self._data[:, 6]]
-        id2dump = []
+        '''
+        Remove the leaf branches, followed from each leaf up to the last node
+        before a fork, that are not longer than 4 times the mean radius
+        '''
+        parent = self._parent_index()
+        nchild = np.bincount(parent[parent >= 0], minlength=parent.size)
         rmean = self._data[:, 5].mean()  # Mean radius
 
-        for leafid in leafidlist:  # Iterate each leaf node
-            nodeid = leafid
-            branch = []
-            while True:  # Get the leaf branch out
-                node = self._data[self._data[:, 0] == nodeid, :].flatten()
-                if node.size == 0:
-                    break
-                branch.append(node)
-                parentid = node[6]
-                if childctr[parentid] != 1:
-                    break  # merged / unconnected
-                nodeid = parentid
-
-            # Get the length of the leaf
-            leaflen = sum([
-                np.linalg.norm(branch[i][2:5] - branch[i - 1][2:5])
-                for i in range(1, len(branch))
-            ])
-
-            # Prune if the leave is too short or
-            # the confidence of the leave branch is too low
-            if leaflen <= 4 * rmean:
-                id2dump.extend([node[0] for node in branch])
-
-        # Only keep the swc nodes not in the dump id list
-        cutted = []
-        for nodeidx in range(self._data.shape[0]):
-            if self._data[nodeidx, 0] not in id2dump:
-                cutted.append(self._data[nodeidx, :])
-
-        cutted = np.squeeze(np.dstack(cutted)).T
-        self._data = cutted
+        # A leaf branch carries on to the parent while it has no other child.
+        # Cutting the swc at every other edge leaves the leaf branches and the
+        # paths between forks as connected components
+        up = np.flatnonzero(parent >= 0)
+        up = up[nchild[parent[up]] == 1]
+        chains = csr_matrix((np.ones(up.size), (up, parent[up])),
+                            shape=(parent.size, parent.size))
+        _, label = csgraph.connected_components(chains, directed=False)
+
+        # Get the length of each leaf branch
+        steplen = np.linalg.norm(self._data[up, 2:5] - self._data[parent[up], 2:5], axis=1)
+        leaflen = np.bincount(label[up], weights=steplen, minlength=label.max() + 1)
+        isleaf = np.bincount(label[nchild == 0], minlength=label.max() + 1) > 0
+
+        # Prune if the leave is too short
+        dump = isleaf & (leaflen <= 4 * rmean)
+        self._data = np.squeeze(self._data[~dump[label]])
 
     def _prune_unreached(self):
         '''
-        Only keep the largest connected component
+        Only keep the largest connected component. Of equally large ones,
+        the one holding the earliest node is kept
         '''
-        swcdict = {}
-        for n in self._data:  # Hash all the swc nodes
-            swcdict[n[0]] = Node(n[0])
-
         # Try to join all the unconnected branches at first
-        for i, n in enumerate(self._data):
-            if n[6] not in swcdict:
-                # Try to match it
-                matched, midx = self.match(n[2:5], n[5])
-                if matched:
-                    self._data[i, 6] = self._data[midx, 0]
-
-        # Add mutual links for all nodes
-        for n in self._data:
-            id = n[0]
-            pid = n[6]
-            if pid >= 0:
-                swcdict[id].add_link(swcdict[pid])
-
-        groups = connected_components(set(swcdict.values()))
-        lenlist = [len(g) for g in groups]
-        maxidx = lenlist.index(max(lenlist))
-        set2keep = groups[maxidx]
-        id2keep = [n.id for n in set2keep]
-        self._data = self._data[
-                     np.in1d(self._data[:, 0], np.asarray(id2keep)), :]
+        for i in np.flatnonzero(~np.isin(self._data[:, 6], self._data[:, 0])):
+            # Try to match it
+            matched, midx = self.match(self._data[i, 2:5], self._data[i, 5])
+            if matched:
+                self._data[i, 6] = self._data[midx, 0]
+
+        # Link every node to its parent
+        parent = self._parent_index()
+        child = np.flatnonzero(parent >= 0)
+        links = csr_matrix((np.ones(child.size), (child, parent[child])),
+                           shape=(parent.size, parent.size))
+        _, label = csgraph.connected_components(links, directed=False)
+        self._data = self._data[label == np.bincount(label).argmax(), :]
 
     def prune(self):
         self._prune_unreached()
@@ -314,11 +321,12 @@ class SWC(object):
 
     def reset(self, crop_region, zoom_factor):
         '''
-        Pad and rescale swc back to the original space
+        Pad and rescale swc back to the original space. zoom_factor is
+        either one factor or one per axis
         '''
 
         tswc = self._data.copy()
-        if zoom_factor != 1.:  # Pad the swc back to original space
+        if np.any(np.asarray(zoom_factor) != 1.):  # Pad the swc back to original space
             tswc[:, 2:5] *= 1. / zoom_factor
 
         # Pad the swc back
@@ -335,11 +343,24 @@ class SWC(object):
         Find the closest ground truth node
         '''
 
-        nodes = self._data[:, 2:5]
-        distlist = np.squeeze(cdist(pos.reshape(1, 3), nodes))
-        if distlist.size == 0:
+        if self._data.shape[0] == 0:
             return False, -2
-        minidx = distlist.argmin()
+        self._update_index()
+
+        # The closest of the appended nodes
+        minidx = self._index.closest(self._data[:, 2:5], pos)
+        if minidx is None and self._nbase < self._n:  # Farther than the coarsest cells
+            minidx = self._nbase + cdist(pos.reshape(1, 3), self._data[self._nbase:, 2:5])[0].argmin()
+
+        # The closest of the assigned nodes, all of them when they tie
+        if self._base is not None:
+            dist, idx = self._base.query(pos, k=min(INDEX_K, self._nbase))
+            if np.size(dist) == INDEX_K and dist[-1] == dist[0]:
+                idx = self._base.query_ball_point(pos, dist[0])
+            candidates = np.sort(np.atleast_1d(idx))
+            if minidx is not None:  # Rows after all of the assigned nodes
+                candidates = np.append(candidates, minidx)
+            minidx = candidates[cdist(pos.reshape(1, 3), self._data[candidates, 2:5])[0].argmin()]
         minnode = self._data[minidx, 2:5]
 
         # See if either of them can cover each other with a ball of their own
@@ -715,6 +736,59 @@ class SWC(object):
         self._data = t_data
 
 
+class NodeGrid(object):
+    '''
+    Hash grids over node positions with the cells of GRID_CELLS, for the
+    closest node queries of SWC.match. Nodes are only ever appended. Each
+    cell keeps the rows of its nodes as a few arrays, merged like the carries
+    of a binary counter as nodes come in
+    '''
+
+    def __init__(self):
+        self._cells = [{} for _ in GRID_CELLS]
+
+    def add(self, pos, start):
+        '''
+        Add the nodes at pos, N x 3, as rows start to start + N
+        '''
+        rows = np.arange(start, start + len(pos))
+        for size, cells in zip(GRID_CELLS, self._cells):
+            ijk = np.clip(np.floor(pos / size), -GRID_LIMIT, GRID_LIMIT).astype('int64')
+            keys = (ijk[:, 0] << 42) + (ijk[:, 1] << 21) + ijk[:, 2]
+            order = np.argsort(keys)
+            keys, members = keys[order], rows[order]
+            bounds = (np.flatnonzero(keys[1:] != keys[:-1]) + 1).tolist()
+            for key, lo, hi in zip(keys[[0] + bounds].tolist(), [0] + bounds, bounds + [len(keys)]):
+                chunks = cells.get(key)
+                if chunks is None:
+                    cells[key] = [members[lo:hi]]
+                    continue
+                chunks.append(members[lo:hi])
+                while len(chunks) > 1 and len(chunks[-2]) <= len(chunks[-1]):
+                    chunks.append(np.concatenate((chunks.pop(-2), chunks.pop())))
+
+    def closest(self, data, pos):
+        '''
+        The row of data, N x 3, closest to pos, the first one on ties. None
+        when it is not within the cells around pos of the coarsest grid
+        '''
+        for size, cells in zip(GRID_CELLS, self._cells):
+            i, j, k = (min(max(math.floor(p / size), -GRID_LIMIT), GRID_LIMIT) for p in pos)
+            key = (i << 42) + (j << 21) + k
+            chunks = [chunk for offset in GRID_BLOCK for chunk in cells.get(key + offset, ())]
+            if not chunks:
+                continue
+            # Every row is kept under one key, so none is repeated
+            rows = np.concatenate(chunks)
+            dist = cdist(pos.reshape(1, 3), data[rows])[0]
+            mindist = dist.min()
+            # Nodes outside the block of cells around pos are at least a
+            # cell away
+            if mindist < size:
+                return rows[dist == mindist].min()
+        return None
+
+
 def get_distance_to_boundary(pt, vec, b):
     temp_pt = pt.copy()
     while (True):
@@ -770,80 +844,6 @@ def get_subtree_nodeids(swc, node):
     return subtreeids
 
 
-class Node(object):
-
-    def __init__(self, id):
-        self.__id = id
-        self.__links = set()
-
-    @property
-    def id(self):
-        return self.__id
-
-    @property
-    def links(self):
-        return set(self.__links)
-
-    def add_link(self, other):
-        self.__links.add(other)
-        other.__links.add(self)
-
-
-def connected_components(nodes):
-    '''
-    The function to look for connected components.
-    Reference: https://breakingcode.wordpress.com/2013/04/08/finding-connected-components-in-a-graph/
-    '''
-
-    # List of connected components found. The order is random.
-    result = []
-
-    # Make a copy of the set, so we can modify it.
-    nodes = set(nodes)
-
-    # Iterate while we still have nodes to process.
-    while nodes:
-
-        # Get a random node and remove it from the global set.
-        n = nodes.pop()
-
-        # This set will contain the next group of nodes
-        # connected to each other.
-        group = {n}
-
-        # Build a queue with this node in it.
-        queue = [n]
-
-        # Iterate the queue.
-        # When it's empty, we finished visiting a group of connected nodes.
-        while queue:
-            # Consume the next item from the queue.
-            n = queue.pop(0)
-
-            # Fetch the neighbors.
-            neighbors = n.links
-
-            # Remove the neighbors we already visited.
-            neighbors.difference_update(group)
-
-            # Remove the remaining nodes from the global set.
-            nodes.difference_update(neighbors)
-
-            # Add them to the group of connected nodes.
-            group.update(neighbors)
-
-            # Add them to the queue, so we visit them in the next iterations.
-            queue.extend(neighbors)
-
-        # Add the group to the list of groups.
-        result.append(group)
-
-    # Return the list of groups.
-    return result
-
-
-
-
 def clean(filenames):
     """Programming interface for cleaning SWCs on disk.
 
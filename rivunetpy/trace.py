@@ -1,16 +1,38 @@
 import math
+import sys
+import tempfile
+import warnings
 from tqdm import tqdm
 import numpy as np
 import skfmm
+import SimpleITK as sitk
 
-from scipy.interpolate import RegularGridInterpolator
+from scipy.ndimage import find_objects, minimum_filter
 from scipy.ndimage.morphology import binary_dilation
 from skimage.morphology import skeletonize_3d
 
 import msfm
+try:
+    import resource
+except ImportError:  # Not available on Windows, no memory report there
+    resource = None
+try:
+    import r2backtrack
+except ImportError:  # The compiled back-tracking engine is optional
+    r2backtrack = None
 from rivunetpy.soma import Soma
 from rivunetpy.swc import SWC
 
+# Reasons for one back-tracking iteration to stop.
+# Keep in sync with rivunetpy/backtrack/_backtrack.h
+STOP_OUT_OF_BOUND = 1
+STOP_GAP = 2
+STOP_SOMA = 3
+STOP_STUCK = 4
+STOP_LOW_CONF = 5
+STOP_MERGED = 6  # Touched a traced branch and matched one of its nodes
+STOP_TOUCHED = 7  # Touched the traced area without a node to merge into
+
 
 class Tracer(object):
 
@@ -27,12 +49,13 @@ class Tracer(object):
 class R2Tracer(Tracer):
 
     def __init__(self, quality=False, silent=False, speed=False,
-                 clean=False, non_stop=False, skeletonize=False):
+                 clean=False, non_stop=False, skeletonize=False, native=True,
+                 debug=False, grad_margin=None, march_margin=None, scratch=None,
+                 pyramid=1, tube_margin=3):
         self._quality = quality
         self._bimg = None
         self._dilated_bimg = None
         self._bsum = 0  # For counting the covered foreground
-        self._bb = None  # For making the erasing contour
         self._t = None  # Original timemap
         self._tt = None  # The copy of the timemap
         self._grad = None
@@ -52,18 +75,58 @@ class R2Tracer(Tracer):
         self._non_stop = non_stop
         self.skeletonize = skeletonize
         self._eps = 1e-5
+        # Whether to back-track with the compiled engine when it is built
+        self._native = native and r2backtrack is not None
+        # Cross-check the incremental coverage against a full-volume scan
+        self._debug = debug
+        # The gradient is only computed this many voxels around the
+        # foreground, None for the whole volume. Back-tracking stalls where
+        # it steps out of that band
+        self._grad_margin = grad_margin
+        # The fast marching only expands this many voxels around the
+        # foreground and stops once it is all reached, None for the whole volume.
+        # Low quality only: msfm is slower and traces worse when restricted
+        if quality and march_margin is not None:
+            warnings.warn('march_margin only applies to the low quality fast marching, ignoring it')
+            march_margin = None
+        self._march_margin = march_margin
+        # Directory to keep the working volumes in as memory-mapped files,
+        # paged in on demand while back-tracking. None keeps them in RAM
+        self._scratch = scratch
+        # The real-valued working volumes are kept as float32 when memory-mapped
+        self._float = 'float64' if scratch is None else 'float32'
+        # (stage, peak RSS in MB) after each stage of the last trace
+        self.memory_report = []
+        # Trace the image downsampled this many times in X and Y first, then
+        # trace at full resolution only inside a tube around the coarse
+        # trace, tube_margin voxels wider than its radius. 1 for no pyramid.
+        # The tube is a single mask over the whole trace rather than one per
+        # branch, so the fine trace back-tracks as usual within it
+        self._pyramid = pyramid
+        self._tube_margin = tube_margin
+        self._tube = None
+        # Grid over the nodes of the swc being back-tracked natively
+        self._node_grid = None
+        self._node_grid_swc = None
 
     def trace(self, img, threshold):
         '''
         The main entry for Rivulet2
         '''
         self.img = img
-        self._bimg = (img > threshold).astype('int')  # Segment image
+        self._bimg = (img > threshold).astype('uint8')  # Segment image
+        self.memory_report = []
+        self._tube = None
+        if self._pyramid > 1:
+            self._tube = self._coarse_tube(img, threshold)
+            self._bimg &= self._tube
+            self._report_memory('coarse trace')
 
         if not self._silent:
             print('\t(1) --Detecting Soma...', end='')
         self._soma = Soma()
         self._soma.detect(self._bimg, not self._quality, self._silent)
+        self._report_memory('soma')
         self._prep()
 
         # Iterative Back Tracking with Erasing
@@ -71,8 +134,10 @@ class R2Tracer(Tracer):
             print('\t(5) --Start Backtracking with {} ...'.format(
                 'non stop' if self._non_stop else 'standard stopping criteria'))
         swc = self._iterative_backtrack()
+        self._report_memory('backtrack')
 
-        print(len(swc._data))
+        if not self._silent:
+            print(len(swc._data))
 
         if self._clean:
             swc.prune()
@@ -94,27 +159,90 @@ class R2Tracer(Tracer):
         if not self._silent:
             print('\t(2) --Boundary DT...')
         self._make_dt()
+        self._report_memory('dt')
         if not self._silent:
             print('\t(3) --Fast Marching with %s quality...' %
                   ('high' if self._quality else 'low'))
         self._fast_marching()
+        self._report_memory('fast marching')
         if not self._silent:
             print('\t(4) --Compute Gradients...')
         self._make_grad()
+        self._report_memory('gradient')
 
         # Make copy of the timemap
-        self._tt = self._t.copy()
+        self._tt = self._volume(self._float)
+        self._tt[...] = self._t
         self._tt[self._bimg <= 0] = -2
 
         # Label all voxels of soma with -3
         self._tt[self._soma.mask > 0] = -3
 
-        # For making a large tube to contain the last traced branch
-        self._bb = np.zeros(shape=self._tt.shape)
+        # The covered foreground is counted once here and then kept up to
+        # date by every erase
+        self._cover_ctr_new = self._count_covered()
+
+        # Source points are taken in descending order of travel time
+        self._sources = LazyArgmax(self._tt)
+
+        # The compiled engine estimates the radius on its own
+        self._radius = None if self._native else RadiusEstimator(self._bimg)
+        self._report_memory('prep')
+
+    def _coarse_tube(self, img, threshold):
+        '''
+        Trace the downsampled image and return the tube around the
+        trace at full resolution
+        '''
+        # Imported here as the segmentation module pulls in the plotting stack
+        from rivunetpy.utils.segmentation import downsample_img
+
+        # SimpleITK orders the axes Z, Y, X and downsample_img keeps Z.
+        # skfmm reads its inputs as C-contiguous
+        fine = sitk.GetImageFromArray(np.ascontiguousarray(img.T))
+        coarse = sitk.GetArrayFromImage(downsample_img(fine, 1. / self._pyramid))
+        coarse = np.ascontiguousarray(coarse.T)
+        tracer = R2Tracer(quality=self._quality, silent=True, speed=self._speed,
+                          clean=self._clean, non_stop=self._non_stop,
+                          skeletonize=self.skeletonize, native=self._native,
+                          grad_margin=self._grad_margin, march_margin=self._march_margin)
+        swc, _ = tracer.trace(coarse, threshold)
+
+        # downsample_img stretches the corners and keeps the centres aligned
+        shape, cshape = np.asarray(img.shape), np.asarray(coarse.shape)
+        # An axis of a single voxel is not scaled
+        zoom = np.where(shape > 1, (cshape - 1) / np.maximum(shape - 1, 1), 1.)
+        offset = (shape - cshape / zoom) / 2
+        swc.reset(np.stack((offset, offset), axis=1), zoom)
+        return path_tube(swc._data, img.shape, zoom[:2].min(), self._tube_margin)
+
+    def _volume(self, dtype, shape=None):
+        '''
+        An uninitialised working volume, memory-mapped to an anonymous file
+        in the scratch directory when there is one
+        '''
+        shape = self._bimg.shape if shape is None else shape
+        if self._scratch is None:
+            return np.empty(shape, dtype=dtype)
+        with tempfile.TemporaryFile(dir=self._scratch) as f:
+            # The mapping outlives the file, which is gone once it is unmapped
+            return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+
+    def _report_memory(self, stage):
+        rss = peak_rss()
+        if rss is not None:
+            self.memory_report.append((stage, rss))
+
+    def _count_covered(self):
+        # Full scan of the foreground voxels erased from the timemap
+        return np.logical_and(self._tt < 0, self._bimg > 0).sum()
 
     def _update_coverage(self):
-        self._cover_ctr_new = np.logical_and(
-            self._tt < 0, self._bimg > 0).sum()
+        if self._debug:
+            covered = self._count_covered()
+            assert covered == self._cover_ctr_new, \
+                'Incremental coverage {} != full scan {}'.format(
+                    self._cover_ctr_new, covered)
 
         self._coverage = self._cover_ctr_new / self._nforeground
 
@@ -123,182 +251,232 @@ class R2Tracer(Tracer):
 
     def _make_grad(self):
         # Get the gradient of the Time-crossing map
-        dx, dy, dz = self._dist_gradient()
-        standard_grid = (np.arange(self._t.shape[0]), np.arange(self._t.shape[1]),
-                         np.arange(self._t.shape[2]))
-        self._grad = (RegularGridInterpolator(standard_grid, dx),
-                      RegularGridInterpolator(standard_grid, dy),
-                      RegularGridInterpolator(standard_grid, dz))
+        mask = None
+        if self._grad_margin is not None:
+            mask = binary_dilation(self._bimg, iterations=self._grad_margin)
+        self._grad = GradientField.from_field(self._dist_gradient(mask))
+
+        # Back-tracking reads the timemap smoothed by the minimum of each
+        # 3x3x3 neighbourhood, as the descent used to write it back in place
+        self._t = minimum_filter(self._t, size=3, mode='constant',
+                                 cval=self._t.max(), output=self._volume(self._t.dtype))
 
     def _make_dt(self):
         '''
         Make the distance transform according to the speed type
         '''
+        self._dt = self._volume(self._float)
         if self._speed:
-            self._dt = self.img.astype(float)  # The input image
+            self._dt[...] = self.img  # The input image
             self._dt /= self._dt.max()
         else:
-            self._dt = skfmm.distance(self._bimg, dx=5e-2)  # Boundary DT
+            self._dt[...] = skfmm.distance(self._bimg, dx=5e-2)  # Boundary DT
 
     def _fast_marching(self):
         speed = self._make_speed()
+        # msfm traces worse when restricted, so the tube only trims its foreground
+        region = None if self._quality else self._tube
+        if self._march_margin is not None:
+            region = binary_dilation(self._bimg, iterations=self._march_margin) \
+                if self._march_margin > 0 else self._bimg > 0
+            if self._tube is not None:
+                region &= self._tube
 
         # # Fast Marching
         if self._quality:
             # if not self._silent: print('--MSFM...')
-            self._t = msfm.run(speed, self._bimg.copy().astype(
-                'int64'), self._soma.centroid, True, True)
-        else:
+            # The speed image and the binary image are used in place
+            self._t = msfm.run(speed, self._bimg, self._soma.centroid, True, True,
+                               region=region, out=self._volume('float64'))
+            if self._t.dtype != self._float:
+                # msfm only writes float64, the mapping of that copy is dropped here
+                t, self._t = self._t, self._volume(self._float)
+                self._t[...] = t
+                del t
+        elif region is None:
             # if not self._silent: print('--FM...')
             marchmap = np.ones(self._bimg.shape)
             marchmap[self._soma.centroid[0],
                      self._soma.centroid[1], self._soma.centroid[2]] = -1
-            self._t = skfmm.travel_time(marchmap, speed, dx=5e-3)
+            self._t = self._volume(self._float)
+            self._t[...] = skfmm.travel_time(marchmap, speed, dx=5e-3)
+        else:
+            self._t = self._volume(self._float)
+            self._t[...] = restricted_travel_time(speed, region, self._soma.centroid)
 
     def _make_speed(self):
-        F = self._dt ** 4
+        F = np.power(self._dt, 4, out=self._volume(self._dt.dtype))
         F[F <= 0] = 1e-10
         return F
 
-    def _dist_gradient(self):
-        fx = np.zeros(shape=self._t.shape)
-        fy = np.zeros(shape=self._t.shape)
-        fz = np.zeros(shape=self._t.shape)
-
-        J = np.zeros(shape=[s + 2 for s in self._t.shape])  # Padded Image
-        J[:, :, :] = self._t.max()
-        J[1:-1, 1:-1, 1:-1] = self._t
-        Ne = [[-1, -1, -1], [-1, -1, 0], [-1, -1, 1], [-1, 0, -1], [-1, 0, 0],
-              [-1, 0, 1], [-1, 1, -1], [-1, 1, 0], [-1, 1, 1], [0, -1, -1],
-              [0, -1, 0], [0, -1, 1], [0, 0, -1], [0, 0, 1], [0, 1, -1],
-              [0, 1, 0], [0, 1, 1], [1, -1, -1], [1, -1, 0], [1, -1, 1],
-              [1, 0, -1], [1, 0, 0], [1, 0, 1], [1, 1, -1], [1, 1, 0], [1, 1, 1]]
-
-        for n in Ne:
-            In = J[1 + n[0]:J.shape[0] - 1 + n[0],
-                   1 + n[1]:J.shape[1] - 1 + n[1],
-                   1 + n[2]:J.shape[2] - 1 + n[2]]
-            check = In < self._t
-            self._t[check] = In[check]
-            D = np.divide(n, np.linalg.norm(n))
-            fx[check] = D[0]
-            fy[check] = D[1]
-            fz[check] = D[2]
-        return -fx, -fy, -fz
+    def _dist_gradient(self, mask=None):
+        '''
+        The steepest descent direction of every voxel of the timemap towards
+        its 26 neighbours, as an interleaved float32 (X, Y, Z, 3) field.
+        Only the voxels in mask are computed when it is given, the rest are
+        left as zero vectors
+        '''
+        out = self._volume('float32', self._t.shape + (3,))
+        if r2backtrack is not None:
+            return r2backtrack.descent(self._t, mask, float(self._t.max()), out)
+        return descent_field(self._t, mask, self._t.max(), out)
 
     def _step(self, branch):
         # RK4 Walk for one step
         p = rk4(branch.pts[-1], self._grad, self._t, 1)
-        branch.update(p, self._bimg, self._dilated_bimg)
+        branch.update(p, self._bimg, self._dilated_bimg, self._radius)
 
     def _erase(self, branch):
         # Erase it from the timemap
-        for i in range(len(branch.pts)):
-            n = [math.floor(n) for n in branch.pts[i]]
-            r = 1 if branch.radius[i] < 1 else branch.radius[i]
-
-            # To make sure all the foreground voxels are included in bb
-            r = math.ceil(r * self._erase_ratio)
-            X, Y, Z = np.meshgrid(
-                constrain_range(n[0] - r, n[0] + r + 1, 0, self._tt.shape[0]),
-                constrain_range(n[1] - r, n[1] + r + 1, 0, self._tt.shape[1]),
-                constrain_range(n[2] - r, n[2] + r + 1, 0, self._tt.shape[2]))
-            self._bb[X, Y, Z] = 1
+        # Only the bounding box of the branch neighbourhood is touched
+        pts = np.floor(np.asarray(branch.pts, dtype='float64').reshape(-1, 3)).astype('int64')
+        r = np.asarray(branch.radius, dtype='float64')
+        r[r < 1] = 1
+
+        # To make sure all the foreground voxels are included in bb
+        r = np.ceil(r * self._erase_ratio).astype('int64')[:, None]
+        lo = np.maximum(pts - r, 0)
+        hi = np.minimum(pts + r + 1, self._tt.shape)
+        corner = lo.min(axis=0)
+        bb = stamp_boxes(lo - corner, hi - corner, hi.max(axis=0) - corner)
+        region = tuple(slice(c, c + s) for c, s in zip(corner, bb.shape))
 
         startidx, endidx = [math.floor(p) for p in branch.pts[0]], [
             math.floor(p) for p in branch.pts[-1]]
 
         if len(branch.pts) > 5 and self._t[endidx[0], endidx[1], endidx[2]] < self._t[
                 startidx[0], startidx[1], startidx[2]]:
+            t = self._t[region]
             erase_region = np.logical_and(
-                self._t[endidx[0], endidx[1], endidx[2]] <= self._t,
-                self._t <= self._t[startidx[0], startidx[1], startidx[2]])
-            erase_region = np.logical_and(self._bb, erase_region)
+                self._t[endidx[0], endidx[1], endidx[2]] <= t,
+                t <= self._t[startidx[0], startidx[1], startidx[2]])
+            erase_region = np.logical_and(bb, erase_region)
         else:
-            erase_region = self._bb.astype('bool')
+            erase_region = bb
 
-        if np.count_nonzero(erase_region) > 0:
-            self._tt[erase_region] = -2 if branch.low_conf else -1
-        self._bb.fill(0)
+        erase_region = tuple(idx + c for idx, c in zip(np.nonzero(erase_region), corner))
+        return self._erase_voxels(
+            erase_region, -2 if branch.low_conf else -1)
+
+    def _erase_voxels(self, region, value):
+        '''
+        Set the voxels of region (an index into the timemap) to a negative
+        erased label. Returns how many foreground voxels this newly covers
+        '''
+        tt = self._tt[region]
+        newly_covered = np.count_nonzero(np.logical_and(
+            np.logical_not(tt < 0), self._bimg[region] > 0))
+        self._tt[region] = value
+        return newly_covered
+
+    def _backtrack(self, srcpt, swc):
+        '''
+        Back-track one branch from srcpt until one of the stopping criteria
+        is met. Returns the branch, whether it should be kept and the
+        STOP_* reason
+        '''
+        branch = R2Branch()
+        branch.add(srcpt, 1., 1.)
+        keep = True
+
+        # Loop for 1 back-tracking iteration
+        while True:
+            self._step(branch)
+            head = branch.pts[-1]
+            tt_head = self._tt[math.floor(head[0]), math.floor(
+                head[1]), math.floor(head[2])]
+
+            # 1. Check out of bound
+            if not inbound(head, self._bimg.shape):
+                branch.slice(0, -1)
+                return branch, keep, STOP_OUT_OF_BOUND
+
+            # 2. Check for the large gap criterion
+            if branch.gap > np.asarray(branch.radius).mean() * 8 and not self._non_stop:
+                return branch, keep, STOP_GAP
+            else:
+                branch.reset_gap()
+
+            # 3. Check if Soma has been reached
+            if tt_head == -3:
+                keep = True if branch.branchlen > self._soma.radius * 3 else False
+                branch.reached_soma = True
+                return branch, keep, STOP_SOMA
+
+            # 4. Check if not moved for 15 iterations
+            if branch.is_stucked():
+                return branch, keep, STOP_STUCK
+
+            # 5. Check for low online confidence
+            if branch.low_conf and not self._non_stop:
+                keep = False
+                return branch, keep, STOP_LOW_CONF
+
+            # 6. Check for branch merge
+            # Consider reaches previous explored area traced with branch
+            # Note: when the area was traced due to noise points
+            # (erased with -2), not considered as 'reached'
+            if tt_head == -1:
+                branch.touched = True
+                if swc.size() == 1:
+                    return branch, keep, STOP_TOUCHED
+
+                matched, matched_idx = swc.match(head, branch.radius[-1])
+                if matched > 0:
+                    branch.touch_idx = matched_idx
+                    return branch, keep, STOP_MERGED
+
+                if branch.steps_after_reach > 200:
+                    return branch, keep, STOP_TOUCHED
+
+    def _backtrack_native(self, srcpt, swc):
+        '''
+        Same as _backtrack, but the whole branch is traced by the compiled
+        r2backtrack engine
+        '''
+        # The grid over the swc nodes is kept up to date by the engine as
+        # branches are added
+        if self._node_grid is None or self._node_grid_swc is not swc:
+            self._node_grid, self._node_grid_swc = r2backtrack.node_grid(), swc
+        (pts, radius, conf, reason, keep, low_conf,
+         reached_soma, touch_idx) = r2backtrack.branch(
+            srcpt, self._grad.field, self._bimg, self._dilated_bimg,
+            self._tt, swc._data, float(self._soma.radius), self._non_stop,
+            self._node_grid)
+
+        branch = R2Branch()
+        branch.pts, branch.radius, branch.conf = pts, radius, conf
+        branch.low_conf = low_conf
+        branch.reached_soma = reached_soma
+        branch.touch_idx = touch_idx
+        return branch, keep, reason
 
     def _iterative_backtrack(self):
 
         # Initialise swc with the soma centroid
         swc = SWC(self._soma)
-        soma_node = np.asarray([0, 1, self._soma.centroid[0],
-                                self._soma.centroid[1],
-                                self._soma.centroid[2],
-                                self._soma.radius, -1, 1.])
-        swc.add(np.reshape(soma_node, (1, 8)))
-
 
-        self._pbar = tqdm(total=math.floor(self._nforeground * self._target_coverage))
+        self._pbar = tqdm(total=math.floor(self._nforeground * self._target_coverage),
+                          disable=self._silent)
 
         # Loop for all branches
         while self._coverage < self._target_coverage:
             self._update_coverage()
             # Find the geodesic furthest point on foreground time-crossing-map
             srcpt = np.asarray(np.unravel_index(
-                self._tt.argmax(), self._tt.shape)).astype('float64')
-            branch = R2Branch()
-            branch.add(srcpt, 1., 1.)
+                self._sources.argmax(), self._tt.shape)).astype('float64')
 
             # Erase the source point just in case
-            self._tt[math.floor(srcpt[0]), math.floor(
-                srcpt[1]), math.floor(srcpt[2])] = -2
-            keep = True
-
-            # Loop for 1 back-tracking iteration
-            while True:
-                self._step(branch)
-                head = branch.pts[-1]
-                tt_head = self._tt[math.floor(head[0]), math.floor(
-                    head[1]), math.floor(head[2])]
-
-                # 1. Check out of bound
-                if not inbound(head, self._bimg.shape):
-                    branch.slice(0, -1)
-                    break
-
-                # 2. Check for the large gap criterion
-                if branch.gap > np.asarray(branch.radius).mean() * 8 and not self._non_stop:
-                    break
-                else:
-                    branch.reset_gap()
-
-                # 3. Check if Soma has been reached
-                if tt_head == -3:
-                    keep = True if branch.branchlen > self._soma.radius * 3 else False
-                    branch.reached_soma = True
-                    break
-
-                # 4. Check if not moved for 15 iterations
-                if branch.is_stucked():
-                    break
-
-                # 5. Check for low online confidence
-                if branch.low_conf and not self._non_stop:
-                    keep = False
-                    break
-
-                # 6. Check for branch merge
-                # Consider reaches previous explored area traced with branch
-                # Note: when the area was traced due to noise points
-                # (erased with -2), not considered as 'reached'
-                if tt_head == -1:
-                    branch.touched = True
-                    if swc.size() == 1:
-                        break
-
-                    matched, matched_idx = swc.match(head, branch.radius[-1])
-                    if matched > 0:
-                        branch.touch_idx = matched_idx
-                        break
-
-                    if branch.steps_after_reach > 200:
-                        break
-
-            self._erase(branch)
+            self._cover_ctr_new += self._erase_voxels(
+                (math.floor(srcpt[0]), math.floor(srcpt[1]),
+                 math.floor(srcpt[2])), -2)
+
+            if self._native:
+                branch, keep, _ = self._backtrack_native(srcpt, swc)
+            else:
+                branch, keep, _ = self._backtrack(srcpt, swc)
+
+            self._cover_ctr_new += self._erase(branch)
 
             # Add to SWC if it was decided to be kept
             if keep:
@@ -361,7 +539,7 @@ class R2Branch(Branch):
     def reset_gap(self):
         self.gap = 0
 
-    def update(self, pt, bimg, dilated_bimg):
+    def update(self, pt, bimg, dilated_bimg, radius_estimator=None):
         eps = 1e-5
         head = self.pts[-1]
         velocity = np.asarray(pt) - np.asarray(head)
@@ -397,7 +575,10 @@ class R2Branch(Branch):
         if self.touched:
             self.steps_after_reach += 1
 
-        r = estimate_radius(pt, bimg)
+        if radius_estimator is None:
+            r = estimate_radius(pt, bimg)
+        else:
+            r = radius_estimator(pt)
         self.add(pt, oc, r)
 
     def update_ma(self, oc):
@@ -440,6 +621,62 @@ def estimate_radius(pt, bimg):
     return r
 
 
+class RadiusEstimator(object):
+    '''
+    Same radius as estimate_radius, looked up in a summed-area table of the
+    binary image. Each cube density test costs 8 lookups instead of a sum
+    over (2r + 1) ** 3 voxels.
+    The radius is still the first r whose cube density drops below 0.6:
+    the density is not monotonic in r, so a binary search could settle on
+    a different radius.
+    '''
+
+    def __init__(self, bimg):
+        self.shape = bimg.shape
+        dtype = 'int32' if bimg.size < 2 ** 31 else 'int64'
+        self._sat = np.zeros([s + 1 for s in bimg.shape], dtype=dtype)
+        self._sat[1:, 1:, 1:] = bimg
+        for axis in range(3):
+            np.cumsum(self._sat, axis=axis, out=self._sat)
+
+    def _cube_sum(self, lo, hi):
+        # Inclusion-exclusion over the 8 corners of [lo, hi)
+        s = self._sat
+        return (s[hi[0], hi[1], hi[2]] - s[lo[0], hi[1], hi[2]] -
+                s[hi[0], lo[1], hi[2]] - s[hi[0], hi[1], lo[2]] +
+                s[lo[0], lo[1], hi[2]] + s[lo[0], hi[1], lo[2]] +
+                s[hi[0], lo[1], lo[2]] - s[lo[0], lo[1], lo[2]])
+
+    def __call__(self, pt):
+        x, y, z = [math.floor(p) for p in pt]
+        r = 0
+        while True:
+            r += 1
+            lo = [min(max(c - r, 0), s) for c, s in zip((x, y, z), self.shape)]
+            hi = [max(min(c + r + 1, s), l) for c, s, l in zip((x, y, z), self.shape, lo)]
+            if self._cube_sum(lo, hi) / (2 * r + 1) ** 3 < .6:
+                return r
+
+    def estimate(self, pts):
+        '''
+        Radii of a batch of points (N, 3) in one vectorised pass
+        '''
+        pts = np.floor(np.asarray(pts, dtype='float64').reshape(-1, 3)).astype('int64')
+        shape = np.asarray(self.shape)
+        radius = np.zeros(pts.shape[0], dtype='int64')
+        active = np.arange(pts.shape[0])
+        r = 0
+        while active.size > 0:
+            r += 1
+            p = pts[active]
+            lo = np.clip(p - r, 0, shape)
+            hi = np.maximum(np.minimum(p + r + 1, shape), lo)
+            done = self._cube_sum(lo.T, hi.T) / (2 * r + 1) ** 3 < .6
+            radius[active[done]] = r
+            active = active[~done]
+        return radius
+
+
 def exponential_moving_average(p, ema, n):
     '''
     The exponential moving average (EMA) traditionally
@@ -460,38 +697,333 @@ def exponential_moving_average(p, ema, n):
 
 
 def rk4(srcpt, ginterp, t, stepsize):
+    '''
+    One Runge-Kutta 4 step down the gradient field.
+    ginterp is a GradientField (or any callable returning the (dx, dy, dz)
+    vector of a single point)
+    '''
     # Compute K1
-    k1 = np.asarray([g(srcpt)[0] for g in ginterp])
+    k1 = ginterp(srcpt)
     k1 *= stepsize / max(np.linalg.norm(k1), 1.)
     tp = srcpt - 0.5 * k1  # Position of temporary point
     if not inbound(tp, t.shape):
         return srcpt
 
     # Compute K2
-    k2 = np.asarray([g(tp)[0] for g in ginterp])
+    k2 = ginterp(tp)
     k2 *= stepsize / max(np.linalg.norm(k2), 1.)
     tp = srcpt - 0.5 * k2  # Position of temporary point
     if not inbound(tp, t.shape):
         return srcpt
 
     # Compute K3
-    k3 = np.asarray([g(tp)[0] for g in ginterp])
+    k3 = ginterp(tp)
     k3 *= stepsize / max(np.linalg.norm(k3), 1.)
     tp = srcpt - k3  # Position of temporary point
     if not inbound(tp, t.shape):
         return srcpt
 
     # Compute K4
-    k4 = np.asarray([g(tp)[0] for g in ginterp])
+    k4 = ginterp(tp)
     k4 *= stepsize / max(np.linalg.norm(k4), 1.)
 
     return srcpt - (k1 + k2 * 2 + k3 * 2 + k4) / 6.0  # Compute final point
 
 
+class LazyArgmax(object):
+    '''
+    Repeated argmax over an array whose entries are only ever erased, i.e.
+    overwritten with negative values, between queries (e.g. the timemap
+    copy during back-tracking).
+    The non-erased entries are sorted once by descending value and then
+    ascending flat index, which is exactly the order np.argmax picks them in
+    (NaN first, ties to the lowest index). Each query skips the entries
+    erased since the last one, so a sequence of queries costs O(N log N)
+    once plus amortised O(1) per query instead of O(N) each.
+    '''
+
+    def __init__(self, arr):
+        if not arr.flags.c_contiguous:
+            raise ValueError('LazyArgmax needs a C-contiguous array')
+        self._arr = arr
+        self._flat = arr.reshape(-1)  # A view sharing the erasures
+        candidates = np.flatnonzero(np.logical_not(self._flat < 0))
+        keys = -self._flat[candidates]
+        keys[np.isnan(keys)] = -np.inf
+        self._order = candidates[np.lexsort((candidates, keys))]
+        self._head = 0
+
+    def __len__(self):
+        # Upper bound of the entries left, erased ones are dropped lazily
+        return len(self._order) - self._head
+
+    def argmax(self):
+        '''
+        The flat index np.argmax(arr) would return
+        '''
+        while self._head < len(self._order):
+            idx = self._order[self._head]
+            if not self._flat[idx] < 0:
+                return idx
+            self._head += 1
+
+        # Everything indexed has been erased, only negative values are left
+        return self._arr.argmax()
+
+
+class GradientField(object):
+    '''
+    Trilinear sampler of the gradient field of the timemap.
+    The three gradient components are kept interleaved in a single float32
+    volume of shape (X, Y, Z, 3), so one lookup reads all of (dx, dy, dz)
+    from the 8 neighbouring voxels at once. It replaces one
+    RegularGridInterpolator per component, whose per-call validation
+    dominated the cost of back-tracking.
+    '''
+
+    def __init__(self, dx, dy, dz):
+        self._set_field(np.stack((dx, dy, dz), axis=-1).astype('float32'))
+
+    @classmethod
+    def from_field(cls, field):
+        '''
+        Wrap an interleaved float32 (X, Y, Z, 3) field without copying it
+        '''
+        sampler = cls.__new__(cls)
+        sampler._set_field(np.ascontiguousarray(field, dtype='float32'))
+        return sampler
+
+    def _set_field(self, field):
+        self._field = field
+        self.shape = self._field.shape[:3]
+        # The lower corner of a cell; the upper bound is included in the last cell
+        self._maxcorner = [max(s - 2, 0) for s in self.shape]
+        # Offsets of the 8 cell corners in the flattened (N, 3) field
+        strides = np.asarray([self.shape[1] * self.shape[2], self.shape[2], 1])
+        self._corners = np.asarray(
+            [[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+        self._corner_offsets = self._corners.dot(strides)
+        self._strides = strides
+
+    @property
+    def field(self):
+        '''
+        The interleaved float32 (X, Y, Z, 3) gradient volume
+        '''
+        return self._field
+
+    def __call__(self, pts):
+        '''
+        Sample the gradient at one point (3,) or a batch of points (N, 3).
+        Returns a float64 array of shape (3,) or (N, 3) respectively
+        '''
+        pts = np.asarray(pts, dtype='float64')
+        if pts.ndim == 1:
+            return self._sample_one(pts)
+        return self._sample_batch(pts)
+
+    def _check_bounds(self, pts):
+        if np.any(pts < 0) or np.any(pts > np.asarray(self.shape) - 1):
+            raise ValueError('One of the requested points is out of the '
+                             'bounds of the gradient field')
+
+    def _sample_one(self, pt):
+        self._check_bounds(pt)
+        x, y, z = pt
+        i = min(math.floor(x), self._maxcorner[0])
+        j = min(math.floor(y), self._maxcorner[1])
+        k = min(math.floor(z), self._maxcorner[2])
+        fx, fy, fz = x - i, y - j, z - k
+
+        c = self._field[i:i + 2, j:j + 2, k:k + 2].astype('float64')
+        c = c[0] * (1. - fx) + c[-1] * fx
+        c = c[0] * (1. - fy) + c[-1] * fy
+        return c[0] * (1. - fz) + c[-1] * fz
+
+    def _sample_batch(self, pts):
+        self._check_bounds(pts)
+        base = np.minimum(np.floor(pts).astype('int64'), self._maxcorner)
+        frac = pts - base  # (N, 3)
+        flat = self._field.reshape(-1, 3)
+
+        # Weights of the 8 corners for each point (N, 8)
+        w = np.where(self._corners[None, :, :] == 1,
+                     frac[:, None, :], 1. - frac[:, None, :]).prod(axis=-1)
+        offsets = self._corner_offsets
+        if min(self.shape) < 2:  # Degenerated axes have no upper corner
+            corners = np.minimum(base[:, None, :] + self._corners[None, :, :],
+                                 np.asarray(self.shape) - 1)
+            idx = corners.dot(self._strides)
+        else:
+            idx = base.dot(self._strides)[:, None] + offsets[None, :]
+        return (flat[idx].astype('float64') * w[:, :, None]).sum(axis=1)
+
+
+def path_tube(swc, shape, zoom, margin):
+    '''
+    Boolean volume of the given shape covering every segment of a swc
+    traced at zoom times the resolution, margin voxels wider than its radius
+    '''
+    tube = np.zeros(shape, dtype=bool)
+    if swc.ndim != 2 or swc.shape[0] == 0:
+        return tube
+    row = {nid: i for i, nid in enumerate(swc[:, 0])}
+    parent = np.asarray([row.get(p, i) for i, p in enumerate(swc[:, 6])])
+    start, end = swc[:, 2:5], swc[parent, 2:5]
+    radius = np.maximum(swc[:, 5], swc[parent, 5]) / zoom + margin
+
+    balls = {}
+    upper = np.asarray(shape)
+    for a, b, r in zip(start, end, np.ceil(radius).astype(int)):
+        if r not in balls:
+            X, Y, Z = np.ogrid[-r:r + 1, -r:r + 1, -r:r + 1]
+            balls[r] = X ** 2 + Y ** 2 + Z ** 2 <= r ** 2
+        nstep = int(np.ceil(np.linalg.norm(b - a))) + 1
+        for p in np.unique(np.rint(np.linspace(a, b, nstep + 1)).astype(int), axis=0):
+            lo, hi = p - r, p + r + 1
+            clo, chi = np.maximum(lo, 0), np.minimum(hi, upper)
+            if np.any(chi <= clo):
+                continue
+            tube[clo[0]:chi[0], clo[1]:chi[1], clo[2]:chi[2]] |= balls[r][
+                clo[0] - lo[0]:chi[0] - lo[0], clo[1] - lo[1]:chi[1] - lo[1],
+                clo[2] - lo[2]:chi[2] - lo[2]]
+    return tube
+
+
+def peak_rss():
+    '''
+    The peak resident set size of this process in MB, None where unknown
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10  # bytes on macOS
+
+
+def restricted_travel_time(speed, region, source):
+    '''
+    skfmm.travel_time from source that never leaves region. skfmm cannot
+    stop early, so it is solved on the bounding box of region with the rest
+    of the box masked out. Voxels left unreached take the latest arrival time.
+    A source outside region, such as the centroid of a curved soma, is moved
+    to the closest voxel of region
+    '''
+    source = tuple(int(c) for c in source)
+    objects = find_objects(region.astype('uint8'))
+    if not objects:
+        raise ValueError('The region to march through is empty')
+    box = objects[0]
+    if not region[source]:
+        source = closest_voxel(region, source)
+    marchmap = np.ones(region[box].shape)
+    marchmap[tuple(c - b.start for c, b in zip(source, box))] = -1
+    # skfmm reads strided views as if they were contiguous
+    t = skfmm.travel_time(np.ma.MaskedArray(marchmap, ~region[box].astype(bool)),
+                          np.ascontiguousarray(speed[box]), dx=5e-3)
+    tmax = t.max()
+    out = np.full(region.shape, tmax, dtype='float64')
+    out[box] = t.filled(tmax)
+    return out
+
+
+def closest_voxel(region, source):
+    '''
+    The voxel of a non-empty region closest to source
+    '''
+    # Grow a cube around source until it holds part of region
+    r, inside = 1, ()
+    while not len(inside):
+        lo = np.maximum(np.asarray(source) - r, 0)
+        inside = np.argwhere(region[tuple(slice(l, c + r + 1) for l, c in zip(lo, source))])
+        r *= 2
+    # The closest voxel of the cube may still be beaten by one just outside it
+    r = np.linalg.norm(inside + lo - source, axis=1).min()
+    lo = np.maximum(np.asarray(source) - int(r), 0)
+    inside = np.argwhere(region[tuple(slice(l, c + int(r) + 1) for l, c in zip(lo, source))]) + lo
+    return tuple(int(c) for c in inside[np.linalg.norm(inside - source, axis=1).argmin()])
+
+
+NEIGHBOURS = np.asarray([[i, j, k] for i in (-1, 0, 1) for j in (-1, 0, 1)
+                        for k in (-1, 0, 1) if (i, j, k) != (0, 0, 0)])
+
+
+def descent_field(t, mask, tpad, out=None):
+    '''
+    numpy version of r2backtrack.descent, only visiting the voxels in mask,
+    or all of them when mask is None.
+    Neighbours are visited in a fixed order and ties keep the first one
+    '''
+    field = np.zeros(t.shape + (3,), dtype='float32') if out is None else out
+    field[...] = 0
+    if mask is None:
+        return _descent_volume(t, tpad, field)
+    idx = np.nonzero(mask)
+    best = t[idx]
+    direction = np.zeros((best.size, 3), dtype='float32')
+    shape = np.asarray(t.shape)[:, None]
+
+    for n in NEIGHBOURS:
+        nb = np.stack(idx) + n[:, None]
+        inside = np.all((nb >= 0) & (nb < shape), axis=0)
+        v = np.full(best.size, tpad, dtype=t.dtype)
+        v[inside] = t[tuple(nb[:, inside])]
+        check = v < best
+        best = np.where(check, v, best)
+        direction[check] = -n / np.linalg.norm(n)
+
+    field[idx] = direction
+    return field
+
+
+
+def _descent_volume(t, tpad, field):
+    '''
+    descent_field over the whole volume, comparing shifted views of the
+    timemap instead of gathering the neighbours of every voxel
+    '''
+    best = np.array(t)
+    for n in NEIGHBOURS:
+        direction = -n / np.linalg.norm(n)
+        # The voxels whose neighbour is inside the volume and that neighbour
+        dst = tuple(slice(max(-d, 0), s - max(d, 0)) for d, s in zip(n, t.shape))
+        src = tuple(slice(max(d, 0), s + min(d, 0)) for d, s in zip(n, t.shape))
+        check = t[src] < best[dst]
+        np.copyto(best[dst], t[src], where=check)
+        field[dst][check] = direction
+        # The faces whose neighbour is the padding
+        for axis, d in enumerate(n):
+            if d:
+                face = (slice(None),) * axis + (-1 if d > 0 else 0,)
+                check = tpad < best[face]
+                best[face][check] = tpad
+                field[face][check] = direction
+    return field
+
 def inbound(pt, shape):
     return all([True if 0 <= p <= s - 1 else False for p, s in zip(pt, shape)])
 
 
+def stamp_boxes(lo, hi, shape):
+    '''
+    Boolean volume of the given shape with the union of the boxes
+    [lo[i], hi[i]) set to True.
+    The box corners are scattered into a difference array and integrated
+    with a cumulative sum along each axis, so the cost is linear in the
+    number of boxes plus the volume instead of the sum of the box volumes
+    '''
+    diff = np.zeros([s + 1 for s in shape], dtype='int32')
+    for cx in (0, 1):
+        for cy in (0, 1):
+            for cz in (0, 1):
+                sign = -1 if (cx + cy + cz) % 2 else 1
+                np.add.at(diff, ((hi if cx else lo)[:, 0],
+                                 (hi if cy else lo)[:, 1],
+                                 (hi if cz else lo)[:, 2]), sign)
+    for axis in range(3):
+        np.cumsum(diff, axis=axis, out=diff)
+    return diff[:-1, :-1, :-1] > 0
+
+
 def constrain_range(min, max, minlimit, maxlimit):
     return list(
         range(min if min > minlimit else minlimit, max
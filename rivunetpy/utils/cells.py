@@ -13,9 +13,12 @@ class Neuron:
 
     Attributes:
         img (Image): Image of the neuron. Should not contain any other neurons.
+          Cropped to the bounding box of the neuron's region.
         img_fname (str): Path pointing towards the image of the neuron.
         num (int): Number identifying the neuron.
         soma_radius: (int): Radius (scale) of the soma of the neuron in pixels.
+        offset (tuple): Index in X, Y, and Z of the first voxel of the image
+          within the original image.
         swc (rivunetpy.swc.SWC): Reconstructed neuron as SWC.
         swc_fname (str): Path pointing towards a copy of the reconstruction on
           disk.
@@ -33,6 +36,8 @@ class Neuron:
     # soma_pos: tuple = None
     soma_radius: int = None
 
+    offset: tuple = (0, 0, 0)
+
     swc: SWC = None
     swc_fname: str = None
 
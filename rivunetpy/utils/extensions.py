@@ -2,8 +2,12 @@ import os
 """Extensions used for RivuNetpy.
 
 By default, RivuNetpy uses .rnp.tif for image files and .rnp.swc for
-reconstructions.
+reconstructions, with a binary copy of each reconstruction in .rnp.npz.
+Each .rnp.tif holds a crop of the original image, its position in the
+original image is stored in .rnp.offset.
 """
 
 RIVULET_2_TREE_IMG_EXT = '{}rnp{}tif'.format(os.extsep, os.extsep)
 RIVULET_2_TREE_SWC_EXT = '{}rnp{}swc'.format(os.extsep, os.extsep)
+RIVULET_2_TREE_NPZ_EXT = '{}rnp{}npz'.format(os.extsep, os.extsep)
+RIVULET_2_TREE_OFFSET_EXT = '{}rnp{}offset'.format(os.extsep, os.extsep)
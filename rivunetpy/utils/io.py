@@ -72,30 +72,43 @@ def writetiff3d(filepath, block):
 
 def loadswc(filepath):
     '''
-    Load swc file as a N X 7 numpy array
+    Load swc file as a N X 7 numpy array. The cells can be separated by
+    any whitespace and lines with fewer than 7 cells are skipped
     '''
-    swc = []
-    with open(filepath) as f:
-        lines = f.read().split("\n")
-        for l in lines:
-            if not l.startswith('#'):
-                l = l.strip()
-                cells = l.split(' ')
-                if len(cells) == 7:
-                    cells = [float(c) for c in cells]
-                    # cells[2:5] = [c-1 for c in cells[2:5]]
-                    swc.append(cells)
-    return np.array(swc)
+    try:
+        swc = np.loadtxt(filepath, comments='#', ndmin=2)
+    except ValueError:  # Rows of different lengths
+        with open(filepath) as f:
+            rows = [l.split()[:7] for l in f if not l.lstrip().startswith('#')]
+        swc = np.array([r for r in rows if len(r) == 7], dtype=float)
+    if swc.size == 0 or swc.shape[1] < 7:
+        return np.zeros((0, 7))
+    return swc[:, :7]
 
 
 def saveswc(filepath, swc):
     if swc.shape[1] > 7:
         swc = swc[:, :7]
 
-    with open(filepath, 'w') as f:
-        for i in range(swc.shape[0]):
-            print('%d %d %.3f %.3f %.3f %.3f %d' %
-                  tuple(swc[i, :].tolist()), file=f)
+    np.savetxt(filepath, swc, fmt='%d %d %.3f %.3f %.3f %.3f %d')
+
+
+def loadswcnpz(filepath):
+    '''
+    Load a swc saved by saveswcnpz as a N X 7 numpy array
+    '''
+    with np.load(filepath) as f:
+        return f['swc']
+
+
+def saveswcnpz(filepath, swc):
+    '''
+    Save the first 7 columns of a swc at full precision in a numpy
+    archive, a binary sidecar to the .swc that loads in milliseconds
+    '''
+    # Through a file object, as np.savez appends .npz to bare file names
+    with open(filepath, 'wb') as f:
+        np.savez(f, swc=np.asarray(swc, dtype='float64')[:, :7])
 
 
 def crop(img, thr):
@@ -160,12 +160,14 @@ def plot_segmentation(neurons, ax=None):
     prop_cycle = plt.rcParams['axes.prop_cycle']
     colors = cycle(prop_cycle.by_key()['color'])
 
-    neuron_fnames = [neuron.img_fname for neuron in neurons]
+    right, bottom = 0, 0
+    for neuron in neurons:
+        img = sitk.ReadImage(neuron.img_fname)
 
-    for ii, fname in enumerate(neuron_fnames):
-        img = sitk.ReadImage(fname)
-
-        shape = img.GetSize()
+        # Place the crop where it was in the full image
+        x0, y0, _ = neuron.offset
+        width, height = img.GetSize()[:2]
+        right, bottom = max(right, x0 + width), max(bottom, y0 + height)
 
         c = next(colors)
         R, G, B = matplotlib.colors.to_rgb(c)
@@ -188,10 +190,13 @@ def plot_segmentation(neurons, ax=None):
 
         aa_cmap = ListedColormap(aa_cmap)
 
-        ax.imshow(flatten(img),
-                     cmap=aa_cmap,
-                     # extent=[0, shape[0], 0, shape[1]],
-                     alpha=1)
+        ax.imshow(np.max(sitk.GetArrayViewFromImage(img), axis=0),
+                  cmap=aa_cmap,
+                  extent=[x0 - 0.5, x0 + width - 0.5, y0 + height - 0.5, y0 - 0.5],
+                  alpha=1)
+
+    ax.set_xlim(-0.5, right - 0.5)
+    ax.set_ylim(bottom - 0.5, -0.5)
 
 
 
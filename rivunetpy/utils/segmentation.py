@@ -37,6 +37,7 @@ from rivunetpy.utils.metrics import euclidean_distance
 ########## 3D Setting for performance ##########
 NUM_SCALES = 5
 DOWNSCALE_THRESHOLD = 10  # soma scale at which to sacrifice quality for speed by reducing image size
+CROP_MARGIN = 12  # px of background kept around each neuron, covers the margin added when cropping for tracing
 
 def downsample_img(img, rescale_factor):
     # https://stackoverflow.com/questions/48065117/simpleitk-resize-images?answertab=trending#tab-top
@@ -430,10 +431,13 @@ class NeuronSegmentor:
         soma_seeds (np.ndarray): Locations of all the individual somata in the image.
         neurite_scale (int): The approximate scale of the neurites in the image.
         regions (Image): An image where each region in which a single neuron lies is labeled by a unique intensity value.
+        region_stats (sitk.LabelIntensityStatisticsImageFilter): Bounding box, voxel count and intensity statistics
+          of every region, computed in a single pass over the image.
         neurons: Images of the individual neurons.
     """
 
-    def __init__(self, img: Image, threshold: Union[int, float] = None, tolerance=0.10, blur=None, watershed=False):
+    def __init__(self, img: Image, threshold: Union[int, float] = None, tolerance=0.10, blur=None, watershed=False,
+                 plot=True):
         """Segment an image of multiple neurons.
 
         A progress bar is shown to indicate the approximate progress.
@@ -447,6 +451,8 @@ class NeuronSegmentor:
             watershed (bool, optional): Whether or not to use a watershed step for soma identification.
               Set to True for wide FOV images and False for narrow FOV images
               (many cells vs. few cells resp.).
+            plot (bool, optional): Whether to show the seeds and labeled neurons when done. Showing them extracts
+              all neuron images at once, leave it off to extract them one at a time through ``iter_neurons``.
 
         Raises:
             ValueError: If the threshold is not a number.
@@ -493,12 +499,13 @@ class NeuronSegmentor:
 
         self.__composite_image = self.__make_segmenting_image()
 
-        self.regions, self.__region_labels = self.__find_regions()
+        self.regions, self.region_stats = self.__find_regions()
+        self.__region_labels = self.region_stats.GetLabels()
 
-        self.neurons = self.__make_neuron_images()
+        self._neurons = None
 
-        self.plot()
-        pass
+        if plot:
+            self.plot()
 
     def __str__(self):
         return (f'{len(self.__region_labels)} Neuron(s) with \n\tSoma Scale = {self.soma_scale}\n'
@@ -762,7 +769,7 @@ class NeuronSegmentor:
         then uses the labeled images to create more expansive volumes containing the neurons.
 
         Returns:
-            tuple: A tuple containing a labeled image and a list of the labels in this image. Each labeled area in the
+            tuple: A tuple containing a labeled image and the statistics of its labels. Each labeled area in the
               image should contain a single neuron.
         """
         # threshold_filter = sitk.LiThresholdImageFilter()
@@ -819,7 +826,7 @@ class NeuronSegmentor:
 
         self.components = ws
 
-        return ws, stats.GetLabels()
+        return ws, stats
 
         # if self.strict:
         #     stats = sitk.LabelIntensityStatisticsImageFilter()
@@ -836,19 +843,46 @@ class NeuronSegmentor:
         #
         #     return voronoi, stats.GetLabels()
 
-    def __make_neuron_images(self) -> list:
-        """Create images containing single neurons using the labeled region image.
-
-        Returns:
-            list: List of items of cell dataclass, each containing an image of single neuron.
+    @property
+    def neurons(self) -> list:
+        """Images of the individual neurons, extracted on first access.
         """
-        neurons = []
-        for ii, label in enumerate(self.__region_labels):
-            region = self.regions == label
-            image = self.img * sitk.Cast(region, self.PixelID)
-            neurons.append(Neuron(image, num=ii, soma_radius=self.soma_scale))
+        if self._neurons is None:
+            self._neurons = list(self.iter_neurons())
+        return self._neurons
+
+    def iter_neurons(self, largest_first: bool = False):
+        """Yield images containing single neurons one at a time.
 
-        return neurons
+        Each image is cropped to the bounding box of its region, with a margin of CROP_MARGIN px, and its position
+        in the input image is stored as the offset of the neuron. Only the crop is compared against the label, so
+        extracting all neurons reads each region once rather than the whole image per region.
+
+        Args:
+            largest_first (bool, optional): Yield the neurons in order of decreasing region size rather than in
+              order of their labels. Their numbering is the same either way.
+
+        Yields:
+            Neuron: Cell dataclass containing the image of a single neuron.
+        """
+        labels = self.__region_labels
+        order = list(range(len(labels)))
+        if largest_first:
+            order.sort(key=lambda ii: self.region_stats.GetNumberOfPixels(labels[ii]), reverse=True)
+
+        size = np.asarray(self.img.GetSize())
+        for ii in order:
+            if self._neurons is not None:  # Already extracted
+                yield self._neurons[ii]
+                continue
+
+            bbox = np.asarray(self.region_stats.GetBoundingBox(labels[ii]))  # Index and size in X, Y, Z
+            lower = np.maximum(bbox[:3] - CROP_MARGIN, 0)
+            upper = np.minimum(bbox[:3] + bbox[3:] + CROP_MARGIN, size)
+            index, crop_size = lower.tolist(), (upper - lower).tolist()
+            region = sitk.RegionOfInterest(self.regions, crop_size, index) == labels[ii]
+            image = sitk.RegionOfInterest(self.img, crop_size, index) * sitk.Cast(region, self.PixelID)
+            yield Neuron(image, num=ii, soma_radius=self.soma_scale, offset=tuple(index))
 
     def __plot_seeds(self, show_labels: int = None):
 
@@ -885,9 +919,8 @@ class NeuronSegmentor:
 
         shape = self.regions.GetSize()
 
-        neuron_images = [neuron.img for neuron in self.neurons]
-
-        for ii, image in enumerate(neuron_images[::-1]):
+        for neuron in self.neurons[::-1]:
+            image = neuron.img
 
             c = next(colors)
             R, G, B = matplotlib.colors.to_rgb(c)
@@ -910,11 +943,17 @@ class NeuronSegmentor:
 
             aa_cmap = ListedColormap(aa_cmap)
 
-            plt.imshow(flatten(image),
+            # Place the crop where it was in the full image
+            x0, y0, _ = neuron.offset
+            width, height = image.GetSize()[:2]
+            plt.imshow(np.max(sitk.GetArrayViewFromImage(image), axis=0),
                        cmap=aa_cmap,
-                       extent=[0, shape[0], 0, shape[1]],
+                       extent=[x0, x0 + width, shape[1] - y0 - height, shape[1] - y0],
                        alpha=1)
 
+        plt.xlim(0, shape[0])
+        plt.ylim(0, shape[1])
+
     def plot(self):
         """Simple plotting.
 
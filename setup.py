@@ -53,6 +53,12 @@ ext_modules = [
             os.path.join('rivunetpy', 'msfm', 'msfmmodule.c'),
             os.path.join('rivunetpy', 'msfm', '_msfm.c'),
         ]),
+    Extension(
+        'r2backtrack',
+        sources=[
+            os.path.join('rivunetpy', 'backtrack', 'backtrackmodule.c'),
+            os.path.join('rivunetpy', 'backtrack', '_backtrack.c'),
+        ]),
 ]
 
 config = {
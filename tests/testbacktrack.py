@@ -0,0 +1,99 @@
+import math
+import time
+
+import numpy as np
+
+from rivunetpy.soma import Soma
+from rivunetpy.swc import SWC
+from rivunetpy.trace import R2Tracer, r2backtrack, STOP_MERGED
+from testtrace_bench import make_synthetic_neuron
+
+
+def check_backtrack_parity(seed, quality=False, nbranch=200):
+    '''
+    Trace the same neuron with both back-tracking engines branch by branch
+    and check the branches and stopping reasons agree
+    '''
+    img = make_synthetic_neuron(seed=seed)
+    tracer = R2Tracer(quality=quality, silent=True, native=False)
+    tracer.img = img
+    tracer._bimg = (img > 60).astype('uint8')
+    tracer._soma = Soma()
+    tracer._soma.detect(tracer._bimg, not quality, True)
+    tracer._prep()
+
+    swc = SWC(tracer._soma)
+    elapsed = {'python': 0., 'native': 0.}
+    for _ in range(nbranch):
+        srcpt = np.asarray(np.unravel_index(
+            tracer._tt.argmax(), tracer._tt.shape)).astype('float64')
+        if tracer._tt[tuple(srcpt.astype(int))] < 0:
+            break
+        tracer._tt[math.floor(srcpt[0]), math.floor(srcpt[1]), math.floor(srcpt[2])] = -2
+
+        t0 = time.time()
+        branch, keep, reason = tracer._backtrack(srcpt, swc)
+        elapsed['python'] += time.time() - t0
+        t0 = time.time()
+        nbranch_, nkeep, nreason = tracer._backtrack_native(srcpt, swc)
+        elapsed['native'] += time.time() - t0
+
+        assert reason == nreason, (reason, nreason)
+        assert keep == nkeep
+        assert branch.low_conf == nbranch_.low_conf
+        assert branch.reached_soma == nbranch_.reached_soma
+        assert branch.touch_idx == nbranch_.touch_idx
+        assert np.allclose(np.asarray(branch.pts).reshape(-1, 3), nbranch_.pts)
+        assert np.allclose(branch.radius, nbranch_.radius)
+        assert np.allclose(branch.conf, nbranch_.conf)
+
+        tracer._erase(branch)
+        if keep:
+            pidx = 0 if branch.reached_soma else (
+                branch.touch_idx if branch.touch_idx >= 0 else None)
+            swc.add_branch(branch, pidx)
+
+    print('Seed {} ({} quality): {} nodes, python {:.2f}s, native {:.2f}s'.format(
+        seed, 'high' if quality else 'low', swc.size(), elapsed['python'], elapsed['native']))
+
+
+def check_node_grid(nadd=400, shape=(96, 80, 40)):
+    '''
+    The node merged into by the compiled engine is the closest swc node, the
+    first one on ties, while the grid over the nodes follows a growing swc
+    '''
+    rng = np.random.RandomState(0)
+    grad = np.zeros(shape + (3,), dtype='float32')
+    grad[..., 0] = -1
+    bimg = np.ones(shape, dtype='uint8')
+    tt = -np.ones(shape)  # Every step touches the traced area
+    grid = r2backtrack.node_grid()
+    swc = np.zeros((1, 8))
+    for _ in range(nadd):
+        if rng.rand() < 0.05:  # The grid starts over for a new swc
+            swc = swc[:len(swc) // 2 + 1]
+        nodes = np.zeros((rng.randint(1, 30), 8))
+        nodes[:, 5] = np.inf  # Every node covers the head
+        if rng.rand() < 0.3:  # Outside the volume
+            nodes[:, 2:5] = rng.rand(len(nodes), 3) * np.asarray(shape) * 1.4 - 10
+        elif rng.rand() < 0.3:  # Duplicates
+            nodes[:, 2:5] = swc[rng.randint(len(swc), size=len(nodes)), 2:5]
+        else:  # On the voxel grid, with many ties
+            nodes[:, 2:5] = rng.randint(0, min(shape), size=(len(nodes), 3))
+        swc = np.vstack((swc, nodes))
+
+        srcpt = rng.rand(3) * (np.asarray(shape) - 3) + 1
+        pts, _, _, reason, _, _, _, touch_idx = r2backtrack.branch(
+            srcpt, grad, bimg, bimg, tt, swc, 1., True, grid)
+        dist = np.linalg.norm(swc[:, 2:5] - pts[-1], axis=1)
+        assert reason == STOP_MERGED and touch_idx == np.flatnonzero(dist == dist.min())[0]
+    print(f'Node grid: {nadd} merges up to {len(swc)} nodes')
+
+
+if __name__ == '__main__':
+    assert r2backtrack is not None, 'Build the r2backtrack extension first (python setup.py build_ext --inplace)'
+
+    for seed in range(3):
+        for quality in (False, True):
+            check_backtrack_parity(seed, quality)
+    check_node_grid()
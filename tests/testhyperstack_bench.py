@@ -0,0 +1,164 @@
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import SimpleITK as sitk
+import tifffile
+
+from rivunetpy.rivunetpy import HyperStack, Tracer
+from rivunetpy.swc import SWC
+from rivunetpy.utils.cells import Neuron
+
+LOAD_SCRIPT = '''
+import json, resource, sys, time, warnings
+warnings.simplefilter('ignore')
+from rivunetpy.rivunetpy import HyperStack
+fname, lazy = sys.argv[1], sys.argv[2] == '1'
+t0 = time.time()
+hyperstack = HyperStack.from_file(fname, lazy=lazy)
+t_open = time.time() - t0
+t0 = time.time()
+hyperstack.t_project(mode='MAX')
+t_project = time.time() - t0
+print(json.dumps([t_open, t_project, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10]))
+'''
+
+
+POOL_SCRIPT = '''
+import json, pickle, resource, sys, time, warnings
+warnings.simplefilter('ignore')
+import numpy as np
+from multiprocessing import Pool
+from rivunetpy.rivunetpy import HyperStack, Tracer
+fname, mode = sys.argv[1], sys.argv[3]
+with open(sys.argv[2], 'rb') as f:
+    rois = pickle.load(f)
+hyperstack = HyperStack.from_file(fname, lazy=mode == 'memmap')
+t0 = time.time()
+stack = hyperstack if mode == 'pickled' else hyperstack.share()
+with Pool(processes=2) as pool:
+    if mode == 'pickled':  # One task per neuron, each carrying the recording
+        args = [(hyperstack, [roi]) for roi in rois]
+    else:  # Frame chunks over the recording attached by name
+        chunks = np.array_split(np.arange(stack.GetSize()[3]), 2)
+        args = [(stack, rois, range(chunk[0], chunk[-1] + 1)) for chunk in chunks]
+    sent = sum(len(pickle.dumps(arg)) for arg in args)
+    results = [result.get() for result in [pool.apply_async(Tracer._get_intensities, arg) for arg in args]]
+stack.close()
+t = time.time() - t0
+traces = np.vstack(results) if mode == 'pickled' else np.hstack(results)
+assert np.allclose(traces, Tracer._get_intensities(hyperstack, rois))
+print(json.dumps([t, sent / len(args), resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 2 ** 10]))
+'''
+
+
+def bench_lazy_hyperstack(shape=(100, 20, 256, 400)):
+    '''
+    Time and peak resident memory of opening an ImageJ hyperstack and
+    projecting it through time, read whole versus memory-mapped. Each run
+    gets a process of its own so the peaks do not carry over
+    '''
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as out:
+        fname = os.path.join(out, 'hyperstack.tif')
+        frame = rng.randint(0, 4000, size=shape[1:]).astype('uint16')
+        tifffile.imwrite(fname, np.broadcast_to(frame, shape), imagej=True, metadata={'axes': 'TZYX'})
+        print(f'{np.prod(shape) * 2 / 2 ** 20:.0f} MB recording')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for name, lazy in (('read', '0'), ('memory-mapped', '1')):
+            out = subprocess.run([sys.executable, '-c', LOAD_SCRIPT, fname, lazy], cwd=root,
+                                 capture_output=True, text=True, check=True).stdout
+            t_open, t_project, rss = json.loads(out.splitlines()[-1])
+            print(f'{name:>14}: open {t_open:6.2f}s, MAX projection {t_project:6.2f}s, peak RSS {rss:6.0f} MB')
+
+
+def random_rois(shape, nneuron, hyperstack, rng):
+    rois = []
+    for ii in range(nneuron):
+        neuron = Neuron(None, num=ii)
+        neuron.swc = SWC()
+        neuron.swc._data = np.asarray([[1, 1, *(rng.rand(3) * shape[:0:-1]), rng.rand() + 0.5, -1, 1.]])
+        rois.append(Tracer._soma_roi(neuron, hyperstack))
+    return rois
+
+
+def bench_voltage_pool(shape=(100, 20, 128, 128), nneurons=(4, 16, 64)):
+    '''
+    Wall time, bytes sent per task and peak worker memory of the voltage
+    pool with the recording pickled into each per-neuron task versus frame
+    chunks over a recording the workers attach to by name, either in shared
+    memory or memory-mapped from the file
+    '''
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as out:
+        fname = os.path.join(out, 'hyperstack.tif')
+        tifffile.imwrite(fname, rng.randint(0, 4000, size=shape).astype('uint16'),
+                         imagej=True, metadata={'axes': 'TZYX'})
+        with warnings.catch_warnings():  # No voxel size in the metadata
+            warnings.simplefilter('ignore')
+            hyperstack = HyperStack.from_file(fname, lazy=True)
+        print(f'{np.prod(shape) * 2 / 2 ** 20:.0f} MB recording')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for nneuron in nneurons:
+            with open(os.path.join(out, 'rois.pkl'), 'wb') as f:
+                pickle.dump(random_rois(shape, nneuron, hyperstack, rng), f)
+            for mode in ('pickled', 'shm', 'memmap'):
+                args = [sys.executable, '-c', POOL_SCRIPT, fname, os.path.join(out, 'rois.pkl'), mode]
+                t, sent, rss = json.loads(subprocess.run(args, cwd=root, capture_output=True, text=True,
+                                                         check=True).stdout.splitlines()[-1])
+                print(f'{nneuron:4d} neurons {mode:>8}: {t:6.2f}s, {sent / 2 ** 10:9.1f} kB per task, '
+                      f'peak worker RSS {rss:6.0f} MB')
+
+
+def full_volume_trace(hyperstack, roi):
+    '''
+    The former per-neuron extraction: every frame is multiplied with a
+    full-volume mask and averaged over the whole volume
+    '''
+    bbox, ball = roi
+    x_size, y_size, z_size, frames = hyperstack.GetSize()
+    full = np.zeros((z_size, y_size, x_size), dtype='uint16')
+    full[bbox] = ball
+    mask = sitk.GetImageFromArray(full)
+    intensities = np.zeros(frames)
+    for ii in range(frames):
+        volume = sitk.GetImageFromArray(hyperstack.frame(ii)) * mask
+        intensities[ii] = np.mean(sitk.GetArrayFromImage(volume))
+    return intensities * full.size / ball.sum()  # Averaged over the mask
+
+
+def bench_soma_traces(shape=(200, 20, 256, 256), nneuron=20):
+    '''
+    Time to get the soma traces of all neurons with a full-volume pass per
+    neuron versus one pass over the frames reading only the soma regions
+    '''
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as out:
+        fname = os.path.join(out, 'hyperstack.tif')
+        tifffile.imwrite(fname, rng.randint(0, 4000, size=shape).astype('uint16'),
+                         imagej=True, metadata={'axes': 'TZYX'})
+        with warnings.catch_warnings():  # No voxel size in the metadata
+            warnings.simplefilter('ignore')
+            hyperstack = HyperStack.from_file(fname, lazy=True)
+
+        rois = random_rois(shape, nneuron, hyperstack, rng)
+
+        t0 = time.time()
+        ref = [full_volume_trace(hyperstack, roi) for roi in rois]
+        print(f'{"full volume":>12}: {time.time() - t0:6.2f}s')
+        t0 = time.time()
+        traces = Tracer._get_intensities(hyperstack, rois)
+        print(f'{"single pass":>12}: {time.time() - t0:6.2f}s for {nneuron} neurons')
+        assert np.allclose(traces, ref)
+
+
+if __name__ == '__main__':
+    bench_lazy_hyperstack()
+    bench_soma_traces()
+    bench_voltage_pool()
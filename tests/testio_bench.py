@@ -0,0 +1,58 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from rivunetpy.utils.io import loadswc, saveswc, loadswcnpz, saveswcnpz
+
+
+def split_loadswc(filepath):
+    '''
+    The former loadswc: one float per cell, lines split on single spaces
+    '''
+    swc = []
+    with open(filepath) as f:
+        for l in f.read().split('\n'):
+            if not l.startswith('#'):
+                cells = l.strip().split(' ')
+                if len(cells) == 7:
+                    swc.append([float(c) for c in cells])
+    return np.array(swc)
+
+
+def make_swc(nnode, seed=0):
+    rng = np.random.RandomState(seed)
+    swc = np.zeros((nnode, 8))
+    swc[:, 0] = np.arange(1, nnode + 1)
+    swc[:, 1] = 3
+    swc[:, 2:5] = np.cumsum(rng.randn(nnode, 3), axis=0) + 500
+    swc[:, 5] = rng.rand(nnode) * 3
+    swc[:, 6] = np.arange(nnode)
+    swc[0, 6] = -1
+    return swc
+
+
+def bench_reload(nfile=1000, nnode=5000):
+    '''
+    Time per file to reload cached reconstructions with the former line
+    splitting, the bulk text parser and the binary .rnp.npz sidecar
+    '''
+    with tempfile.TemporaryDirectory() as out:
+        swcs = [make_swc(nnode, seed) for seed in range(nfile)]
+        for i, swc in enumerate(swcs):
+            saveswc(os.path.join(out, f'{i}.rnp.swc'), swc)
+            saveswcnpz(os.path.join(out, f'{i}.rnp.npz'), swc)
+
+        for name, load, ext in (('split lines', split_loadswc, 'swc'),
+                                ('loadswc', loadswc, 'swc'),
+                                ('loadswcnpz', loadswcnpz, 'npz')):
+            t0 = time.time()
+            for i, swc in enumerate(swcs):
+                loaded = load(os.path.join(out, f'{i}.rnp.{ext}'))
+                assert np.allclose(loaded, swc[:, :7], atol=5e-4)
+            print(f'{name:>12}: {(time.time() - t0) / nfile * 1e3:6.2f} ms per file of {nnode} nodes')
+
+
+if __name__ == '__main__':
+    bench_reload()
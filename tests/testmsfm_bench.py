@@ -0,0 +1,130 @@
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+import msfm
+
+
+def make_speed(nvox, seed=0):
+    '''
+    A smooth positive speed image of about nvox voxels with a 2:2:1 aspect
+    '''
+    z = max(int(round((nvox / 4) ** (1 / 3))), 2)
+    rng = np.random.RandomState(seed)
+    speed = gaussian_filter(rng.rand(2 * z, 2 * z, z), 2)
+    speed -= speed.min()
+    return speed / speed.max() + 0.1
+
+
+def bench_narrow_band(sizes=(10 ** 6, 10 ** 7)):
+    '''
+    Seconds to march through whole volumes with the min-tree list and with
+    the binary heap narrow band. Both should produce the same time map as
+    the speed image has no ties
+    '''
+    for nvox in sizes:
+        speed = make_speed(nvox)
+        bimg = np.ones(speed.shape, dtype='int64')
+        source = np.asarray(speed.shape) // 2
+        result = {}
+        for name, heap in (('list', False), ('heap', True)):
+            t0 = time.time()
+            result[name] = msfm.run(speed, bimg, source, True, True, heap=heap)
+            print(f'{speed.size:>12} voxels {name:>5}: {time.time() - t0:7.2f}s')
+        assert np.allclose(result['list'], result['heap'])
+
+
+def check_progress_and_cancel(nvox=10 ** 6, every=10000):
+    '''
+    The progress callback counts frozen foreground voxels, and setting the
+    cancel event stops the fast marching with msfm.Cancelled
+    '''
+    speed = make_speed(nvox)
+    bimg = np.ones(speed.shape, dtype='int64')
+    source = np.asarray(speed.shape) // 2
+    reports = []
+    msfm.run(speed, bimg, source, True, True,
+             progress=lambda frozen, total: reports.append((frozen, total)), every=every)
+    assert reports and all(total == speed.size for _, total in reports)
+    assert [frozen for frozen, _ in reports] == list(range(every, reports[-1][0] + 1, every))
+
+    cancel = threading.Event()
+    seen = []
+
+    def stop_halfway(frozen, total):
+        seen.append(frozen)
+        if frozen >= total // 2:
+            cancel.set()
+
+    try:
+        msfm.run(speed, bimg, source, True, True,
+                 progress=stop_halfway, cancel=cancel, every=every)
+    except msfm.Cancelled:
+        assert seen[-1] < reports[-1][0]
+        print(f'Cancelled after {len(seen)} of {len(reports)} progress reports')
+    else:
+        raise AssertionError('The fast marching was not cancelled')
+
+
+def bench_threads(nvox=10 ** 6, nvolume=4, nthread=4):
+    '''
+    Marching several volumes one after the other versus from a thread pool,
+    which overlaps as the GIL is released while marching
+    '''
+    volumes = [make_speed(nvox, seed) for seed in range(nvolume)]
+
+    def march(speed):
+        return msfm.run(speed, np.ones(speed.shape, dtype='int64'),
+                        np.asarray(speed.shape) // 2, True, True, heap=True)
+
+    t0 = time.time()
+    serial = [march(speed) for speed in volumes]
+    print(f'{nvolume} volumes one by one: {time.time() - t0:7.2f}s')
+    t0 = time.time()
+    with ThreadPoolExecutor(nthread) as pool:
+        threaded = list(pool.map(march, volumes))
+    print(f'{nvolume} volumes on {nthread} threads: {time.time() - t0:7.2f}s')
+    assert all(np.array_equal(a, b) for a, b in zip(serial, threaded))
+
+
+MEMORY_SCRIPT = '''
+import resource, sys
+import numpy as np
+import msfm
+from testmsfm_bench import make_speed
+speed = make_speed({nvox}).astype('float32')
+bimg = np.ones(speed.shape, dtype='uint8')
+source = np.asarray(speed.shape) // 2
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if {legacy}:
+    # As R2Tracer used to call it: float64 speed and int64 binary image copies
+    msfm.run(speed.astype('float64'), bimg.copy().astype('int64'), source, True, True, heap=True)
+else:
+    msfm.run(speed, bimg, source, True, True, heap=True)
+print((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024)
+'''
+
+
+def bench_memory(nvox=10 ** 7):
+    '''
+    Growth of the peak RSS while marching a float32 speed image with a
+    uint8 mask passed in place, versus converting them as R2Tracer used to.
+    Each run is done in a fresh interpreter
+    '''
+    for name, legacy in (('Converted inputs', True), ('In place inputs', False)):
+        out = subprocess.run([sys.executable, '-c', MEMORY_SCRIPT.format(nvox=nvox, legacy=legacy)],
+                             capture_output=True, text=True, check=True)
+        print(f'{name:>18}: peak RSS grew by {float(out.stdout):8.0f} MB')
+
+
+if __name__ == '__main__':
+    check_progress_and_cancel()
+    bench_threads()
+    bench_memory()
+    # The volume sizes to benchmark can be given on the command line, e.g. 1e6 1e8 1e9
+    bench_narrow_band([int(float(s)) for s in sys.argv[1:]] or (10 ** 6, 10 ** 7))
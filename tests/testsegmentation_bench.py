@@ -0,0 +1,170 @@
+import copy
+import os
+import tempfile
+import time
+import warnings
+from multiprocessing import Pool
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import SimpleITK as sitk
+import tifffile
+
+from rivunetpy.rivunetpy import Tracer
+from rivunetpy.utils.segmentation import NeuronSegmentor, CROP_MARGIN
+from testtrace_bench import make_synthetic_neuron
+
+
+def make_field(grid=(2, 3), size=(100, 100, 36), gap=30):
+    '''
+    A wide field of view with a grid of synthetic neurons, as a SimpleITK
+    image
+    '''
+    shape = (grid[0] * (size[0] + gap) + gap, grid[1] * (size[1] + gap) + gap, size[2] + 4)
+    vol = np.zeros(shape)
+    for ii in range(grid[0]):
+        for jj in range(grid[1]):
+            x0, y0 = gap + ii * (size[0] + gap), gap + jj * (size[1] + gap)
+            neuron = make_synthetic_neuron(size, nbranch=5, seed=ii * grid[1] + jj)
+            vol[x0:x0 + size[0], y0:y0 + size[1], 2:2 + size[2]] = neuron
+    return sitk.GetImageFromArray(np.transpose(vol, (2, 1, 0)).astype('uint16'))
+
+
+def full_fov_images(segmentor):
+    '''
+    The former neuron images: the full field of view masked by each region
+    '''
+    labels = np.unique(sitk.GetArrayViewFromImage(segmentor.regions))
+    return [segmentor.img * sitk.Cast(segmentor.regions == label, segmentor.PixelID) for label in labels[labels > 0]]
+
+
+def bench_neuron_crops(grid=(2, 3)):
+    '''
+    Memory and disk used by the per-neuron images of a segmented field of
+    view, masked full-size copies versus crops of each region
+    '''
+    img = make_field(grid)
+    segmentor = NeuronSegmentor(img)
+    print(f'{len(segmentor.neurons)} neurons in a field of view of {img.GetSize()}')
+
+    t0 = time.time()
+    full = full_fov_images(segmentor)
+    t_full = time.time() - t0
+    for name, images, t in (('full view', full, t_full),
+                            ('cropped', [neuron.img for neuron in segmentor.neurons], None)):
+        with tempfile.TemporaryDirectory() as out:
+            for ii, image in enumerate(images):
+                sitk.WriteImage(image, os.path.join(out, f'neuron_{ii:04d}.rnp.tif'))
+            disk = sum(os.path.getsize(os.path.join(out, fname)) for fname in os.listdir(out))
+        nbytes = sum(sitk.GetArrayViewFromImage(image).nbytes for image in images)
+        took = f', {t:6.2f}s' if t is not None else ''
+        print(f'{name:>10}: {nbytes / 2 ** 20:6.1f} MB in memory, {disk / 2 ** 20:6.1f} MB on disk{took}')
+
+    # The crops trace back to the original image through their offsets
+    with tempfile.TemporaryDirectory() as out:
+        tracer = Tracer()
+        tracer.out = out
+        tracer.neurons = segmentor.neurons
+        for neuron in tracer.neurons:
+            tracer._write_neuron_to_file(neuron)
+        fg = sitk.GetArrayViewFromImage(img) > 12
+        for neuron in tracer.neurons:
+            neuron = Tracer._trace_single(neuron, None, False, False, True, (1, 1, 1))
+            xyz = np.clip(np.round(neuron.swc._data[:, 2:5]).astype(int), 0, np.asarray(img.GetSize()) - 1)
+            print(f'Neuron ({neuron.num}): {fg[tuple(xyz[:, ::-1].T)].mean():.0%} of nodes on the neuron')
+
+
+def per_label_crops(segmentor):
+    '''
+    The former extraction: every label is compared against the whole image
+    to find its bounding box before cropping
+    '''
+    shape_stats = sitk.LabelShapeStatisticsImageFilter()
+    size = np.asarray(segmentor.img.GetSize())
+    labels = np.unique(sitk.GetArrayViewFromImage(segmentor.regions))
+    for label in labels[labels > 0]:
+        region = segmentor.regions == int(label)
+        shape_stats.Execute(region)
+        bbox = np.asarray(shape_stats.GetBoundingBox(1))
+        lower = np.maximum(bbox[:3] - CROP_MARGIN, 0)
+        upper = np.minimum(bbox[:3] + bbox[3:] + CROP_MARGIN, size)
+        index, crop_size = lower.tolist(), (upper - lower).tolist()
+        yield (sitk.RegionOfInterest(segmentor.img, crop_size, index)
+               * sitk.Cast(sitk.RegionOfInterest(region, crop_size, index), segmentor.PixelID))
+
+
+def bench_label_split(grid=(4, 4)):
+    '''
+    Time to the first and to all neuron crops with a whole-image pass per
+    label versus the label statistics of a single pass
+    '''
+    img = make_field(grid)
+    segmentor = NeuronSegmentor(img)
+    segmentor._neurons = None  # Drop the crops extracted for the summary plot
+    print(f'{len(segmentor.region_stats.GetLabels())} regions in a field of view of {img.GetSize()}')
+
+    for name, crops in (('per label', per_label_crops(segmentor)),
+                        ('one pass', (neuron.img for neuron in segmentor.iter_neurons()))):
+        t0 = time.time()
+        images = [next(crops)]
+        t_first = time.time() - t0
+        images.extend(crops)
+        print(f'{name:>10}: first neuron after {t_first:6.3f}s, all {len(images)} after {time.time() - t0:6.3f}s')
+        if name == 'per label':
+            ref = images
+    for image, crop in zip(ref, images):
+        assert np.array_equal(sitk.GetArrayViewFromImage(image), sitk.GetArrayViewFromImage(crop))
+
+
+def barrier_execute(tracer, neurons):
+    '''
+    The former Tracer.execute after segmentation: every step finishes for
+    all neurons, with a pool of its own, before the next one starts
+    '''
+    neurons = list(neurons)
+    for neuron in neurons:
+        tracer._write_neuron_to_file(neuron)
+    with Pool(processes=max(os.cpu_count() - 1, 1)) as pool:
+        result_buffers = [pool.apply_async(Tracer._trace_single,
+                                           (neuron, tracer.threshold, tracer._speed, tracer.quality,
+                                            tracer.overwrite_cache, tracer.hyperstack.voxel_size))
+                          for neuron in neurons]
+        tracer.neurons = [result.get() for result in result_buffers]
+    tracer._get_voltage_all()
+
+
+def bench_pipeline(grid=(3, 3), frames=20):
+    '''
+    Wall time from the segmented neurons to their voltage traces with a
+    barrier between the steps versus neurons pipelined through one pool,
+    largest first
+    '''
+    img = sitk.GetArrayFromImage(make_field(grid))
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as out:
+        fname = os.path.join(out, 'hyperstack.tif')
+        recording = img + rng.randint(0, 10, size=(frames,) + img.shape).astype('uint16')
+        tifffile.imwrite(fname, recording, imagej=True, metadata={'axes': 'TZYX'})
+
+        with warnings.catch_warnings():  # No voxel size in the metadata
+            warnings.simplefilter('ignore')
+            tracer = Tracer()
+            tracer.set_file(fname)
+            neurons = list(tracer._segment())
+
+            for name, run in (('barriers', barrier_execute),
+                              ('pipelined', Tracer._run_pipeline)):
+                tracer.set_output_dir(os.path.join(out, name))
+                os.mkdir(tracer.out)
+                tracer.set_overwrite_cache(True)
+                t0 = time.time()
+                run(tracer, copy.deepcopy(neurons))
+                print(f'{name:>10}: {time.time() - t0:6.2f}s for {len(tracer.neurons)} neurons on '
+                      f'{max(os.cpu_count() - 1, 1)} workers')
+
+
+if __name__ == '__main__':
+    bench_neuron_crops()
+    bench_label_split()
+    bench_pipeline()
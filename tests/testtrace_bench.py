@@ -0,0 +1,639 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from collections import Counter
+
+import numpy as np
+import skfmm
+from scipy.interpolate import RegularGridInterpolator
+from scipy.ndimage import binary_dilation, gaussian_filter, label
+from scipy.spatial.distance import cdist
+
+from rivunetpy.soma import Soma
+from rivunetpy.swc import SWC
+from rivunetpy.trace import R2Branch
+from rivunetpy.trace import R2Tracer, GradientField, LazyArgmax, rk4, descent_field, r2backtrack
+from rivunetpy.trace import restricted_travel_time
+from rivunetpy.utils.metrics import precision_recall
+
+
+def make_synthetic_neuron(shape=(128, 128, 64), nbranch=8, seed=0, nspeckle=0):
+    '''
+    A soma ball with random-walk neurites, blurred and scaled to 0-255.
+    Isolated speckles of noise each end up as a short branch of their own
+    '''
+    rng = np.random.RandomState(seed)
+    img = np.zeros(shape)
+    c = np.asarray(shape) // 2
+    X, Y, Z = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    img[(X - c[0]) ** 2 + (Y - c[1]) ** 2 + (Z - c[2]) ** 2 <= 36] = 1
+
+    for _ in range(nbranch):
+        p = c.astype('float64')
+        d = rng.randn(3)
+        d /= np.linalg.norm(d)
+        for _ in range(max(shape) * 2):
+            d += 0.3 * rng.randn(3)
+            d /= np.linalg.norm(d)
+            p += d
+            if np.any(p < 2) or np.any(p >= np.asarray(shape) - 2):
+                break
+            i = np.floor(p).astype(int)
+            img[i[0] - 1:i[0] + 2, i[1] - 1:i[1] + 2, i[2] - 1:i[2] + 1] = 1
+
+    for _ in range(nspeckle):
+        i = [rng.randint(2, s - 3) for s in shape]
+        img[i[0]:i[0] + 2, i[1]:i[1] + 2, i[2]:i[2] + 2] = 1
+
+    return gaussian_filter(img, 0.7) * 255
+
+
+def bench_gradient_sampler(nsteps=5000):
+    '''
+    RK4 steps per second with the RegularGridInterpolator triple
+    versus the interleaved GradientField
+    '''
+    img = make_synthetic_neuron()
+    tracer = R2Tracer(quality=False, silent=True)
+    tracer.img = img
+    tracer._bimg = (img > 60).astype('int')
+    tracer._soma = Soma()
+    tracer._soma.detect(tracer._bimg, True, True)
+    tracer._prep()
+
+    dx, dy, dz = np.moveaxis(tracer._dist_gradient(), -1, 0)
+    grid = tuple(np.arange(s) for s in tracer._t.shape)
+    interps = [RegularGridInterpolator(grid, d) for d in (dx, dy, dz)]
+
+    def old_sampler(pt):
+        return np.asarray([g(pt)[0] for g in interps])
+
+    new_sampler = GradientField(dx, dy, dz)
+
+    start = np.asarray(np.unravel_index(tracer._tt.argmax(), tracer._tt.shape)).astype('float64')
+    for name, sampler in (('RegularGridInterpolator', old_sampler), ('GradientField', new_sampler)):
+        pt = start.copy()
+        t0 = time.time()
+        for _ in range(nsteps):
+            pt = rk4(pt, sampler, tracer._t, 1)
+        elapsed = time.time() - t0
+        print(f'{name:>24}: {nsteps / elapsed:10.0f} steps/s')
+
+    # Both samplers should agree on a batch of random points
+    pts = np.random.rand(1000, 3) * (np.asarray(tracer._t.shape) - 1)
+    ref = np.stack([g(pts) for g in interps], axis=1)
+    assert np.allclose(new_sampler(pts), ref, atol=1e-6)
+
+
+def loop_descent(t):
+    '''
+    The former R2Tracer._dist_gradient: one masked assignment per neighbour
+    over three float64 volumes
+    '''
+    t = t.copy()
+    fx, fy, fz = (np.zeros(shape=t.shape) for _ in range(3))
+    J = np.zeros(shape=[s + 2 for s in t.shape])  # Padded Image
+    J[:, :, :] = t.max()
+    J[1:-1, 1:-1, 1:-1] = t
+    for n in [[i, j, k] for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)
+              if (i, j, k) != (0, 0, 0)]:
+        In = J[1 + n[0]:J.shape[0] - 1 + n[0],
+               1 + n[1]:J.shape[1] - 1 + n[1],
+               1 + n[2]:J.shape[2] - 1 + n[2]]
+        check = In < t
+        t[check] = In[check]
+        D = np.divide(n, np.linalg.norm(n))
+        fx[check] = D[0]
+        fy[check] = D[1]
+        fz[check] = D[2]
+    return np.stack((-fx, -fy, -fz), axis=-1)
+
+
+def bench_descent(shape=(256, 256, 128), margin=2):
+    '''
+    Time and output size of the 26-neighbour descent: the former numpy loop,
+    the numpy fallback on the foreground and the compiled kernel
+    '''
+    img = make_synthetic_neuron(shape, nbranch=30)
+    tracer = R2Tracer(quality=False, silent=True)
+    tracer.img = img
+    tracer._bimg = (img > 60).astype('uint8')
+    tracer._soma = Soma()
+    tracer._soma.detect(tracer._bimg, True, True)
+    tracer._make_dt()
+    tracer._fast_marching()
+    t = tracer._t
+    mask = binary_dilation(tracer._bimg, iterations=margin)
+
+    t0 = time.time()
+    ref = loop_descent(t)
+    print(f'{"numpy loop":>24}: {time.time() - t0:6.2f}s, {ref.nbytes / 2 ** 20:6.0f} MB')
+
+    candidates = [('numpy', lambda: descent_field(t, None, t.max())),
+                  ('numpy foreground', lambda: descent_field(t, mask, t.max()))]
+    if r2backtrack is not None:
+        candidates += [('compiled', lambda: r2backtrack.descent(t, None, float(t.max()))),
+                       ('compiled foreground', lambda: r2backtrack.descent(t, mask, float(t.max())))]
+    for name, fn in candidates:
+        t0 = time.time()
+        field = fn()
+        print(f'{name:>24}: {time.time() - t0:6.2f}s, {field.nbytes / 2 ** 20:6.0f} MB')
+        if name.endswith('foreground'):
+            assert np.allclose(field[mask], ref[mask], atol=1e-6)
+        else:
+            assert np.allclose(field, ref, atol=1e-6)
+
+
+class FullScanCoverageTracer(R2Tracer):
+    '''
+    R2Tracer counting the coverage with a full-volume scan for every branch
+    '''
+
+    def _update_coverage(self):
+        self._cover_ctr_new = self._count_covered()
+        super()._update_coverage()
+
+
+class TimedCoverageTracer(R2Tracer):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.coverage_time = 0.
+        self.nbranch = 0
+
+    def _update_coverage(self):
+        t0 = time.time()
+        super()._update_coverage()
+        self.coverage_time += time.time() - t0
+        self.nbranch += 1
+
+
+class TimedFullScanCoverageTracer(TimedCoverageTracer, FullScanCoverageTracer):
+    pass
+
+
+def bench_coverage(shape=(256, 256, 128), nspeckle=3000):
+    '''
+    Time spent keeping the coverage up to date with a full scan per branch
+    versus the incremental counter updated by _erase
+    '''
+    img = make_synthetic_neuron(shape, nbranch=30, nspeckle=nspeckle)
+    covered = []
+    for name, cls in (('Full scan', TimedFullScanCoverageTracer),
+                      ('Incremental', TimedCoverageTracer)):
+        tracer = cls(quality=False, silent=True)
+        t0 = time.time()
+        tracer.trace(img, 60)
+        elapsed = time.time() - t0
+        covered.append(tracer._cover_ctr_new)
+        print(f'{name:>12}: {tracer.nbranch} branches, coverage {tracer.coverage_time:.2f}s '
+              f'of {elapsed:.2f}s tracing')
+    assert covered[0] == covered[1]
+
+
+def bench_lazy_argmax(shape=(128, 128, 64), nquery=2000):
+    '''
+    Seed selection with LazyArgmax against np.argmax on a timemap with
+    many ties, erasing a random block around every seed
+    '''
+    rng = np.random.RandomState(0)
+    tt = rng.randint(0, 50, size=shape).astype('float64')
+    tt[rng.rand(*shape) < 0.5] = -2
+    tt[0, 0, :4] = np.nan
+    reference = tt.copy()
+    queue = LazyArgmax(tt)
+
+    t_lazy = t_argmax = 0.
+    for _ in range(nquery):
+        t0 = time.time()
+        idx = queue.argmax()
+        t_lazy += time.time() - t0
+        t0 = time.time()
+        ref = reference.argmax()
+        t_argmax += time.time() - t0
+        assert idx == ref, (idx, ref)
+
+        x, y, z = np.unravel_index(idx, shape)
+        dx, dy = rng.randint(1, 4, size=2)
+        for arr in (tt, reference):
+            arr[x, y, z] = -2
+            arr[x:x + dx, y:y + dy, z] = -1
+
+    print(f'{nquery} seeds: np.argmax {t_argmax:.2f}s, LazyArgmax {t_lazy:.3f}s')
+
+
+class TimedMarchingTracer(R2Tracer):
+
+    def _fast_marching(self):
+        t0 = time.time()
+        super()._fast_marching()
+        self.marching_time = time.time() - t0
+
+
+def bench_restricted_march(shape=(256, 256, 128), nbranch=8, margin=2):
+    '''
+    Low quality fast marching through the whole volume versus only around
+    the foreground of a sparse neuron, with the node precision/recall of the
+    restricted trace against the whole-volume one. High quality ignores
+    march_margin
+    '''
+    img = make_synthetic_neuron(shape, nbranch=nbranch)
+    print(f'Foreground is {(img > 60).mean() * 100:.2f}% of the volume')
+    swcs = []
+    for march_margin in (None, margin):
+        tracer = TimedMarchingTracer(quality=False, silent=True, march_margin=march_margin)
+        t0 = time.time()
+        swc, _ = tracer.trace(img, 60)
+        elapsed = time.time() - t0
+        swcs.append(swc._data.copy())
+        print(f'march_margin={march_margin}: '
+              f'marching {tracer.marching_time:6.2f}s of {elapsed:6.2f}s, {swc.size()} nodes')
+    with warnings.catch_warnings():  # Identical traces leave no far nodes to average
+        warnings.simplefilter('ignore', RuntimeWarning)
+        (precision, recall, f1), _, _ = precision_recall(swcs[1], swcs[0])
+    print(f'     precision {precision:.3f}, recall {recall:.3f}, F1 {f1:.3f}')
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        tracer = R2Tracer(quality=True, silent=True, march_margin=margin)
+    assert tracer._march_margin is None and len(caught) == 1
+
+
+def bench_curved_soma_march(shape=(128, 128, 64), nbranch=8, margin=2):
+    '''
+    Restricted marching from the centre of mass of a C-shaped soma, which
+    lies outside the foreground and its dilation. Every voxel connected to
+    the soma should still be reached, in the same order as when marching through
+    the whole volume
+    '''
+    img = make_synthetic_neuron(shape, nbranch=nbranch)
+    c = np.asarray(shape) // 2
+    X, Y, Z = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    r2 = (X - c[0]) ** 2 + (Y - c[1]) ** 2 + (Z - c[2]) ** 2
+    img[r2 <= 64] = 0
+    img[(r2 <= 144) & (r2 > 64) & (X >= c[0] - 8)] = 255
+    # Neurites cut off by the opening of the soma are left out
+    labels, _ = label(img > 60)
+    bimg = labels == labels[c[0] + 10, c[1], c[2]]
+    region = binary_dilation(bimg, iterations=margin)
+    source = c
+    assert not region[tuple(source)]
+
+    # The speed image of R2Tracer._make_speed
+    speed = skfmm.distance(bimg.astype('uint8'), dx=5e-2) ** 4
+    speed[speed <= 0] = 1e-10
+    t0 = time.time()
+    t = restricted_travel_time(speed, region, source)
+    elapsed = time.time() - t0
+    assert np.all(np.isfinite(t)) and np.all(t[bimg] < t.max())
+
+    marchmap = np.ones(shape)
+    marchmap[tuple(source)] = -1
+    full = skfmm.travel_time(marchmap, speed, dx=5e-3)
+    rank = np.corrcoef(np.argsort(np.argsort(t[bimg])), np.argsort(np.argsort(full[bimg])))[0, 1]
+    print(f'Curved soma: restricted march {elapsed:.2f}s, '
+          f'arrival order correlation with the whole volume {rank:.3f}')
+
+
+def bench_pyramid(shape=(256, 256, 128), nbranch=30, pyramids=(2, 4), qualities=(False, True)):
+    '''
+    Tracing at full resolution versus coarse-to-fine from a volume
+    downsampled in X and Y, with the node precision/recall of each
+    coarse-to-fine trace against the full-resolution one
+    '''
+    img = make_synthetic_neuron(shape, nbranch=nbranch)
+    for quality in qualities:
+        swcs = {}
+        for pyramid in (1,) + tuple(pyramids):
+            # Most msfm branches of the synthetic neuron do not connect
+            # back to the soma, so they are kept in high quality
+            tracer = R2Tracer(quality=quality, silent=True, clean=not quality, pyramid=pyramid)
+            t0 = time.time()
+            swc, _ = tracer.trace(img, 60)
+            elapsed = time.time() - t0
+            swcs[pyramid] = swc._data.copy()
+            print(f'quality={quality} pyramid={pyramid}: {elapsed:6.2f}s, {swc.size()} nodes')
+            if pyramid > 1:
+                with warnings.catch_warnings():  # Identical traces leave no far nodes to average
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    (precision, recall, f1), _, _ = precision_recall(swcs[pyramid], swcs[1].copy())
+                print(f'           precision {precision:.3f}, recall {recall:.3f}, F1 {f1:.3f}')
+
+
+def cdist_match(swc, pos, radius):
+    '''
+    The former SWC.match, scanning every node
+    '''
+    distlist = cdist(pos.reshape(1, 3), swc._data[:, 2:5])[0]
+    minidx = distlist.argmin()
+    mindist = np.linalg.norm(pos - swc._data[minidx, 2:5])
+    return radius > mindist or swc._data[minidx, 5] > mindist, minidx
+
+
+def bench_swc_match(nbranch=2000, branchlen=50, nquery=20):
+    '''
+    Time of the nearest-node queries made while a swc grows branch by
+    branch, scanning every node versus the index of SWC.match
+    '''
+    rng = np.random.RandomState(0)
+    swc = SWC()
+    t_scan = t_index = 0.
+    for _ in range(nbranch):
+        branch = R2Branch()
+        branch.pts = np.cumsum(rng.randn(branchlen, 3), axis=0) + rng.rand(3) * 500
+        branch.radius = rng.rand(branchlen) * 2
+        branch.conf = np.ones(branchlen)
+        swc.add_branch(branch)
+        for pos in branch.pts[rng.randint(branchlen, size=nquery)] + rng.randn(nquery, 3):
+            t0 = time.time()
+            ref = cdist_match(swc, pos, 1.)
+            t_scan += time.time() - t0
+            t0 = time.time()
+            matched = swc.match(pos, 1.)
+            t_index += time.time() - t0
+            assert matched == ref, (matched, ref)
+    print(f'{nbranch * nquery} queries up to {swc.size()} nodes: '
+          f'full scan {t_scan:.2f}s, SWC.match {t_index:.2f}s')
+
+
+def bench_swc_match_scaling(sizes=(10000, 100000, 1000000), branchlen=50, nquery=2):
+    '''
+    Time per SWC.match query and time to index each appended node while a
+    swc grows branch by branch from one size to the next, with the time of
+    a full scan at each size
+    '''
+    rng = np.random.RandomState(0)
+    swc = SWC()
+    for size in sizes:
+        t_update = t_query = 0.
+        nnode, nmatch = swc.size(), 0
+        while swc.size() < size:
+            nodes = np.zeros((branchlen, 8))
+            nodes[:, 2:5] = np.cumsum(rng.randn(branchlen, 3), axis=0) + rng.rand(3) * 2000
+            nodes[:, 5] = 1
+            swc.add(nodes)
+            t0 = time.time()
+            swc._update_index()
+            t_update += time.time() - t0
+            for pos in nodes[rng.randint(branchlen, size=nquery), 2:5] + rng.randn(nquery, 3):
+                t0 = time.time()
+                swc.match(pos, 1.)
+                t_query += time.time() - t0
+                nmatch += 1
+        t0 = time.time()
+        for pos in nodes[:nquery * 10, 2:5] + rng.randn(nquery * 10, 3):
+            ref = cdist_match(swc, pos, 1.)
+            assert swc.match(pos, 1.) == ref
+        t_scan = (time.time() - t0) / (nquery * 10)
+        print(f'{swc.size():>8} nodes: {t_query / nmatch * 1e6:5.0f} us per query, '
+              f'{t_update / (swc.size() - nnode) * 1e6:5.1f} us to index a node, '
+              f'full scan {t_scan * 1e6:6.0f} us')
+
+
+def bench_swc_append(nbranch=5000, branchlen=20):
+    '''
+    Time to grow a swc branch by branch, copying the whole array and
+    finding the next id for every branch versus SWC.add_branch
+    '''
+    rng = np.random.RandomState(0)
+    branches = []
+    for _ in range(nbranch):
+        branch = R2Branch()
+        branch.pts = rng.rand(branchlen, 3) * 1000
+        branch.radius = np.ones(branchlen)
+        branch.conf = np.ones(branchlen)
+        branches.append(branch)
+
+    t0 = time.time()
+    data = np.zeros((1, 8))
+    for branch in branches:
+        rows = np.zeros((branchlen, 8))
+        rows[:, 0] = data[:, 0].max() + 1 + np.arange(branchlen)
+        rows[:, 2:5] = branch.pts
+        data = np.vstack((data, rows))
+    print(f'{"np.vstack":>16}: {time.time() - t0:6.2f}s')
+
+    t0 = time.time()
+    swc = SWC()
+    for branch in branches:
+        swc.add_branch(branch)
+    print(f'{"SWC.add_branch":>16}: {time.time() - t0:6.2f}s, {swc.size()} nodes')
+    assert np.array_equal(swc._data[:, 0], data[:, 0])
+
+
+def recursive_clean(data):
+    '''
+    The renumbering of the former SWC.clean: a recursive depth-first
+    traversal from the root and a Python loop filling the new rows
+    '''
+    children = {}
+    for sample_id, parent_id in data[:, [0, 6]].astype(int):
+        children.setdefault(parent_id, []).append(sample_id)
+    mapper = np.zeros(int(data[:, 0].max()) + 2, dtype=int)
+    new_id = 0
+
+    def assign_id(node):
+        nonlocal new_id
+        new_id += 1
+        mapper[node] = new_id
+        for child in children.get(node, []):
+            assign_id(child)
+
+    assign_id(children[-1][0])
+    new_data = np.zeros((new_id, data.shape[1]))
+    for line in data:
+        new_data[mapper[int(line[0])] - 1] = line
+        new_data[mapper[int(line[0])] - 1, 0] = mapper[int(line[0])]
+        new_data[mapper[int(line[0])] - 1, 6] = mapper[int(line[6])]
+    new_data[0, 6] = -1
+    return new_data
+
+
+def make_deep_tree(nnode, depth, seed=0):
+    '''
+    swc rows of a random tree made of unbranched paths of the given length,
+    each forking from a random node of the tree so far, in shuffled order
+    '''
+    rng = np.random.RandomState(seed)
+    parent = np.arange(-1, nnode - 1)
+    starts = np.arange(1, nnode, depth)
+    parent[starts] = (rng.rand(starts.size) * starts).astype(int)
+    data = np.zeros((nnode, 8))
+    data[:, 0] = rng.permutation(nnode) + 1
+    data[:, 6] = np.where(parent >= 0, data[parent, 0], -1)
+    data[:, 1] = 3
+    data[:, 2:6] = rng.rand(nnode, 4)
+    return data[rng.permutation(nnode)]
+
+
+def bench_swc_clean(cases=((10000, 50), (100000, 50), (1000000, 100000))):
+    '''
+    Renumbering deep random trees with the recursive traversal versus the
+    depth-first order of SWC.clean
+    '''
+    for nnode, depth in cases:
+        data = make_deep_tree(nnode, depth)
+        swc = SWC()
+        swc._data = data.copy()
+        t0 = time.time()
+        swc.clean()
+        elapsed = time.time() - t0
+        t0 = time.time()
+        try:
+            ref = recursive_clean(data)
+            recursive = f'{time.time() - t0:6.2f}s'
+            assert np.array_equal(swc._data, ref)
+        except RecursionError:
+            recursive = 'RecursionError'
+        print(f'{nnode:>8} nodes, paths of {depth:>6}: recursive {recursive}, SWC.clean {elapsed:6.2f}s')
+
+
+def scan_prune_leaves(data):
+    '''
+    The former SWC._prune_leaves: every leaf branch is walked with a scan
+    of all the nodes per step
+    '''
+    childctr = Counter(data[:, 6])
+    rmean = data[:, 5].mean()
+    id2dump = []
+    for leafid in [i for i in data[:, 0] if i not in data[:, 6]]:
+        nodeid, branch = leafid, []
+        while True:
+            node = data[data[:, 0] == nodeid, :].flatten()
+            if node.size == 0:
+                break
+            branch.append(node)
+            if childctr[node[6]] != 1:
+                break
+            nodeid = node[6]
+        leaflen = sum(np.linalg.norm(branch[i][2:5] - branch[i - 1][2:5]) for i in range(1, len(branch)))
+        if leaflen <= 4 * rmean:
+            id2dump.extend(node[0] for node in branch)
+    return np.asarray([n for n in data if n[0] not in id2dump])
+
+
+def bench_prune_leaves(sizes=(2000, 10000, 1000000), depth=5):
+    '''
+    Leaf pruning of random trees with short leaf branches, scanning the
+    nodes for every step versus SWC._prune_leaves
+    '''
+    for nnode in sizes:
+        data = make_deep_tree(nnode, depth)
+        data[:, 2:5] = np.cumsum(data[:, 2:5], axis=0)  # Spread the nodes out
+        swc = SWC()
+        swc._data = data.copy()
+        t0 = time.time()
+        swc._prune_leaves()
+        elapsed = time.time() - t0
+        scan = 'skipped'
+        if nnode <= 10000:
+            t0 = time.time()
+            ref = scan_prune_leaves(data)
+            scan = f'{time.time() - t0:6.2f}s'
+            assert np.array_equal(swc._data, ref)
+        print(f'{nnode:>8} nodes: scan {scan}, SWC._prune_leaves {elapsed:6.2f}s, {swc.size()} kept')
+
+
+def object_components(data):
+    '''
+    The components of the former SWC._prune_unreached: a set of links per
+    node and a breadth-first search popping the front of a list
+    '''
+    links = {n[0]: set() for n in data}
+    for n in data:
+        if n[6] >= 0:
+            links[n[0]].add(n[6])
+            links[n[6]].add(n[0])
+    nodes, groups = set(links), []
+    while nodes:
+        group = {nodes.pop()}
+        queue = list(group)
+        while queue:
+            neighbours = set(links[queue.pop(0)]) - group
+            nodes -= neighbours
+            group |= neighbours
+            queue.extend(neighbours)
+        groups.append(group)
+    return groups
+
+
+def bench_prune_unreached(sizes=(10000, 100000, 500000), ncomponent=50):
+    '''
+    Time and peak Python allocations of keeping the largest component of a
+    forest, with per-node link sets versus SWC._prune_unreached
+    '''
+    for nnode in sizes:
+        data = make_deep_tree(nnode, 20)
+        data[:, 2:5] *= 1e6  # No orphan is matched to another node
+        cut = np.sort(np.random.RandomState(1).choice(nnode, ncomponent, replace=False))
+        data[cut, 6] = -2
+        swc = SWC()
+        swc._data = data.copy()
+        tracemalloc.start()
+        t0 = time.time()
+        swc._prune_unreached()
+        elapsed = time.time() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result = f'SWC._prune_unreached {elapsed:6.2f}s {peak / 2 ** 20:6.0f} MB'
+        if nnode <= 100000:
+            tracemalloc.start()
+            t0 = time.time()
+            groups = object_components(data)
+            elapsed = time.time() - t0
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            result = f'link sets {elapsed:6.2f}s {peak / 2 ** 20:6.0f} MB, ' + result
+            assert max(len(g) for g in groups) == swc.size()
+        print(f'{nnode:>7} nodes: {result}')
+
+
+SCRATCH_SCRIPT = '''
+import json, sys
+from tests.testtrace_bench import make_synthetic_neuron
+from rivunetpy.trace import R2Tracer, peak_rss
+shape, scratch = json.loads(sys.argv[1]), sys.argv[2] or None
+img = make_synthetic_neuron(tuple(shape), nbranch=30).astype('float32')
+base = peak_rss()
+tracer = R2Tracer(quality=True, silent=True, scratch=scratch)
+swc, _ = tracer.trace(img, 60)
+print(json.dumps([base, tracer.memory_report, swc.size()]))
+'''
+
+
+def bench_scratch(shape=(384, 384, 192)):
+    '''
+    Peak resident memory after each stage of a trace with the working
+    volumes in RAM versus memory-mapped in a scratch directory. Each run
+    gets a process of its own so the peaks do not carry over
+    '''
+    with tempfile.TemporaryDirectory() as scratch:
+        for name, arg in (('in memory', ''), ('scratch', scratch)):
+            out = subprocess.run([sys.executable, '-c', SCRATCH_SCRIPT, json.dumps(shape), arg],
+                                 capture_output=True, text=True, check=True,
+                                 cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+            base, report, size = json.loads(out.splitlines()[-1])
+            stages = ', '.join(f'{stage} {rss - base:.0f}' for stage, rss in report)
+            print(f'{name:>10}: {size} nodes, MB above the input: {stages}')
+
+
+if __name__ == '__main__':
+    bench_gradient_sampler()
+    bench_descent()
+    bench_coverage()
+    bench_lazy_argmax()
+    bench_restricted_march()
+    bench_curved_soma_march()
+    bench_scratch()
+    bench_pyramid()
+    bench_swc_match()
+    bench_swc_match_scaling()
+    bench_swc_append()
+    bench_swc_clean()
+    bench_prune_leaves()
+    bench_prune_unreached()